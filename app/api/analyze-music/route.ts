@@ -1,6 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { join } from 'path';
-import { exec } from 'child_process';
+import { exec, spawn } from 'child_process';
 import { promisify } from 'util';
 import { existsSync } from 'fs';
 import {
@@ -8,6 +8,13 @@ import {
   resolveAudioFileUnderDownloads,
   resolveBestAudioFileUnderDownloads,
 } from '../utils/common';
+import {
+  getAnalyzerWorker,
+  AnalyzerWorkerTimeoutError,
+  type AnalyzerProgressEvent,
+  type PitchEngine,
+} from '../utils/analyzerWorker';
+import { sendProgressEvent } from '@/lib/utils/progressEventService';
 
 async function resolveAnalysisFilePath(
   filename: string,
@@ -29,6 +36,56 @@ export const dynamic = 'force-dynamic';
 // DEDUPLICATION: Evitar análises simultâneas do mesmo arquivo
 // ──────────────────────────────────────────────────────────────────
 const pendingAnalyses = new Map<string, Promise<AudioAnalysis>>();
+// Quem acompanha cada análise em andamento (inclui quem reaproveitou a promise)
+const pendingListeners = new Map<string, Set<ProgressListener>>();
+
+type ProgressListener = (event: AnalyzerProgressEvent) => void;
+
+// ──────────────────────────────────────────────────────────────────
+// PROGRESSO: estágios do Python → SSE do cliente (/api/download-progress)
+// ──────────────────────────────────────────────────────────────────
+
+// Grupos de estágio do Python (PROGRESS_STAGES em audio_analyzer.py)
+const ANALYSIS_STAGE_LABELS: Record<string, string> = {
+  decode: 'Decodificando áudio',
+  hpss: 'Separando harmônico/percussivo',
+  basic: 'BPM, tonalidade e bandas',
+  identity: 'Identidade e groove',
+  drums: 'Bateria, baixo e synths',
+  structure: 'Estrutura e dinâmica',
+  arrangement: 'Arranjo temporal',
+  midi: 'Extraindo MIDI',
+};
+
+/**
+ * Repassa os eventos de estágio da análise ao cliente inscrito no SSE de
+ * progresso com o mesmo id (`/api/download-progress?downloadId=<progressId>`).
+ */
+function createProgressForwarder(progressId: string): ProgressListener {
+  let lastProgress = 0;
+  return (event) => {
+    if (event.event === 'stage_end') {
+      lastProgress = Math.round((event.progress ?? 0) * 100);
+    }
+    sendProgressEvent(progressId, {
+      type: 'analysis',
+      step: ANALYSIS_STAGE_LABELS[event.stage] ?? event.stage,
+      substep: event.event,
+      progress: lastProgress,
+      detail: event.eta != null ? `restam ~${Math.round(event.eta)}s` : undefined,
+    });
+  };
+}
+
+function parseProgressId(value: unknown): string | undefined {
+  return typeof value === 'string' && value.trim() ? value.trim() : undefined;
+}
+
+const PITCH_ENGINES: readonly PitchEngine[] = ['pyin', 'salience'];
+
+function parsePitchEngine(value: unknown): PitchEngine | undefined {
+  return PITCH_ENGINES.includes(value as PitchEngine) ? (value as PitchEngine) : undefined;
+}
 
 // ──────────────────────────────────────────────────────────────────
 // INTERFACES
@@ -209,6 +266,7 @@ interface MidiExtractedEvent {
 interface StemMeta {
   confidence: number; // 0–1
   method: 'detected' | 'estimated';
+  engine?: PitchEngine; // motor de pitch (bassline/lead)
 }
 
 interface MidiExtractionResult {
@@ -239,6 +297,8 @@ interface AudioAnalysis {
   };
   bpm?: number;
   key?: string;
+  /** Origem da tonalidade: tag confirmada, STFT do mix (barato) ou CQT harmônico (completo) */
+  keyMethod?: 'tag' | 'mix_stft' | 'harmonic_cqt';
   analysisMethod?: 'python' | 'ffmpeg';
 
   // Dados detalhados da análise v2
@@ -299,6 +359,7 @@ interface PythonAnalysisResult {
   sample_rate?: number;
   bpm?: number;
   key?: string;
+  key_method?: 'tag' | 'mix_stft' | 'harmonic_cqt' | null;
   analysis_method?: string;
   loudness?: {
     peak_db: number;
@@ -416,21 +477,21 @@ interface PythonAnalysisResult {
     behavior?: string;
     function?: string;
   }>;
-  // Retrocompatibilidade
+  // Retrocompatibilidade (null no modo streaming: não analisado, ≠ ausente)
   drum_detection?: {
     kick_present: boolean;
     snare_present: boolean;
     hihat_present: boolean;
     cymbals_present: boolean;
     percussion_present: boolean;
-  };
+  } | null;
   bass_detection?: {
     sub_bass: boolean;
     mid_bass: boolean;
     bassline: boolean;
-  };
-  detected_synths?: string[];
-  detected_instruments?: string[];
+  } | null;
+  detected_synths?: string[] | null;
+  detected_instruments?: string[] | null;
   midi_extraction?: {
     source?: string;
     coverage?: string;
@@ -444,15 +505,97 @@ interface PythonAnalysisResult {
       midi: number;
       velocity: number;
     }>>;
-    stem_meta?: Record<string, { confidence: number; method: 'detected' | 'estimated' }>;
+    stem_meta?: Record<string, { confidence: number; method: 'detected' | 'estimated'; engine?: PitchEngine }>;
   };
   error?: string;
 }
 
+/**
+ * Roda o analisador avulso com `--progress ndjson`: repassa os eventos de
+ * estágio conforme chegam e resolve com a última linha do stdout (o resultado
+ * compacto). Rejeita como o execAsync (stdout/stderr/killed no erro), para o
+ * loop de fallback entre comandos Python continuar igual.
+ */
+function runAnalyzerCli(
+  pythonCmd: string,
+  args: string[],
+  timeoutMs: number,
+  onProgress?: ProgressListener
+): Promise<{ stdout: string; stderr: string }> {
+  return new Promise((resolve, reject) => {
+    const proc = spawn(pythonCmd, args, {
+      env: { ...process.env, PYTHONDONTWRITEBYTECODE: '1' }  // Evitar __pycache__ (triggera rebuilds)
+    });
+    let pending = '';
+    let resultLine = '';
+    let stderr = '';
+    let killed = false;
+    let settled = false;
+
+    const handleLine = (line: string) => {
+      if (line.startsWith('{"event"')) {
+        try {
+          onProgress?.(JSON.parse(line) as AnalyzerProgressEvent);
+          return;
+        } catch {
+          // Não era um evento: trata como resultado
+        }
+      }
+      resultLine = line;
+    };
+
+    const finish = (error: Error | null) => {
+      if (settled) return;
+      settled = true;
+      clearTimeout(timer);
+      if (error) {
+        reject(Object.assign(error, { stdout: resultLine, stderr, killed }));
+      } else {
+        resolve({ stdout: resultLine, stderr });
+      }
+    };
+
+    const timer = setTimeout(() => {
+      killed = true;
+      proc.kill('SIGTERM');
+    }, timeoutMs);
+
+    proc.stdout.setEncoding('utf8');
+    proc.stdout.on('data', (chunk: string) => {
+      pending += chunk;
+      let newline = pending.indexOf('\n');
+      while (newline >= 0) {
+        const line = pending.slice(0, newline).trim();
+        pending = pending.slice(newline + 1);
+        if (line) handleLine(line);
+        newline = pending.indexOf('\n');
+      }
+    });
+    proc.stderr.setEncoding('utf8');
+    proc.stderr.on('data', (chunk: string) => {
+      // Só o fim do stderr interessa (erro/traceback); evita crescer sem limite
+      stderr = (stderr + chunk).slice(-1024 * 1024);
+    });
+    proc.on('error', (error) => finish(error));
+    proc.on('close', (code, signal) => {
+      if (pending.trim()) handleLine(pending.trim());
+      if (code === 0) {
+        finish(null);
+      } else {
+        finish(new Error(`Command failed: ${pythonCmd} ${args.join(' ')} (${signal ?? `exit ${code}`})`));
+      }
+    });
+  });
+}
+
 /**
  * Tenta analisar usando o script Python (librosa)
  */
-async function analyzeWithPython(filePath: string): Promise<PythonAnalysisResult | null> {
+async function analyzeWithPython(
+  filePath: string,
+  pitchEngine?: PitchEngine,
+  onProgress?: ProgressListener
+): Promise<PythonAnalysisResult | null> {
   try {
     const scriptPath = join(process.cwd(), 'scripts', 'audio_analyzer.py');
 
@@ -463,22 +606,55 @@ async function analyzeWithPython(filePath: string): Promise<PythonAnalysisResult
 
     console.log(`🐍 [Python Analysis] Analisando: ${filePath.split(/[/\\]/).pop()}`);
 
+    // Mixes/sets longos vão no modo streaming (memória constante, sem
+    // bateria/baixo/synths/arranjo/MIDI); o Python decide pela duração só
+    // depois de consultar o cache de resultados
+    const stream = 'auto';
+
+    // Eventos de estágio: log no console e repasse a quem acompanha (SSE do cliente)
+    const handleProgress: ProgressListener = (event) => {
+      if (event.event === 'stage_end') {
+        const eta = event.eta != null ? `, restam ~${event.eta}s` : '';
+        console.log(`   ⏱️ ${event.stage}: ${event.duration}s (${Math.round((event.progress ?? 0) * 100)}%${eta})`);
+      }
+      onProgress?.(event);
+    };
+
+    // PRIORIDADE: worker persistente (--serve), sem cold start de imports/JIT por faixa.
+    // Processo avulso fica como fallback quando o worker não sobe.
+    const worker = getAnalyzerWorker();
+    if (worker) {
+      try {
+        const result = (await worker.analyze(filePath, 300000, handleProgress, pitchEngine, stream)) as PythonAnalysisResult;
+        if (!result?.success) {
+          console.warn('⚠️ [Python Analysis] Falha:', result?.error);
+          return null;
+        }
+        console.log('✅ [Python Analysis] Análise v2 concluída com sucesso (worker)');
+        console.log(`   BPM: ${result.bpm}, Key: ${result.key}, Genre: ${result.musical_identity?.genre}`);
+        return result;
+      } catch (error) {
+        if (error instanceof AnalyzerWorkerTimeoutError) {
+          throw error;
+        }
+        console.warn('⚠️ [Python Analysis] Worker indisponível, usando processo avulso:', error);
+      }
+    }
+
     // Tentar python3.11 primeiro, depois python3, depois python
     const pythonCommands = ['python3.11', 'python3', 'python'];
+    // --progress ndjson: eventos de estágio no stdout, resultado compacto na última linha
+    const cliArgs = [scriptPath, filePath, '--progress', 'ndjson'];
+    if (pitchEngine) cliArgs.push('--pitch-engine', pitchEngine);
+    cliArgs.push('--stream-auto');
     let stdout = '';
     let stderr = '';
     let lastError: Error | null = null;
 
     for (const pythonCmd of pythonCommands) {
       try {
-        const result = await execAsync(
-          `${pythonCmd} "${scriptPath}" "${filePath}"`,
-          {
-            maxBuffer: 1024 * 1024 * 10,
-            timeout: 300000,  // 300 segundos (5 min) para arquivos grandes
-            env: { ...process.env, PYTHONDONTWRITEBYTECODE: '1' }  // Evitar __pycache__ (triggera rebuilds)
-          }
-        );
+        // 300 segundos (5 min) para arquivos grandes
+        const result = await runAnalyzerCli(pythonCmd, cliArgs, 300000, handleProgress);
         stdout = result.stdout;
         stderr = result.stderr;
         lastError = null;
@@ -740,6 +916,7 @@ function convertPythonResult(pythonResult: PythonAnalysisResult, filePath: strin
     },
     bpm: pythonResult.bpm,
     key: pythonResult.key,
+    keyMethod: pythonResult.key_method ?? undefined,
     analysisMethod: 'python',
     // Dados ricos v2
     musicalIdentity,
@@ -802,11 +979,15 @@ function convertPythonResult(pythonResult: PythonAnalysisResult, filePath: strin
 /**
  * Analisa um arquivo de áudio usando ffprobe e ffmpeg (fallback)
  */
-async function analyzeAudioFileInternal(filePath: string): Promise<AudioAnalysis> {
+async function analyzeAudioFileInternal(
+  filePath: string,
+  pitchEngine?: PitchEngine,
+  onProgress?: ProgressListener
+): Promise<AudioAnalysis> {
   try {
     // PRIORIDADE 1: Tentar análise Python v2 (mais completa e precisa)
     console.log('🎵 [Analyze] Tentando análise Python v2...');
-    const pythonResult = await analyzeWithPython(filePath);
+    const pythonResult = await analyzeWithPython(filePath, pitchEngine, onProgress);
 
     if (pythonResult) {
       console.log('✅ [Analyze] Usando resultados do Python v2');
@@ -878,32 +1059,50 @@ async function analyzeAudioFileInternal(filePath: string): Promise<AudioAnalysis
 }
 
 /**
- * Wrapper com deduplicação: evita análises simultâneas do mesmo arquivo
+ * Wrapper com deduplicação: evita análises simultâneas do mesmo arquivo.
+ * `onProgress` recebe os eventos de estágio, também quando a análise é reaproveitada.
  */
-async function analyzeAudioFile(filePath: string): Promise<AudioAnalysis> {
-  // Se já existe uma análise em andamento para este arquivo, reutilizar
-  const existing = pendingAnalyses.get(filePath);
+async function analyzeAudioFile(
+  filePath: string,
+  pitchEngine?: PitchEngine,
+  onProgress?: ProgressListener
+): Promise<AudioAnalysis> {
+  // Se já existe uma análise em andamento para este arquivo (e motor), reutilizar
+  const pendingKey = pitchEngine ? `${filePath}|${pitchEngine}` : filePath;
+  const existing = pendingAnalyses.get(pendingKey);
   if (existing) {
     console.log('♻️ [Analyze] Reutilizando análise em andamento para:', filePath);
+    if (onProgress) pendingListeners.get(pendingKey)?.add(onProgress);
     return existing;
   }
 
   // Criar nova análise e registrar
-  const analysisPromise = analyzeAudioFileInternal(filePath).finally(() => {
-    pendingAnalyses.delete(filePath);
+  const listeners = new Set<ProgressListener>(onProgress ? [onProgress] : []);
+  pendingListeners.set(pendingKey, listeners);
+  const analysisPromise = analyzeAudioFileInternal(filePath, pitchEngine, (event) => {
+    listeners.forEach((listener) => listener(event));
+  }).finally(() => {
+    pendingAnalyses.delete(pendingKey);
+    pendingListeners.delete(pendingKey);
   });
 
-  pendingAnalyses.set(filePath, analysisPromise);
+  pendingAnalyses.set(pendingKey, analysisPromise);
   return analysisPromise;
 }
 
 /**
  * POST /api/analyze-music
+ * Body: { filename, preferBestQuality?, pitchEngine?, progressId? } — com `progressId`,
+ * os estágios da análise chegam pelo SSE /api/download-progress?downloadId=<progressId>.
  */
 export async function POST(request: NextRequest) {
   try {
     const body = await request.json();
     const { filename, preferBestQuality } = body;
+    // 'salience' troca o pyin por um motor de pitch rápido (ex.: exportação de MIDI pack)
+    const pitchEngine = parsePitchEngine(body.pitchEngine);
+    // Progresso por estágio no SSE /api/download-progress?downloadId=<progressId>
+    const progressId = parseProgressId(body.progressId);
 
     if (!filename) {
       return NextResponse.json(
@@ -929,7 +1128,11 @@ export async function POST(request: NextRequest) {
 
     const startTime = Date.now();
 
-    const analysisPromise = analyzeAudioFile(filePath);
+    const analysisPromise = analyzeAudioFile(
+      filePath,
+      pitchEngine,
+      progressId ? createProgressForwarder(progressId) : undefined
+    );
     const timeoutPromise = new Promise<never>((_, reject) =>
       setTimeout(() => reject(new Error('Timeout: análise demorou mais de 300 segundos')), 300000)
     );
@@ -962,13 +1165,14 @@ export async function POST(request: NextRequest) {
 }
 
 /**
- * GET /api/analyze-music?filename=...
+ * GET /api/analyze-music?filename=...&progressId=...
  */
 export async function GET(request: NextRequest) {
   try {
     const { searchParams } = new URL(request.url);
     const filename = searchParams.get('filename');
     const preferBestQuality = searchParams.get('preferBestQuality') === 'true';
+    const progressId = parseProgressId(searchParams.get('progressId'));
 
     if (!filename) {
       return NextResponse.json(
@@ -994,7 +1198,11 @@ export async function GET(request: NextRequest) {
 
     const startTime = Date.now();
 
-    const analysisPromise = analyzeAudioFile(filePath);
+    const analysisPromise = analyzeAudioFile(
+      filePath,
+      undefined,
+      progressId ? createProgressForwarder(progressId) : undefined
+    );
     const timeoutPromise = new Promise<never>((_, reject) =>
       setTimeout(() => reject(new Error('Timeout: análise demorou mais de 300 segundos')), 300000)
     );
@@ -0,0 +1,246 @@
+import { spawn, type ChildProcessWithoutNullStreams } from 'child_process';
+import { createInterface } from 'readline';
+import { existsSync } from 'fs';
+import { join } from 'path';
+
+/**
+ * Worker Python persistente (`audio_analyzer.py --serve`).
+ *
+ * Um único processo fica vivo entre requisições: paga uma vez o start do
+ * interpretador, os imports (numpy/librosa/scipy/numba) e a compilação JIT,
+ * em vez de a cada faixa. Protocolo NDJSON: um job por linha no stdin, um
+ * resultado por linha no stdout. Jobs são enviados um de cada vez (fila); o
+ * prazo de cada job conta desde a entrada na fila — o mesmo relógio de quem
+ * espera a resposta —, e um job que vence ainda na fila sai dela sem rodar.
+ */
+
+const PYTHON_COMMANDS = ['python3.11', 'python3', 'python'];
+const READY_TIMEOUT_MS = 120000;
+
+/** O job estourou o tempo — o worker foi reiniciado; não vale tentar de novo. */
+export class AnalyzerWorkerTimeoutError extends Error {
+  constructor(timeoutMs: number) {
+    super(`Timeout do worker de análise (${timeoutMs}ms)`);
+    this.name = 'AnalyzerWorkerTimeoutError';
+  }
+}
+
+/** Motor de pitch da bassline/lead no MIDI (`PITCH_ENGINES` do Python). */
+export type PitchEngine = 'pyin' | 'salience';
+
+/** Modo streaming do job: `'auto'` deixa o Python decidir pela duração, depois do cache. */
+export type AnalyzerStreamMode = boolean | 'auto';
+
+/** Evento de estágio emitido pelo Python (`ProgressReporter`) antes do resultado. */
+export interface AnalyzerProgressEvent {
+  event: 'stage_start' | 'stage_end';
+  stage: string;
+  index?: number | null;
+  total?: number;
+  elapsed: number;
+  duration?: number;
+  progress?: number;
+  eta?: number | null;
+}
+
+interface WorkerJob {
+  id: string;
+  path: string;
+  timeoutMs: number;
+  onProgress?: (event: AnalyzerProgressEvent) => void;
+  pitchEngine?: PitchEngine;
+  stream?: AnalyzerStreamMode;
+  timer: NodeJS.Timeout | null;
+  sent: boolean;
+  resolve: (result: unknown) => void;
+  reject: (error: Error) => void;
+}
+
+class AnalyzerWorker {
+  private proc: ChildProcessWithoutNullStreams | null = null;
+  private ready: Promise<void> | null = null;
+  private queue: WorkerJob[] = [];
+  private current: WorkerJob | null = null;
+  private nextId = 1;
+
+  constructor(private readonly scriptPath: string) {}
+
+  analyze(
+    path: string,
+    timeoutMs: number,
+    onProgress?: (event: AnalyzerProgressEvent) => void,
+    pitchEngine?: PitchEngine,
+    stream?: AnalyzerStreamMode
+  ): Promise<unknown> {
+    return new Promise((resolve, reject) => {
+      const job: WorkerJob = {
+        id: String(this.nextId++), path, timeoutMs, onProgress, pitchEngine, stream, timer: null, sent: false, resolve, reject,
+      };
+      job.timer = setTimeout(() => this.expire(job), timeoutMs);
+      this.queue.push(job);
+      void this.pump();
+    });
+  }
+
+  private expire(job: WorkerJob): void {
+    job.timer = null;
+    if (this.current === job) {
+      // Job travado: mata o worker antes de liberar a fila — senão o próximo
+      // job sobe um processo novo e o stop() o derrubaria em seguida. Se ainda
+      // esperava o worker subir, o start segue e atende o próximo job
+      if (job.sent) this.stop();
+      this.finishCurrent(new AnalyzerWorkerTimeoutError(job.timeoutMs));
+      return;
+    }
+    // Venceu ainda na fila: ninguém espera mais o resultado, não roda
+    const index = this.queue.indexOf(job);
+    if (index >= 0) this.queue.splice(index, 1);
+    job.reject(new AnalyzerWorkerTimeoutError(job.timeoutMs));
+  }
+
+  private async pump(): Promise<void> {
+    if (this.current || this.queue.length === 0) return;
+    const job = this.queue.shift()!;
+    this.current = job;
+    try {
+      await this.ensureStarted();
+    } catch (error) {
+      this.finishCurrent(error as Error);
+      return;
+    }
+    const proc = this.proc;
+    if (!proc || this.current !== job) {
+      // O worker caiu (ou foi parado) enquanto o job esperava o start
+      if (this.current === job) this.finishCurrent(new Error('Worker de análise indisponível'));
+      return;
+    }
+    job.sent = true;
+    proc.stdin.write(
+      JSON.stringify({
+        id: job.id,
+        path: job.path,
+        progress: Boolean(job.onProgress),
+        pitch_engine: job.pitchEngine,
+        stream: job.stream,
+      }) + '\n'
+    );
+  }
+
+  private finishCurrent(error: Error | null, result?: unknown): void {
+    const job = this.current;
+    if (!job) return;
+    if (job.timer) clearTimeout(job.timer);
+    job.timer = null;
+    this.current = null;
+    if (error) job.reject(error);
+    else job.resolve(result);
+    void this.pump();
+  }
+
+  private ensureStarted(): Promise<void> {
+    // Um start em andamento é reaproveitado: um job que venceu esperando o
+    // worker subir libera a fila, e o próximo não pode subir outro processo
+    if (this.ready) return this.ready;
+    const ready = this.start(0);
+    ready.catch(() => {
+      if (this.ready === ready) this.ready = null;
+    });
+    this.ready = ready;
+    return ready;
+  }
+
+  private start(commandIndex: number): Promise<void> {
+    return new Promise((resolve, reject) => {
+      if (commandIndex >= PYTHON_COMMANDS.length) {
+        reject(new Error('Nenhum Python disponível para o worker de análise'));
+        return;
+      }
+      const proc = spawn(PYTHON_COMMANDS[commandIndex], [this.scriptPath, '--serve'], {
+        env: { ...process.env, PYTHONDONTWRITEBYTECODE: '1' },
+        windowsHide: true,
+      });
+      let settled = false;
+      const readyTimer = setTimeout(() => {
+        if (settled) return;
+        settled = true;
+        proc.kill();
+        reject(new Error('Worker de análise não ficou pronto a tempo'));
+      }, READY_TIMEOUT_MS);
+
+      proc.on('error', () => {
+        // Comando inexistente (ENOENT): tentar o próximo Python
+        if (settled) return;
+        settled = true;
+        clearTimeout(readyTimer);
+        this.start(commandIndex + 1).then(resolve, reject);
+      });
+
+      proc.stdin.on('error', () => {
+        // EPIPE ao escrever num worker que acabou de morrer: o 'exit' abaixo trata
+      });
+
+      proc.stderr.on('data', () => {
+        // Logs [Perf]/[Info] do Python: descartados (o stdout carrega o protocolo)
+      });
+
+      const lines = createInterface({ input: proc.stdout });
+      lines.on('line', (line) => {
+        let msg: { id?: string | null; event?: string; result?: unknown };
+        try {
+          msg = JSON.parse(line);
+        } catch {
+          return;
+        }
+        if (msg.event === 'ready') {
+          if (!settled) {
+            settled = true;
+            clearTimeout(readyTimer);
+            this.proc = proc;
+            console.log(`🐍 [Analyzer Worker] Pronto (${PYTHON_COMMANDS[commandIndex]}, pid ${proc.pid})`);
+            resolve();
+          }
+          return;
+        }
+        if (this.current && msg.id === this.current.id) {
+          if (msg.event === 'stage_start' || msg.event === 'stage_end') {
+            this.current.onProgress?.(msg as unknown as AnalyzerProgressEvent);
+            return;
+          }
+          this.finishCurrent(null, msg.result);
+        }
+      });
+
+      proc.on('exit', (code) => {
+        clearTimeout(readyTimer);
+        if (this.proc === proc) {
+          this.proc = null;
+          this.ready = null;
+          this.finishCurrent(new Error(`Worker de análise encerrou (código ${code})`));
+        }
+        if (!settled) {
+          settled = true;
+          reject(new Error(`Worker de análise encerrou antes de ficar pronto (código ${code})`));
+        }
+      });
+    });
+  }
+
+  stop(): void {
+    const proc = this.proc;
+    this.proc = null;
+    this.ready = null;
+    proc?.kill();
+  }
+}
+
+// Singleton sobrevive ao hot reload do Next em dev (módulo é reavaliado)
+const globalForWorker = globalThis as typeof globalThis & { __legolasAnalyzerWorker?: AnalyzerWorker };
+
+export function getAnalyzerWorker(): AnalyzerWorker | null {
+  const scriptPath = join(process.cwd(), 'scripts', 'audio_analyzer.py');
+  if (!existsSync(scriptPath)) return null;
+  if (!globalForWorker.__legolasAnalyzerWorker) {
+    globalForWorker.__legolasAnalyzerWorker = new AnalyzerWorker(scriptPath);
+  }
+  return globalForWorker.__legolasAnalyzerWorker;
+}
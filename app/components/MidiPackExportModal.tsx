@@ -4,6 +4,7 @@ import { useCallback, useMemo, useState } from 'react';
 import BaseModal from './BaseModal';
 import {
   pickBestTracksForMidiPack,
+  type MidiPackPitchEngine,
   type MidiPackTrackInput,
 } from '../utils/midiPackExport';
 import { useMidiPackExport } from '../contexts/MidiPackExportContext';
@@ -24,6 +25,7 @@ export default function MidiPackExportModal({
   filteredTracks,
 }: MidiPackExportModalProps) {
   const [scope, setScope] = useState<ExportScope>('library');
+  const [pitchEngine, setPitchEngine] = useState<MidiPackPitchEngine>('pyin');
   const { activeJob, startPackExport } = useMidiPackExport();
 
   const bestAll = useMemo(() => pickBestTracksForMidiPack(allTracks), [allTracks]);
@@ -51,11 +53,11 @@ export default function MidiPackExportModal({
     const scopeLabel =
       scope === 'filtered' ? 'Busca filtrada' : 'Biblioteca inteira';
 
-    const started = startPackExport(tracksToExport, scopeLabel);
+    const started = startPackExport(tracksToExport, scopeLabel, { pitchEngine });
     if (started) {
       onClose();
     }
-  }, [tracksToExport, exportRunning, scope, startPackExport, onClose]);
+  }, [tracksToExport, exportRunning, scope, pitchEngine, startPackExport, onClose]);
 
   return (
     <BaseModal
@@ -100,6 +102,30 @@ export default function MidiPackExportModal({
           )}
         </div>
 
+        <div className="space-y-2">
+          <p className="text-xs text-gray-500 font-medium">Notas do baixo/lead</p>
+          <label className="flex items-center gap-2 text-sm text-gray-300 cursor-pointer">
+            <input
+              type="radio"
+              name="midi-pack-pitch-engine"
+              checked={pitchEngine === 'pyin'}
+              onChange={() => setPitchEngine('pyin')}
+              className="accent-emerald-500"
+            />
+            Precisão (pyin)
+          </label>
+          <label className="flex items-center gap-2 text-sm text-gray-300 cursor-pointer">
+            <input
+              type="radio"
+              name="midi-pack-pitch-engine"
+              checked={pitchEngine === 'salience'}
+              onChange={() => setPitchEngine('salience')}
+              className="accent-emerald-500"
+            />
+            Rápido (saliência) — bom para bibliotecas grandes
+          </label>
+        </div>
+
         <div
           className="text-xs text-gray-500 rounded-lg border px-3 py-2 space-y-1"
           style={{ borderColor: themeColors.border, backgroundColor: 'rgba(0,0,0,0.2)' }}
@@ -357,6 +357,8 @@ export default function MusicStudyModal({ isOpen, onClose }: MusicStudyModalProp
   const [isAnalyzing, setIsAnalyzing] = useState(false);
   const [analysis, setAnalysis] = useState<FullAnalysis | null>(null);
   const [analysisError, setAnalysisError] = useState<string | null>(null);
+  // Estágio atual da análise (SSE /api/download-progress, eventos type 'analysis')
+  const [analysisProgress, setAnalysisProgress] = useState<{ step: string; progress: number; detail?: string } | null>(null);
   const [themeColors, setThemeColors] = useState({
     primary: 'rgb(16, 185, 129)',
     primaryLight: 'rgba(16, 185, 129, 0.9)',
@@ -524,13 +526,39 @@ export default function MusicStudyModal({ isOpen, onClose }: MusicStudyModalProp
     // 2) Sem cache → buscar da API com AbortController
     const abortController = new AbortController();
     let timeoutId: ReturnType<typeof setTimeout> | null = null;
+    let progressSource: EventSource | null = null;
 
     const fetchAnalysis = async () => {
       try {
         setIsAnalyzing(true);
         setAnalysisError(null);
+        setAnalysisProgress(null);
         hasAnalysisRef.current = false;
 
+        // Progresso por estágio: o servidor repassa os eventos do analisador para este id
+        const progressId = `analysis-${Date.now()}-${Math.random().toString(36).slice(2, 8)}`;
+        try {
+          const source = new EventSource(`/api/download-progress?downloadId=${encodeURIComponent(progressId)}&_t=${Date.now()}`);
+          progressSource = source;
+          source.onmessage = (message) => {
+            try {
+              const data = JSON.parse(message.data);
+              if (data.type === 'analysis' && !abortController.signal.aborted) {
+                setAnalysisProgress({ step: data.step, progress: data.progress ?? 0, detail: data.detail });
+              }
+            } catch {
+              // heartbeat/evento malformado: ignora
+            }
+          };
+          // Espera o stream registrar (até 1s) para não perder o primeiro estágio
+          await new Promise<void>((resolve) => {
+            source.onopen = () => resolve();
+            setTimeout(resolve, 1000);
+          });
+        } catch (error) {
+          console.warn('[MusicStudyModal] Progresso indisponível:', error);
+        }
+
         timeoutId = setTimeout(() => {
           if (!hasAnalysisRef.current && !abortController.signal.aborted) {
             console.warn('[MusicStudyModal] Timeout da análise');
@@ -542,7 +570,7 @@ export default function MusicStudyModal({ isOpen, onClose }: MusicStudyModalProp
         const response = await fetch('/api/analyze-music', {
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ filename: currentFile.name }),
+          body: JSON.stringify({ filename: currentFile.name, progressId }),
           signal: abortController.signal
         });
 
@@ -599,6 +627,7 @@ export default function MusicStudyModal({ isOpen, onClose }: MusicStudyModalProp
         console.error('[MusicStudyModal] Erro:', error);
         setAnalysisError(error instanceof Error ? error.message : 'Erro desconhecido na análise');
       } finally {
+        progressSource?.close();
         if (!abortController.signal.aborted) {
           setIsAnalyzing(false);
         }
@@ -610,6 +639,7 @@ export default function MusicStudyModal({ isOpen, onClose }: MusicStudyModalProp
     // Cleanup: abortar requisição anterior quando o efeito re-executar
     return () => {
       abortController.abort();
+      progressSource?.close();
       if (timeoutId) clearTimeout(timeoutId);
     };
   }, [isOpen, currentFile?.name]);
@@ -760,8 +790,12 @@ export default function MusicStudyModal({ isOpen, onClose }: MusicStudyModalProp
             {isAnalyzing ? (
               <div className="flex flex-col items-center justify-center py-16">
                 <LoadingSpinner size="lg" themeColors={themeColors} isLoading={true} />
-                <p className="text-gray-400 mt-4 text-sm">Analisando música com librosa...</p>
-                <p className="text-gray-500 mt-1 text-xs">Isso pode levar até 5 minutos para arquivos grandes</p>
+                <p className="text-gray-400 mt-4 text-sm">
+                  {analysisProgress ? `${analysisProgress.step}... ${analysisProgress.progress}%` : 'Analisando música com librosa...'}
+                </p>
+                <p className="text-gray-500 mt-1 text-xs">
+                  {analysisProgress?.detail ?? 'Isso pode levar até 5 minutos para arquivos grandes'}
+                </p>
               </div>
             ) : analysis ? (
               <>
@@ -13,6 +13,7 @@ import {
   buildMidiPackZip,
   pickBestTracksForMidiPack,
   type MidiPackExportProgress,
+  type MidiPackPitchEngine,
   type MidiPackTrackInput,
 } from '../utils/midiPackExport';
 import { downloadZipArchive } from '../utils/midiGenerator';
@@ -37,7 +38,11 @@ export interface MidiPackJob {
 
 interface MidiPackExportContextType {
   activeJob: MidiPackJob | null;
-  startPackExport: (tracks: MidiPackTrackInput[], scopeLabel: string) => string | null;
+  startPackExport: (
+    tracks: MidiPackTrackInput[],
+    scopeLabel: string,
+    options?: { pitchEngine?: MidiPackPitchEngine }
+  ) => string | null;
   cancelPackExport: () => void;
   dismissJob: () => void;
 }
@@ -74,7 +79,11 @@ export function MidiPackExportProvider({ children }: { children: ReactNode }) {
   }, [activeJob?.status, cancelPackExport]);
 
   const startPackExport = useCallback(
-    (tracks: MidiPackTrackInput[], scopeLabel: string): string | null => {
+    (
+      tracks: MidiPackTrackInput[],
+      scopeLabel: string,
+      options: { pitchEngine?: MidiPackPitchEngine } = {}
+    ): string | null => {
       const bestTracks = pickBestTracksForMidiPack(tracks);
       if (bestTracks.length === 0) return null;
 
@@ -112,6 +121,7 @@ export function MidiPackExportProvider({ children }: { children: ReactNode }) {
         try {
           const result = await buildMidiPackZip(bestTracks, {
             dedupeBestFormat: false,
+            pitchEngine: options.pitchEngine,
             onProgress: (p) => {
               setActiveJob((prev) =>
                 prev?.id === id ? { ...prev, progress: p } : prev
@@ -12,6 +12,8 @@ export interface MidiExtractedEvent {
 export interface StemFidelity {
   confidence: number; // 0–1
   method: 'detected' | 'estimated';
+  /** Motor de pitch que gerou as notas (bassline/lead); ausente nos demais stems */
+  engine?: 'pyin' | 'salience';
 }
 
 export interface MidiExtractionData {
@@ -71,8 +73,13 @@ export interface MusicAnalysisForMidi {
 
 export const ANALYSIS_CACHE_KEY_PREFIX = 'legolas-analysis-v5';
 
-export function analysisCacheKey(filename: string): string {
-  return `${ANALYSIS_CACHE_KEY_PREFIX}:${filename}`;
+/**
+ * Chave do cache local da análise. Motores de pitch fora do padrão (pyin) têm
+ * slot próprio: o resultado deles não pode ocupar o que os modais leem.
+ */
+export function analysisCacheKey(filename: string, pitchEngine?: 'pyin' | 'salience'): string {
+  const base = `${ANALYSIS_CACHE_KEY_PREFIX}:${filename}`;
+  return pitchEngine && pitchEngine !== 'pyin' ? `${base}|${pitchEngine}` : base;
 }
 
 /** Metadados de exibição por chave de stem extraído do Python */
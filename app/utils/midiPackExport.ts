@@ -115,9 +115,10 @@ function buildTrackFolderName(file: MidiPackTrackInput, usedNames: Set<string>):
 
 async function fetchAnalysisForTrack(
   filename: string,
-  signal?: AbortSignal
+  signal?: AbortSignal,
+  pitchEngine?: MidiPackPitchEngine
 ): Promise<MusicAnalysisForMidi> {
-  const cacheKey = analysisCacheKey(filename);
+  const cacheKey = analysisCacheKey(filename, pitchEngine);
   const cached = safeGetItem<MusicAnalysisForMidi>(cacheKey);
   if (cached && hasValidMidiExtraction(cached)) return cached;
 
@@ -134,7 +135,7 @@ async function fetchAnalysisForTrack(
     const response = await fetch('/api/analyze-music', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ filename, preferBestQuality: true }),
+      body: JSON.stringify({ filename, preferBestQuality: true, pitchEngine }),
       signal: controller.signal,
     });
 
@@ -236,6 +237,9 @@ function buildPackReadme(
     .join('\n');
 }
 
+/** Motor de pitch da bassline/lead (`PITCH_ENGINES` do Python). */
+export type MidiPackPitchEngine = 'pyin' | 'salience';
+
 /**
  * Gera ZIP com uma pasta por música e subpastas por categoria (Drums, Bass, Synths...).
  */
@@ -247,6 +251,8 @@ export async function buildMidiPackZip(
     signal?: AbortSignal;
     /** Uma faixa por música, sempre FLAC quando existir */
     dedupeBestFormat?: boolean;
+    /** Motor de pitch da bassline/lead: 'salience' é bem mais rápido que o pyin (padrão) */
+    pitchEngine?: MidiPackPitchEngine;
   } = {}
 ): Promise<MidiPackExportResult> {
   const { onProgress, signal } = options;
@@ -299,7 +305,7 @@ export async function buildMidiPackZip(
     report('analyzing', i + 1, label);
 
     try {
-      const analysis = await fetchAnalysisForTrack(file.name, signal);
+      const analysis = await fetchAnalysisForTrack(file.name, signal, options.pitchEngine);
       report('generating', i + 1, label);
 
       const trackFolder = buildTrackFolderName(file, usedFolderNames);
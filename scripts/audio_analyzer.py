@@ -19,6 +19,10 @@ import sys
 import json
 import warnings
 import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from fractions import Fraction
 
 # Suprimir warnings para output limpo
 warnings.filterwarnings('ignore')
@@ -48,7 +52,15 @@ check_dependencies()
 
 import numpy as np
 import librosa
+import scipy.signal
 
+# Rótulo do analisador gravado em cada resultado (e nos manifests do modo batch)
+ANALYSIS_METHOD = "python_librosa_v3"
+
+# Versão do pipeline: entra na chave do cache e no manifest do batch. Suba a
+# cada mudança que altera resultados — o que foi gravado por versões
+# anteriores deixa de valer
+PIPELINE_VERSION = 5
 
 # ──────────────────────────────────────────────────────────────────
 # UTILIDADES
@@ -83,24 +95,444 @@ def format_time(seconds):
     return f"{m}:{s:02d}"
 
 
+# ──────────────────────────────────────────────────────────────────
+# CONTEXTO DE ANÁLISE (cache espectral por faixa)
+# ──────────────────────────────────────────────────────────────────
+
+# HPSS em blocos: frames de STFT por bloco (~24 s a 22050 Hz) e kernel da mediana
+HPSS_BLOCK_FRAMES = 1024
+HPSS_KERNEL_SIZE = 31
+
+
+def hpss_workers(stage_workers=1):
+    """Threads do HPSS em blocos: $LEGOLAS_HPSS_WORKERS ou núcleos / workers de estágio.
+
+    Com estágios em paralelo (--workers), o HPSS divide os núcleos com eles —
+    a mesma conta do BLAS em _run_stages_parallel — em vez de abrir uma thread
+    por núcleo em cima das threads de estágio.
+    """
+    env = int(os.environ.get("LEGOLAS_HPSS_WORKERS", "0") or 0)
+    return env or max(1, (os.cpu_count() or 1) // max(1, int(stage_workers or 1)))
+
+
+def hpss_blocked(y, n_fft=2048, hop_length=512, kernel_size=HPSS_KERNEL_SIZE,
+                 block_frames=HPSS_BLOCK_FRAMES, workers=None):
+    """HPSS (o mesmo de librosa.effects.hpss) processado em blocos de tempo sobrepostos.
+
+    O hpss monolítico monta a STFT complexa da faixa inteira, dois filtros de
+    mediana do mesmo tamanho e duas ISTFTs — a maior alocação da análise, num
+    núcleo só. Aqui cada bloco de `block_frames` frames leva de contexto, de
+    cada lado, o alcance da mediana no tempo (kernel_size // 2; a mediana do
+    percussivo é só na frequência) mais a sobreposição da janela na ISTFT
+    (n_fft / hop frames). Os frames do bloco são os mesmos da STFT inteira
+    (sinal com o mesmo padding do center=True), então as amostras do miolo saem
+    iguais às do hpss monolítico. Só o miolo de cada bloco é gravado.
+
+    `workers`: threads para os blocos (None = hpss_workers(), sem estágios em paralelo).
+    Memória de pico: a de `workers` blocos, não a da faixa.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    y = np.asarray(y)
+    pad = n_fft // 2
+    y_pad = np.pad(y, pad, mode='constant')
+    n_frames = 1 + len(y) // hop_length
+    context = kernel_size // 2 + -(-n_fft // hop_length)
+    block_frames = max(int(block_frames), -(-n_fft // hop_length))
+    y_harm = np.zeros_like(y)
+    y_perc = np.zeros_like(y)
+
+    def _block(f0):
+        f1 = min(n_frames, f0 + block_frames)
+        e0, e1 = max(0, f0 - context), min(n_frames, f1 + context)
+        offset = e0 * hop_length  # início do trecho, em amostras do sinal com padding
+        D = librosa.stft(y_pad[offset:(e1 - 1) * hop_length + n_fft], n_fft=n_fft,
+                         hop_length=hop_length, center=False)
+        D_harm, D_perc = librosa.decompose.hpss(D, kernel_size=kernel_size)
+        del D
+        # Miolo do bloco em amostras de y; primeiro e último blocos vão até as pontas
+        a = 0 if f0 == 0 else f0 * hop_length - pad
+        b = len(y) if f1 == n_frames else f1 * hop_length - pad
+        for D_part, out in ((D_harm, y_harm), (D_perc, y_perc)):
+            y_part = librosa.istft(D_part, n_fft=n_fft, hop_length=hop_length, center=False, dtype=y.dtype)
+            out[a:b] = y_part[a + pad - offset:b + pad - offset]
+
+    starts = list(range(0, n_frames, block_frames))
+    if workers is None:
+        workers = hpss_workers()
+    workers = max(1, min(int(workers), len(starts)))
+    if workers == 1:
+        for f0 in starts:
+            _block(f0)
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hpss") as pool:
+            list(pool.map(_block, starts))
+    return y_harm, y_perc
+
+
+class AnalysisContext:
+    """
+    Sinais e features espectrais de uma faixa, calculados sob demanda e memoizados.
+
+    Cada eixo de análise recalculava a própria STFT de y, y_harm e y_perc (e
+    spectral_centroid/flatness/contrast/bandwidth/mfcc faziam mais uma cada).
+    O contexto calcula cada espectrograma uma única vez, na primeira análise que
+    pedir, e entrega o mesmo array às demais. Os parâmetros (n_fft=2048, hop=512)
+    são os defaults do librosa — os mesmos que as análises já usavam.
+
+    Os arrays devolvidos são compartilhados: as análises só podem lê-los.
+    `hpss_runs` conta quantas vezes o HPSS foi de fato executado (deve ser ≤ 1);
+    ele roda em blocos de tempo paralelos (hpss_blocked), sem a STFT inteira, com
+    os núcleos divididos por `stage_workers` (threads de estágio, ver hpss_workers).
+    Seguro entre threads (estágios concorrentes): cada chave tem a sua trava, então
+    features diferentes são calculadas em paralelo e a mesma, uma única vez.
+
+    Pirâmide de resolução: níveis fixos derivados do topo PYRAMID_TOP_SR
+    (22050 → 11025/5512/2756 Hz), os mesmos qualquer que seja o sr de análise;
+    cada sinal existe decimado (polifásico) nos níveis abaixo do sr de análise, e
+    estágios de banda baixa (pitch do baixo) rodam no menor nível que cobre a
+    banda (ver band_source). `y_top`/`sr_top`: o mix mono no topo (faixas longas,
+    analisadas abaixo dele), usado pelas bandas acima do Nyquist e liberado por
+    release_top assim que os onsets delas saem. Os onsets por banda da bateria
+    saem de um espectrograma só (band_onset_envelopes) e as bandas do pyin, de
+    uma STFT por nível (band_signals).
+    """
+
+    N_FFT = 2048
+    HOP_LENGTH = 512
+    # CQT do cromagrama = defaults do chroma_cqt (C1, 7 oitavas, 36 bins/oitava)
+    CQT_BINS_PER_OCTAVE = 36
+    CQT_N_OCTAVES = 7
+    # Fatores de decimação da pirâmide e o menor sr aceito num nível
+    PYRAMID_FACTORS = (1, 2, 4, 8)
+    PYRAMID_MIN_SR = 2000.0
+
+    def __init__(self, y, sr, y_harm=None, y_perc=None, y_top=None, sr_top=None, stage_workers=1):
+        self.y = y
+        self.sr = sr
+        self.stage_workers = stage_workers
+        self.y_top = y_top
+        self.sr_top = sr_top if y_top is not None else None
+        self._y_harm = y_harm
+        self._y_perc = y_perc
+        self._cache = {}
+        self.hpss_runs = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._hpss_lock = threading.Lock()
+
+    def _memo(self, key, compute):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+        return self._cache[key]
+
+    def _ensure_hpss(self):
+        if self._y_harm is None or self._y_perc is None:
+            with self._hpss_lock:
+                if self._y_harm is None or self._y_perc is None:
+                    self._y_harm, self._y_perc = hpss_blocked(
+                        self.y, workers=hpss_workers(self.stage_workers))
+                    self.hpss_runs += 1
+
+    @property
+    def y_harm(self):
+        self._ensure_hpss()
+        return self._y_harm
+
+    @property
+    def y_perc(self):
+        self._ensure_hpss()
+        return self._y_perc
+
+    def signal(self, source='full'):
+        """Sinal por nome: 'full' (mix), 'harm' ou 'perc'."""
+        if source == 'harm':
+            return self.y_harm
+        if source == 'perc':
+            return self.y_perc
+        return self.y
+
+    def decimated(self, source, sr_level):
+        """Sinal ('full', 'harm' ou 'perc') reamostrado (polifásico) para `sr_level` Hz."""
+        if sr_level >= self.sr:
+            return self.signal(source)
+        ratio = Fraction(sr_level) / Fraction(self.sr)
+        return self._memo(('decimated', source, sr_level), lambda: scipy.signal.resample_poly(
+            self.signal(source), ratio.numerator, ratio.denominator
+        ))
+
+    def band_source(self, source, fmax):
+        """Nível da pirâmide para analisar a banda até `fmax` Hz.
+
+        Escolhe o menor nível fixo (PYRAMID_TOP_SR / 1, 2, 4, 8) abaixo do sr de
+        análise que ainda tem 2× de folga sobre a banda (sr ≥ 4·fmax) e não cai
+        abaixo de PYRAMID_MIN_SR — o baixo roda em 2756 Hz tanto a 22050 quanto a
+        11025 ou 16000. Bandas acima do Nyquist de análise usam `y_top` quando
+        existe (mix, não o HPSS — que só existe no sr de análise). Retorna
+        (y, sr, spec): `spec` traz hop_length e n_fft fixos por nível (a mesma
+        resolução em tempo e em Hz em qualquer sr de análise; no topo, escalados
+        para a taxa de frames de análise) e n_mels na grade mel do sr de análise.
+        """
+        if fmax > self.sr * 0.48 and self.y_top is not None:
+            y_level, sr_level = self.y_top, self.sr_top
+            ratio = sr_level / float(self.sr)
+            hop = int(round(self.HOP_LENGTH * ratio))
+            n_fft = int(2 ** round(np.log2(self.N_FFT * ratio)))
+        else:
+            sr_level, n_fft, hop = self.sr, self.N_FFT, self.HOP_LENGTH
+            for q in self.PYRAMID_FACTORS:
+                level = PYRAMID_TOP_SR / q
+                if level < sr_level and level >= max(4.0 * fmax, self.PYRAMID_MIN_SR):
+                    sr_level, n_fft, hop = level, self.N_FFT // q, self.HOP_LENGTH // q
+            y_level = self.decimated(source, sr_level)
+        n_mels = int(round(128 * librosa.hz_to_mel(sr_level / 2) / librosa.hz_to_mel(self.sr / 2)))
+        return y_level, sr_level, {"hop_length": hop, "n_fft": n_fft, "n_mels": max(8, n_mels)}
+
+    def release_top(self):
+        """Libera `y_top` (o mix no topo da pirâmide) depois dos onsets das bandas altas.
+
+        Os envelopes já calculados continuam memoizados; uma banda alta pedida
+        depois disso sai do espectrograma de análise (cortada no Nyquist dele).
+        """
+        self.y_top = None
+
+    def onset_envelope(self, source='perc'):
+        """Envelope de onset de banda larga (mel, defaults do onset_strength) do sinal.
+
+        Groove (complexidade/regularidade) e bateria (viradas) liam o mesmo
+        envelope do percussivo, cada um recalculando a mel-STFT.
+        """
+        return self._memo(('onset_env', source), lambda: librosa.onset.onset_strength(
+            y=self.signal(source), sr=self.sr, hop_length=self.HOP_LENGTH
+        ))
+
+    def _top_magnitude(self):
+        """|STFT| de `y_top`, com n_fft/hop escalados para a taxa de frames de análise.
+
+        Não memoizado: só os envelopes por banda (já memoizados) o usam.
+        """
+        ratio = self.sr_top / float(self.sr)
+        hop = int(round(self.HOP_LENGTH * ratio))
+        n_fft = int(2 ** round(np.log2(self.N_FFT * ratio)))
+        S = np.abs(librosa.stft(self.y_top, n_fft=n_fft, hop_length=hop))
+        return S, librosa.fft_frequencies(sr=self.sr_top, n_fft=n_fft), n_fft, hop
+
+    def band_onset_envelopes(self, bands, source='perc'):
+        """Envelopes de onset de várias bandas a partir de um único espectrograma.
+
+        `bands`: {nome: (fmin, fmax)} em Hz. Em vez de filtrar e ressintetizar cada
+        banda para tirar o onset_strength dela, o fluxo espectral (log-|STFT|,
+        lag 1) é calculado uma vez sobre |STFT| de `source` e agregado (média) nos
+        bins de cada banda — onset_strength_multi com um canal por faixa entre as
+        bordas de todas as bandas. Bandas acima do Nyquist de análise saem do
+        espectrograma de `y_top` quando ele existe (mesma taxa de frames).
+
+        Retorna {nome: (env, sr, hop_length)}; banda sem energia → env só de zeros.
+        Memoizado por banda: só as faixas ainda não calculadas entram na passada.
+        """
+        keys = {name: ('band_onset', source, float(fmin), float(fmax)) for name, (fmin, fmax) in bands.items()}
+        missing = {name: bands[name] for name, key in keys.items() if key not in self._cache}
+        if missing:
+            computed = self._compute_band_onsets(missing, source)
+            for name, value in computed.items():
+                self._memo(keys[name], lambda value=value: value)
+        return {name: self._cache[key] for name, key in keys.items()}
+
+    def _compute_band_onsets(self, bands, source):
+        groups = {}
+        for name, (fmin, fmax) in bands.items():
+            top = fmax > self.sr * 0.48 and self.y_top is not None
+            groups.setdefault(top, {})[name] = (float(fmin), float(fmax))
+        out = {}
+        for top, group in groups.items():
+            if top:
+                S, freqs, n_fft, hop = self._top_magnitude()
+                sr_level = self.sr_top
+            else:
+                S, freqs = self.magnitude(source), self.freqs
+                n_fft, hop, sr_level = self.N_FFT, self.HOP_LENGTH, self.sr
+            spans = {
+                name: (int(np.searchsorted(freqs, fmin, 'left')), int(np.searchsorted(freqs, fmax, 'right')))
+                for name, (fmin, fmax) in group.items()
+            }
+            edges = sorted({0, len(freqs)} | {b for span in spans.values() for b in span})
+            with _profile("band_onsets"):
+                flux = librosa.onset.onset_strength_multi(
+                    S=librosa.amplitude_to_db(S), sr=sr_level, n_fft=n_fft, hop_length=hop,
+                    channels=edges, aggregate=np.mean
+                )
+            widths = np.diff(edges).astype(np.float64)
+            for name, (lo, hi) in spans.items():
+                i0, i1 = edges.index(lo), edges.index(hi)
+                if i1 <= i0:
+                    env = np.zeros(flux.shape[1], dtype=flux.dtype)
+                else:
+                    w = widths[i0:i1]
+                    env = (np.tensordot(w, flux[i0:i1], axes=1) / w.sum()).astype(flux.dtype)
+                out[name] = (env, sr_level, hop)
+        return out
+
+    def band_signals(self, bands, source='harm'):
+        """Bandas de `source` ressintetizadas, uma STFT por nível da pirâmide.
+
+        `bands`: {nome: (fmin, fmax)} em Hz. Cada banda vai para o nível que a
+        cobre (band_source); as bandas do mesmo nível saem da mesma STFT direta,
+        mascarada por banda e ressintetizada (ISTFT), normalizada pelo pico — o
+        pyin precisa do sinal, não do espectrograma. A STFT complexa vive só
+        durante a chamada; memoizado por banda (só o sinal).
+
+        Retorna {nome: (y_band, sr, spec)}, `spec` como em band_source.
+        """
+        keys = {name: ('band_signal', source, float(fmin), float(fmax)) for name, (fmin, fmax) in bands.items()}
+        levels = {}
+        for name, (fmin, fmax) in bands.items():
+            if keys[name] in self._cache:
+                continue
+            y_src, sr_level, spec = self.band_source(source, fmax)
+            levels.setdefault((sr_level, spec["n_fft"]), (y_src, sr_level, spec, {}))[3][name] = (fmin, fmax)
+        for y_src, sr_level, spec, group in levels.values():
+            n_fft = spec["n_fft"]
+            with _profile("bandpass"):
+                D = librosa.stft(y_src, n_fft=n_fft)
+                freqs = librosa.fft_frequencies(sr=sr_level, n_fft=n_fft)
+                for name, (fmin, fmax) in group.items():
+                    mask = (freqs >= fmin) & (freqs <= fmax)
+                    D_filt = np.zeros_like(D)
+                    D_filt[mask] = D[mask]
+                    y_out = librosa.istft(D_filt, n_fft=n_fft)
+                    y_out = y_out / float(np.max(np.abs(y_out)) + 1e-10)
+                    self._memo(keys[name], lambda value=(y_out, sr_level, spec): value)
+                del D
+        return {name: self._cache[key] for name, key in keys.items()}
+
+    @property
+    def freqs(self):
+        return self._memo('freqs', lambda: librosa.fft_frequencies(sr=self.sr, n_fft=self.N_FFT))
+
+    def chroma_stft(self):
+        """Cromagrama STFT do mix (|STFT|², sem HPSS nem CQT) — barato, para verificações."""
+        return self._memo('chroma_stft', lambda: librosa.feature.chroma_stft(
+            S=self.magnitude('full') ** 2, sr=self.sr
+        ))
+
+    @property
+    def beats(self):
+        """Rastreador de beats compartilhado da faixa (ver BeatTracker)."""
+        return self._memo('beats', lambda: BeatTracker(self))
+
+    def magnitude(self, source='full'):
+        """|STFT| do sinal ('full', 'harm' ou 'perc')."""
+        return self._memo(('mag', source), lambda: np.abs(librosa.stft(
+            self.signal(source), n_fft=self.N_FFT, hop_length=self.HOP_LENGTH
+        )))
+
+    def rms(self):
+        """Curva RMS do mix (frame=2048, hop=512)."""
+        return self._memo('rms', lambda: librosa.feature.rms(
+            y=self.y, frame_length=self.N_FFT, hop_length=self.HOP_LENGTH
+        )[0])
+
+    def spectral_centroid(self, source='full'):
+        return self._memo(('centroid', source), lambda: librosa.feature.spectral_centroid(
+            S=self.magnitude(source), sr=self.sr
+        ))
+
+    def spectral_rolloff(self, source='full'):
+        return self._memo(('rolloff', source), lambda: librosa.feature.spectral_rolloff(
+            S=self.magnitude(source), sr=self.sr
+        ))
+
+    def spectral_flatness(self, source='full'):
+        return self._memo(('flatness', source), lambda: librosa.feature.spectral_flatness(
+            S=self.magnitude(source)
+        ))
+
+    def spectral_contrast(self, source='full'):
+        return self._memo(('contrast', source), lambda: librosa.feature.spectral_contrast(
+            S=self.magnitude(source), sr=self.sr
+        ))
+
+    def spectral_bandwidth(self, source='full'):
+        return self._memo(('bandwidth', source), lambda: librosa.feature.spectral_bandwidth(
+            S=self.magnitude(source), sr=self.sr
+        ))
+
+    @property
+    def cqt_fmin(self):
+        return librosa.note_to_hz('C1')
+
+    @property
+    def cqt_freqs(self):
+        return self._memo('cqt_freqs', lambda: librosa.cqt_frequencies(
+            self.CQT_BINS_PER_OCTAVE * self.CQT_N_OCTAVES,
+            fmin=self.cqt_fmin, bins_per_octave=self.CQT_BINS_PER_OCTAVE
+        ))
+
+    def cqt(self):
+        """|CQT| do componente harmônico — base única de todo cromagrama da faixa."""
+        return self._memo('cqt', lambda: np.abs(librosa.cqt(
+            self.y_harm, sr=self.sr, hop_length=self.HOP_LENGTH, fmin=self.cqt_fmin,
+            n_bins=self.CQT_BINS_PER_OCTAVE * self.CQT_N_OCTAVES,
+            bins_per_octave=self.CQT_BINS_PER_OCTAVE
+        )))
+
+    def chroma(self, fmin=None, fmax=None):
+        """Cromagrama do harmônico, opcionalmente restrito à faixa [fmin, fmax] Hz.
+
+        A banda sai do recorte das linhas do CQT compartilhado, sem ressintetizar
+        o áudio (antes: bandpass por STFT/ISTFT + um chroma_cqt completo por banda).
+        Normalização por frame (norma infinita), como no chroma_cqt.
+        """
+        def _compute():
+            C = self.cqt()
+            to_chroma = librosa.filters.cq_to_chroma(
+                C.shape[0], bins_per_octave=self.CQT_BINS_PER_OCTAVE, n_chroma=12,
+                fmin=self.cqt_fmin
+            )
+            if fmin is not None or fmax is not None:
+                f = self.cqt_freqs
+                band = (f >= (fmin or 0.0)) & (f <= (fmax or np.inf))
+                C = C[band]
+                to_chroma = to_chroma[:, band]
+            return librosa.util.normalize(to_chroma.dot(C), norm=np.inf, axis=0)
+        return self._memo(('chroma', fmin, fmax), _compute)
+
+    def mfcc(self, n_mfcc=13):
+        """MFCCs do mix a partir do mesmo |STFT| (mel de potência → dB)."""
+        def _compute():
+            mel = librosa.feature.melspectrogram(S=self.magnitude('full') ** 2, sr=self.sr)
+            return librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=n_mfcc)
+        return self._memo(('mfcc', n_mfcc), _compute)
+
+
 # ──────────────────────────────────────────────────────────────────
 # 1. IDENTIDADE MUSICAL
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_musical_identity(y, sr, bpm, key, freq_bands, rms_curve, y_harm=None, y_perc=None):
+def analyze_musical_identity(y, sr, bpm, key, freq_bands, rms_curve, y_harm=None, y_perc=None,
+                             ctx=None):
     """
     Identifica gênero, subgêneros, energia, mood e contexto de uso.
     """
     try:
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_harm=y_harm, y_perc=y_perc)
+
         # Spectral features para classificação
-        spectral_centroid = np.mean(librosa.feature.spectral_centroid(y=y, sr=sr))
-        spectral_rolloff = np.mean(librosa.feature.spectral_rolloff(y=y, sr=sr))
-        spectral_flatness = np.mean(librosa.feature.spectral_flatness(y=y))
+        spectral_centroid = np.mean(ctx.spectral_centroid())
+        spectral_rolloff = np.mean(ctx.spectral_rolloff())
+        spectral_flatness = np.mean(ctx.spectral_flatness())
         zero_crossing = np.mean(librosa.feature.zero_crossing_rate(y=y))
 
-        # Usar HPSS pré-computado se disponível
-        if y_harm is None or y_perc is None:
-            y_harm, y_perc = librosa.effects.hpss(y)
+        # Usar HPSS pré-computado (o contexto só calcula se ainda não houver)
+        y_harm, y_perc = ctx.y_harm, ctx.y_perc
         perc_ratio = np.mean(y_perc ** 2) / (np.mean(y ** 2) + 1e-10)
         harm_ratio = np.mean(y_harm ** 2) / (np.mean(y ** 2) + 1e-10)
 
@@ -286,15 +718,135 @@ def classify_context(bpm, energy, mood, genre):
 # 2. BPM, GROOVE E RITMO
 # ──────────────────────────────────────────────────────────────────
 
-def detect_bpm(y, sr):
-    """Detecta o BPM da música."""
+def _tempo_candidates(tg_mean, sr, hop_length, start_bpm=120.0, std_bpm=1.0, max_tempo=320.0, n=None):
+    """Candidatos de tempo de um tempograma médio, do mais provável ao menos.
+
+    Mesma pontuação de librosa.feature.tempo (autocorrelação com prior
+    log-normal em torno de `start_bpm`, nada acima de `max_tempo`): o primeiro
+    candidato é exatamente o tempo que o librosa estimaria. Os demais são os
+    outros picos locais da pontuação. Retorna [(bpm, score), ...].
+    """
+    tg_mean = np.asarray(tg_mean, dtype=float).reshape(-1)
+    bpms = librosa.tempo_frequencies(len(tg_mean), hop_length=hop_length, sr=sr)
+    with np.errstate(divide='ignore'):
+        logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+    if max_tempo is not None:
+        logprior[:int(np.argmax(bpms < max_tempo))] = -np.inf
+    score = np.log1p(1e6 * tg_mean) + logprior
+    best = int(np.argmax(score))
+    inner = np.arange(1, len(score) - 1)
+    peaks = inner[(score[inner] > score[inner - 1]) & (score[inner] >= score[inner + 1])
+                  & np.isfinite(score[inner])]
+    order = [best] + [int(i) for i in peaks[np.argsort(-score[peaks], kind='stable')] if i != best]
+    if n is not None:
+        order = order[:n]
+    return [(float(bpms[i]), float(score[i])) for i in order]
+
+
+class BeatTracker:
+    """Tempo e grades de beats de uma faixa, calculados uma vez e compartilhados.
+
+    detect_bpm (mix), o groove (percussivo), a grade da extração MIDI e o
+    fallback de kick chamavam librosa.beat.beat_track cada um — e cada chamada
+    recalculava o envelope de onset e o tempograma. Aqui o envelope (median, o
+    mesmo do beat_track) e o tempograma médio de cada sinal saem uma vez; o
+    beat_track recebe o envelope pronto e o tempo já estimado, então tempos e
+    beats são os mesmos de antes. Tudo fica memoizado no AnalysisContext
+    (`ctx.beats`), inclusive as grades ancorada e com fase alinhada ao kick.
+    """
+
+    START_BPM = 120.0
+    AC_SIZE = 8.0  # janela do tempograma (s), default do librosa.feature.tempo
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.sr = ctx.sr
+        self.hop_length = ctx.HOP_LENGTH
+
+    def onset_envelope(self, source='perc'):
+        """Envelope de onset do beat tracker (aggregate=median) do sinal."""
+        return self.ctx._memo(('beat_onset_env', source), lambda: librosa.onset.onset_strength(
+            y=self.ctx.signal(source), sr=self.sr, hop_length=self.hop_length, aggregate=np.median
+        ))
+
+    def tempogram(self, source='perc'):
+        """Tempograma de autocorrelação (janela AC_SIZE s), médio no tempo."""
+        def compute():
+            win_length = int(librosa.time_to_frames(self.AC_SIZE, sr=self.sr, hop_length=self.hop_length))
+            tg = librosa.feature.tempogram(
+                onset_envelope=self.onset_envelope(source), sr=self.sr,
+                hop_length=self.hop_length, win_length=win_length
+            )
+            return tg.mean(axis=1)
+        return self.ctx._memo(('tempogram', source), compute)
+
+    def tempo_candidates(self, source='perc', n=5):
+        """[(bpm, score), ...] do tempograma de `source`; o primeiro é o tempo estimado."""
+        cands = self.ctx._memo(('tempo_candidates', source), lambda: _tempo_candidates(
+            self.tempogram(source), self.sr, self.hop_length, start_bpm=self.START_BPM
+        ))
+        return cands[:n]
+
+    def tempo(self, source='perc'):
+        """Tempo estimado (BPM) — o mesmo do beat_track sem `bpm`; 0.0 sem onsets."""
+        if not self.onset_envelope(source).any():
+            return 0.0
+        return self.tempo_candidates(source, n=1)[0][0]
+
+    def track(self, source='perc', bpm=None, trim=True):
+        """(tempo, beat_times) do beat_track sobre o envelope de `source`.
+
+        `bpm`: tempo conhecido (None = tempo estimado do próprio sinal).
+        """
+        def compute():
+            env = self.onset_envelope(source)
+            tempo = float(bpm) if bpm else self.tempo(source)
+            if not env.any():
+                return tempo, np.array([], dtype=float)
+            _t, frames = librosa.beat.beat_track(
+                onset_envelope=env, sr=self.sr, hop_length=self.hop_length, bpm=tempo, trim=trim
+            )
+            return tempo, librosa.frames_to_time(frames, sr=self.sr, hop_length=self.hop_length)
+        key = ('beat_track', source, float(bpm) if bpm else None, bool(trim))
+        return self.ctx._memo(key, compute)
+
+    def grid(self, bpm, max_beats):
+        """Grade de beats ancorada ao BPM conhecido — corrige o drift que a
+        quantização por BPM constante acumula ao longo da faixa."""
+        def compute():
+            try:
+                _t, beat_times = self.track('perc', bpm=bpm, trim=False)
+                if len(beat_times) >= 4:
+                    return np.asarray(beat_times, dtype=float)
+            except Exception:
+                pass
+            # Grade sintética a partir do BPM (offset 0)
+            beat_dur = 60.0 / float(bpm) if bpm and bpm > 0 else 0.5
+            return np.arange(int(max_beats) + 2, dtype=float) * beat_dur
+        return self.ctx._memo(('beat_grid', float(bpm or 0), float(max_beats)), compute)
+
+    def aligned_grid(self, bpm, max_beats):
+        """Grade ancorada com a fase alinhada ao kick (20–120 Hz do percussivo),
+        para o groove cair no downbeat correto."""
+        def compute():
+            beat_times = self.grid(bpm, max_beats)
+            try:
+                env, sr_k, hop_k = self.ctx.band_onset_envelopes({"kick_phase": (20.0, 120.0)})["kick_phase"]
+                frames = librosa.onset.onset_detect(
+                    onset_envelope=env, sr=sr_k, hop_length=hop_k, backtrack=True, delta=0.10, wait=4
+                )
+                return _align_grid_phase(beat_times, librosa.frames_to_time(frames, sr=sr_k, hop_length=hop_k))
+            except Exception:
+                return beat_times
+        return self.ctx._memo(('aligned_grid', float(bpm or 0), float(max_beats)), compute)
+
+
+def detect_bpm(y, sr, ctx=None):
+    """Detecta o BPM da música (tempo estimado do mix, via ctx.beats)."""
     try:
-        tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-        if hasattr(tempo, '__len__'):
-            tempo = float(tempo[0])
-        else:
-            tempo = float(tempo)
-        return round(tempo, 1)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        return round(float(ctx.beats.tempo('full')), 1)
     except Exception:
         return None
 
@@ -317,6 +869,137 @@ def _bpm_from_filename(file_path):
     return None
 
 
+# Camelot (DJ) → tonalidade: A = menor, B = maior
+_CAMELOT_KEYS = {
+    (1, "A"): "G#m", (2, "A"): "D#m", (3, "A"): "A#m", (4, "A"): "Fm", (5, "A"): "Cm", (6, "A"): "Gm",
+    (7, "A"): "Dm", (8, "A"): "Am", (9, "A"): "Em", (10, "A"): "Bm", (11, "A"): "F#m", (12, "A"): "C#m",
+    (1, "B"): "B", (2, "B"): "F#", (3, "B"): "C#", (4, "B"): "G#", (5, "B"): "D#", (6, "B"): "A#",
+    (7, "B"): "F", (8, "B"): "C", (9, "B"): "G", (10, "B"): "D", (11, "B"): "A", (12, "B"): "E",
+}
+_ENHARMONIC_ROOTS = {"Db": "C#", "Eb": "D#", "Gb": "F#", "Ab": "G#", "Bb": "A#",
+                     "Cb": "B", "Fb": "E", "E#": "F", "B#": "C"}
+KEY_NOTES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+def _normalize_key_label(label):
+    """'A min' / 'Amin' / 'Am' / '8A' (Camelot) → 'Am'; 'Db maj' / 'C#' → 'C#'.
+
+    Mesma grafia do detect_key (sustenidos). None se ilegível.
+    """
+    import re
+    if not label:
+        return None
+    text = str(label).strip().replace("♯", "#").replace("♭", "b")
+    m = re.fullmatch(r'(\d{1,2})\s*([AaBb])', text)
+    if m:
+        return _CAMELOT_KEYS.get((int(m.group(1)), m.group(2).upper()))
+    m = re.fullmatch(r'([A-Ga-g])\s*([#b]?)\s*(.*)', text)
+    if not m:
+        return None
+    root = m.group(1).upper() + m.group(2)
+    mode = m.group(3).strip().lower().rstrip('.')
+    if mode in ('', 'maj', 'major', 'dur'):
+        minor = False
+    elif mode in ('m', 'min', 'minor', 'moll'):
+        minor = True
+    else:
+        return None
+    root = _ENHARMONIC_ROOTS.get(root, root)
+    if root not in KEY_NOTES:
+        return None
+    return f"{root}m" if minor else root
+
+
+def _first_tag_text(tags, names):
+    """Primeiro valor textual entre as tags `names` (ID3, Vorbis ou MP4)."""
+    for name in names:
+        try:
+            if name not in tags:
+                continue
+            value = tags[name]
+        except (KeyError, ValueError, TypeError):
+            continue
+        value = getattr(value, "text", value)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "ignore")
+        if value is not None and str(value).strip():
+            return str(value).strip()
+    return None
+
+
+# O aviso de mutagen ausente sai uma vez por processo (o worker lê tags a cada job)
+_MUTAGEN_WARNED = False
+
+
+def _read_tag_hints(file_path):
+    """BPM e tonalidade das tags do arquivo, sem decodificar o áudio.
+
+    ID3 (TBPM/TKEY), Vorbis/FLAC (bpm, initialkey/key) e MP4 (tmpo,
+    ----:com.apple.iTunes:initialkey). Requer o mutagen (opcional, ver
+    SETUP-LINUX.md): sem ele, avisa uma vez no stderr e só o BPM do nome vale;
+    sem tags legíveis, devolve {}.
+    """
+    global _MUTAGEN_WARNED
+    try:
+        import mutagen
+    except ImportError:
+        if not _MUTAGEN_WARNED:
+            _MUTAGEN_WARNED = True
+            sys.stderr.write("[Warning] mutagen não instalado: hints das tags (BPM/tonalidade) "
+                             "indisponíveis, só o BPM do nome Beatport é usado (pip install mutagen)\n")
+        return {}
+    try:
+        audio = mutagen.File(file_path)
+        tags = getattr(audio, "tags", None) if audio is not None else None
+        if not tags:
+            return {}
+        hints = {}
+        bpm_text = _first_tag_text(tags, ("TBPM", "bpm", "tmpo", "----:com.apple.iTunes:BPM"))
+        if bpm_text:
+            try:
+                bpm = float(bpm_text.replace(",", "."))
+                if BPM_HINT_MIN <= bpm <= BPM_HINT_MAX:
+                    hints["bpm"] = round(bpm, 2)
+            except ValueError:
+                pass
+        key = _normalize_key_label(_first_tag_text(
+            tags, ("TKEY", "initialkey", "INITIALKEY", "key", "----:com.apple.iTunes:initialkey")
+        ))
+        if key:
+            hints["key"] = key
+        return hints
+    except Exception:
+        return {}
+
+
+def read_track_hints(file_path):
+    """Hints confiáveis de BPM/tonalidade: tags do arquivo e o BPM Beatport do nome.
+
+    Retorna {"bpm", "bpm_source", "key", "key_source"} (None quando ausente).
+    O BPM das tags tem prioridade (pode ter casas decimais); o do nome é o fallback.
+    """
+    tags = _read_tag_hints(file_path)
+    hints = {"bpm": None, "bpm_source": None, "key": None, "key_source": None}
+    if tags.get("bpm"):
+        hints["bpm"], hints["bpm_source"] = tags["bpm"], "tag"
+    else:
+        name_bpm = _bpm_from_filename(file_path)
+        if name_bpm:
+            hints["bpm"], hints["bpm_source"] = name_bpm, "filename"
+    if tags.get("key"):
+        hints["key"], hints["key_source"] = tags["key"], "tag"
+    return hints
+
+
+def resolve_use_hints(use_hints=None):
+    """Modo de hints (BPM/tonalidade das tags/nome): None = $LEGOLAS_USE_HINTS (padrão: desligado)."""
+    if use_hints is None:
+        use_hints = os.environ.get("LEGOLAS_USE_HINTS", "").strip().lower() in ("1", "true", "yes", "on")
+    return bool(use_hints)
+
+
 def _reconcile_bpm(detected, hint):
     """Concilia o BPM detectado com o hint do nome (Beatport).
 
@@ -338,18 +1021,75 @@ def _reconcile_bpm(detected, hint):
     return hint
 
 
-def analyze_groove_and_rhythm(y, sr, bpm, y_perc=None):
+# Conferência do BPM das tags/nome: trecho do meio da faixa, decodificado à parte
+BPM_HINT_EXCERPT = 30.0   # s
+BPM_HINT_SR = 11025
+BPM_HINT_HOP = 128        # ~86 quadros/s: lags finos o bastante para ±3%
+BPM_HINT_DOUBLE = 1.05    # autocorrelação em ½ período > 105% da do período → 2× o hint
+BPM_HINT_DOUBLE_BELOW = 90.0  # só hints lentos podem ser meia velocidade (house/techno não)
+BPM_HINT_MIN, BPM_HINT_MAX = 50.0, 220.0  # faixa aceita para BPM de tags/nome
+BPM_HINT_HALVE = 0.5      # autocorrelação no período < 50% da de 2 períodos → ½× o hint
+
+
+def verify_bpm_hint(file_path, hint, seconds=BPM_HINT_EXCERPT):
+    """Confere a oitava do BPM `hint` na autocorrelação do onset de um trecho curto.
+
+    Tags e nomes às vezes trazem a meia/dupla velocidade (ex.: DnB marcado 87).
+    Decodifica só `seconds` do meio da faixa (sempre o mesmo trecho, qualquer
+    que seja o plano) e lê a autocorrelação do envelope de onset no período do
+    hint e nos de 2× e ½× (pico em ±3%). Só um hint lento (< 90) pode subir
+    para 2×, e só se o meio período vencer o período com folga: hi-hat no
+    contratempo repete no meio período quase com a força do beat e não pode
+    dobrar um 124 correto. Um hint no dobro do tempo real cai no contratempo
+    e perde para o período de dois hints. Retorna (bpm,
+    verificado): verificado é True quando o hint se confirma, False quando foi
+    corrigido e None quando o trecho não pôde ser lido.
+    """
+    try:
+        total = _probe_duration(file_path)
+        offset = max(0.0, total / 2.0 - seconds / 2.0)
+        y, sr = librosa.load(file_path, sr=BPM_HINT_SR, mono=True, offset=offset, duration=seconds)
+        env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=BPM_HINT_HOP, aggregate=np.median)
+        env = env - env.mean()
+        ac = librosa.autocorrelate(env)
+        if ac[0] <= 0:
+            return hint, None
+        ac = ac / ac[0]
+    except Exception as e:
+        sys.stderr.write(f"[Warning] conferência do BPM indisponível ({e}): usando o hint\n")
+        return hint, None
+
+    fps = sr / float(BPM_HINT_HOP)
+    lags = np.arange(len(ac))
+
+    def strength(bpm):
+        period = 60.0 * fps / bpm
+        return float(np.max(np.interp(period * np.linspace(0.97, 1.03, 13), lags, ac)))
+
+    at_hint = strength(hint)
+    if (hint < BPM_HINT_DOUBLE_BELOW and hint * 2.0 <= BPM_HINT_MAX
+            and strength(hint * 2.0) > BPM_HINT_DOUBLE * at_hint):
+        return round(hint * 2.0, 2), False
+    if hint * 0.5 >= BPM_HINT_MIN and at_hint < BPM_HINT_HALVE * strength(hint * 0.5):
+        return round(hint * 0.5, 2), False
+    return hint, True
+
+
+def analyze_groove_and_rhythm(y, sr, bpm, y_perc=None, ctx=None, tempo_hint=None):
     """
     Analisa groove, swing e complexidade rítmica.
+
+    `tempo_hint`: BPM confiável (tags/nome) — o beat tracking parte dele em vez
+    de estimar o tempo do percussivo.
     """
     try:
         # Usar HPSS pré-computado se disponível
-        if y_perc is None:
-            _, y_perc = librosa.effects.hpss(y)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_perc=y_perc)
+        y_perc = ctx.y_perc
 
-        # Beat tracking
-        tempo, beat_frames = librosa.beat.beat_track(y=y_perc, sr=sr)
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr)
+        # Beat tracking (compartilhado: ctx.beats)
+        _tempo, beat_times = ctx.beats.track('perc', bpm=tempo_hint)
 
         # Calcular swing/groove
         swing = 0.0
@@ -373,7 +1113,7 @@ def analyze_groove_and_rhythm(y, sr, bpm, y_perc=None):
                         groove_type = "reto"
 
         # Complexidade rítmica - baseada na variação de onset strength
-        onset_env = librosa.onset.onset_strength(y=y_perc, sr=sr)
+        onset_env = ctx.onset_envelope('perc')
         onset_var = np.std(onset_env) / (np.mean(onset_env) + 1e-10)
 
         if onset_var > 1.5:
@@ -389,7 +1129,7 @@ def analyze_groove_and_rhythm(y, sr, bpm, y_perc=None):
             # Analisar onsets por compasso
             beats_per_bar = 4
             bar_duration = (60.0 / bpm) * beats_per_bar
-            onsets = librosa.onset.onset_detect(y=y_perc, sr=sr, units='time')
+            onsets = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, units='time')
 
             if len(onsets) > 8:
                 # Verificar regularidade
@@ -426,19 +1166,19 @@ def analyze_groove_and_rhythm(y, sr, bpm, y_perc=None):
 # 3. ELEMENTOS DE BATERIA (detalhado)
 # ──────────────────────────────────────────────────────────────────
 
-def detect_drums_detailed(y, sr, y_harm=None, y_perc=None):
+def detect_drums_detailed(y, sr, y_harm=None, y_perc=None, ctx=None):
     """
     Detecta elementos de bateria com detalhes de papel, padrão e tipo.
     """
     try:
-        if y_harm is None or y_perc is None:
-            y_harm, y_perc = librosa.effects.hpss(y)
-        D_perc = np.abs(librosa.stft(y_perc))
-        freqs = librosa.fft_frequencies(sr=sr)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_harm=y_harm, y_perc=y_perc)
+        D_perc = ctx.magnitude('perc')
+        freqs = ctx.freqs
         avg_energy = np.mean(D_perc) + 1e-10
 
-        # Onset envelope para análise temporal
-        onset_env = librosa.onset.onset_strength(y=y_perc, sr=sr)
+        # Onset envelope para análise temporal (compartilhado com o groove)
+        onset_env = ctx.onset_envelope('perc')
         onset_times = librosa.frames_to_time(np.arange(len(onset_env)), sr=sr)
 
         elements = {}
@@ -577,11 +1317,13 @@ def detect_drums_detailed(y, sr, y_harm=None, y_perc=None):
 # 4. ELEMENTOS DE BASS
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_bass_detailed(y, sr, y_perc=None):
+def analyze_bass_detailed(y, sr, y_perc=None, ctx=None):
     """Analisa elementos de bass com detalhes."""
     try:
-        D = np.abs(librosa.stft(y))
-        freqs = librosa.fft_frequencies(sr=sr)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_perc=y_perc)
+        D = ctx.magnitude('full')
+        freqs = ctx.freqs
         avg_energy = np.mean(D) + 1e-10
 
         # ── SUB BASS ──
@@ -643,9 +1385,7 @@ def analyze_bass_detailed(y, sr, y_perc=None):
         }
 
         # ── RELAÇÃO KICK x BASS ──
-        if y_perc is None:
-            _, y_perc = librosa.effects.hpss(y)
-        D_perc = np.abs(librosa.stft(y_perc))
+        D_perc = ctx.magnitude('perc')
         kick_mask = (freqs >= 20) & (freqs <= 120)
         kick_energy = np.mean(D_perc[kick_mask, :]) if np.any(kick_mask) else 0
 
@@ -684,19 +1424,19 @@ def analyze_bass_detailed(y, sr, y_perc=None):
 # 5. SYNTHS E CAMADAS SONORAS
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_synths_and_layers(y, sr, y_harm=None):
+def analyze_synths_and_layers(y, sr, y_harm=None, ctx=None):
     """Analisa synths e camadas sonoras em detalhe."""
     try:
-        if y_harm is None:
-            y_harm, _ = librosa.effects.hpss(y)
-        D = np.abs(librosa.stft(y_harm))
-        freqs = librosa.fft_frequencies(sr=sr)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_harm=y_harm)
+        D = ctx.magnitude('harm')
+        freqs = ctx.freqs
         avg_energy = np.mean(D) + 1e-10
 
         # Features espectrais
-        centroid = np.mean(librosa.feature.spectral_centroid(y=y_harm, sr=sr))
-        rolloff = np.mean(librosa.feature.spectral_rolloff(y=y_harm, sr=sr))
-        flatness = np.mean(librosa.feature.spectral_flatness(y=y_harm))
+        centroid = np.mean(ctx.spectral_centroid('harm'))
+        rolloff = np.mean(ctx.spectral_rolloff('harm'))
+        flatness = np.mean(ctx.spectral_flatness('harm'))
 
         layers = []
 
@@ -826,15 +1566,55 @@ def analyze_synths_and_layers(y, sr, y_harm=None):
 # 6. HARMONIA E TONALIDADE
 # ──────────────────────────────────────────────────────────────────
 
-def detect_key(y, sr):
-    """Detecta a tonalidade (key) da música usando análise de chroma."""
+# Perfis de Krumhansl (maior/menor), tônica em C
+KRUMHANSL_MAJOR = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+KRUMHANSL_MINOR = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+# Folga de correlação com que uma tonalidade das tags é aceita frente à melhor
+KEY_HINT_MARGIN = 0.1
+
+
+def detect_key(y, sr, ctx=None, hint=None, cheap=False):
+    """Detecta a tonalidade (key) da música usando análise de chroma.
+
+    `hint`: tonalidade confiável (tags, ver read_track_hints). Vira uma
+    verificação rápida sobre o cromagrama STFT do mix (sem HPSS nem CQT); só
+    se ela falhar roda a detecção completa. `cheap`: a detecção também sai do
+    cromagrama STFT do mix — para planos em que nenhum outro estágio usa o HPSS
+    (ver fast_stages); nos sintéticos do benchmark concorda com o CQT harmônico.
+    """
+    return detect_key_with_method(y, sr, ctx=ctx, hint=hint, cheap=cheap)[0]
+
+
+def detect_key_with_method(y, sr, ctx=None, hint=None, cheap=False):
+    """detect_key que também diz de onde a tonalidade saiu: (key, key_method).
+
+    key_method: "tag" (hint confirmado), "mix_stft" (cromagrama STFT do mix,
+    versão barata) ou "harmonic_cqt" (CQT do harmônico, análise completa). Os
+    dois algoritmos podem divergir em faixas ambíguas, então o resultado leva
+    o método junto (ver analyze_audio).
+    """
     try:
-        chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-        chroma_mean = np.mean(chroma, axis=1)
-        notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+        if hint or cheap:
+            if ctx is None:
+                ctx = AnalysisContext(y, sr)
+            chroma_mean = np.mean(ctx.chroma_stft(), axis=1)
+            if hint and _verify_key_hint(chroma_mean, hint):
+                return hint, "tag"
+            if cheap:
+                return _key_from_chroma_mean(chroma_mean), "mix_stft"
+        # Com contexto: cromagrama do CQT harmônico compartilhado
+        chroma = ctx.chroma() if ctx is not None else librosa.feature.chroma_cqt(y=y, sr=sr)
+        return _key_from_chroma_mean(np.mean(chroma, axis=1)), "harmonic_cqt"
+    except Exception:
+        return None, None
 
-        major_profile = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
-        minor_profile = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+def _key_from_chroma_mean(chroma_mean):
+    """Tonalidade pelo perfil de Krumhansl que melhor correlaciona com o chroma médio."""
+    try:
+        notes = KEY_NOTES
+        major_profile = KRUMHANSL_MAJOR
+        minor_profile = KRUMHANSL_MINOR
 
         best_major_corr = -1
         best_minor_corr = -1
@@ -861,10 +1641,29 @@ def detect_key(y, sr):
         return None
 
 
-def analyze_harmony(y, sr, key):
+def _verify_key_hint(chroma_mean, hint, margin=KEY_HINT_MARGIN):
+    """True se a tonalidade `hint` (ou a relativa dela) correlaciona com o chroma
+    médio a até `margin` da melhor das 24.
+
+    O perfil de Krumhansl não separa maior/relativa menor (mesmas notas), então
+    a relativa conta como confirmação; tag de outra faixa ou a quinta errada não passam.
+    """
+    try:
+        root, is_minor = _parse_key_root(hint)
+        corrs = np.array([[np.corrcoef(np.roll(chroma_mean, -i), prof)[0, 1] for i in range(12)]
+                          for prof in (KRUMHANSL_MAJOR, KRUMHANSL_MINOR)])
+        best = float(np.nanmax(corrs))
+        relative = (root + 3) % 12 if is_minor else (root + 9) % 12
+        hint_corr = max(corrs[int(is_minor), root], corrs[int(not is_minor), relative])
+        return bool(np.isfinite(hint_corr) and hint_corr >= best - margin)
+    except Exception:
+        return False
+
+
+def analyze_harmony(y, sr, key, ctx=None):
     """Analisa harmonia e uso harmônico."""
     try:
-        chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
+        chroma = ctx.chroma() if ctx is not None else librosa.feature.chroma_cqt(y=y, sr=sr)
         chroma_mean = np.mean(chroma, axis=1)
 
         # Quantas notas têm presença significativa
@@ -920,12 +1719,14 @@ def analyze_harmony(y, sr, key):
 # 7. ESTRUTURA DA MÚSICA (linha do tempo)
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_structure_detailed(y, sr, duration):
+def analyze_structure_detailed(y, sr, duration, ctx=None):
     """
     Detecta estrutura detalhada com timestamps, energia e elementos.
     """
     try:
-        rms = librosa.feature.rms(y=y)[0]
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        rms = ctx.rms()
         rms_norm = rms / (np.max(rms) + 1e-10)
 
         hop_length = 512
@@ -1091,13 +1892,15 @@ def analyze_structure_detailed(y, sr, duration):
 # 8. DINÂMICA E ARRANJO
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_dynamics(y, sr, duration):
+def analyze_dynamics(y, sr, duration, ctx=None):
     """Analisa dinâmica, uso de camadas, tensão e previsibilidade."""
     try:
-        rms = librosa.feature.rms(y=y)[0]
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        rms = ctx.rms()
         rms_norm = rms / (np.max(rms) + 1e-10)
 
-        hop_length = 512
+        hop_length = ctx.HOP_LENGTH
         frame_duration = hop_length / sr
 
         # Evolução de energia
@@ -1145,7 +1948,7 @@ def analyze_dynamics(y, sr, duration):
             predictability = "média"
 
         # Uso de camadas
-        spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)[0]
+        spectral_bandwidth = ctx.spectral_bandwidth()[0]
         bandwidth_var = np.std(spectral_bandwidth) / (np.mean(spectral_bandwidth) + 1e-10)
         layering = "camadas densas (adição)" if bandwidth_var > 0.3 else "camadas sutis (subtração)" if bandwidth_var > 0.15 else "estável"
 
@@ -1179,11 +1982,13 @@ def analyze_dynamics(y, sr, duration):
 # 9. MIXAGEM (análise perceptiva)
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_mix(y, y_stereo, sr):
+def analyze_mix(y, y_stereo, sr, ctx=None):
     """Analisa características da mixagem."""
     try:
-        D = np.abs(librosa.stft(y))
-        freqs = librosa.fft_frequencies(sr=sr)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        D = ctx.magnitude('full')
+        freqs = ctx.freqs
 
         # ── ESPAÇO ESTÉREO ──
         if y_stereo is not None and y_stereo.ndim == 2 and y_stereo.shape[0] == 2:
@@ -1203,7 +2008,7 @@ def analyze_mix(y, y_stereo, sr):
 
         # ── PROFUNDIDADE ──
         # Reverb estimation: spectral decay rate
-        spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+        spectral_contrast = ctx.spectral_contrast()
         avg_contrast = np.mean(spectral_contrast)
         if avg_contrast > 25:
             depth = "muita profundidade (reverb/delay)"
@@ -1214,7 +2019,7 @@ def analyze_mix(y, y_stereo, sr):
 
         # ── CLAREZA ──
         # Baseado no spectral flatness e contraste
-        flatness = np.mean(librosa.feature.spectral_flatness(y=y))
+        flatness = np.mean(ctx.spectral_flatness())
         if flatness < 0.05:
             clarity = "muito clara"
         elif flatness < 0.1:
@@ -1284,10 +2089,12 @@ def analyze_mix(y, y_stereo, sr):
 # 10. ANÁLISE PARA DJ
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_for_dj(y, sr, bpm, key, duration, structure_sections, energy_score, genre):
+def analyze_for_dj(y, sr, bpm, key, duration, structure_sections, energy_score, genre, ctx=None):
     """Analisa características relevantes para DJs."""
     try:
-        rms = librosa.feature.rms(y=y)[0]
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        rms = ctx.rms()
         rms_norm = rms / (np.max(rms) + 1e-10)
         hop_length = 512
         frame_duration = hop_length / sr
@@ -1785,11 +2592,13 @@ def generate_temporal_arrangement(duration, structure, drums, bass, synth_layers
 # ANÁLISE DE FREQUÊNCIAS E LOUDNESS
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_frequency_bands(y, sr):
+def analyze_frequency_bands(y, sr, ctx=None):
     """Analisa energia em diferentes bandas de frequência."""
     try:
-        D = np.abs(librosa.stft(y))
-        freqs = librosa.fft_frequencies(sr=sr)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        D = ctx.magnitude('full')
+        freqs = ctx.freqs
 
         bands = {
             'sub_bass': (20, 60),
@@ -1825,10 +2634,12 @@ def analyze_frequency_bands(y, sr):
         }
 
 
-def analyze_loudness(y, sr):
+def analyze_loudness(y, sr, ctx=None):
     """Calcula loudness em dB."""
     try:
-        rms = librosa.feature.rms(y=y)[0]
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        rms = ctx.rms()
         rms_db = librosa.amplitude_to_db(rms, ref=1.0)
         return {
             'peak_db': round(float(np.max(rms_db)), 2),
@@ -2049,7 +2860,7 @@ def _fill_section_elements(structure, temporal_arrangement):
         sec["elements_exiting"] = exiting[:8]
 
 
-def detect_structure_adaptive(y, sr, duration, bpm=None):
+def detect_structure_adaptive(y, sr, duration, bpm=None, ctx=None):
     """
     Detecta a estrutura da música de forma adaptativa usando features reais.
 
@@ -2063,11 +2874,13 @@ def detect_structure_adaptive(y, sr, duration, bpm=None):
     - Classificação por energia e tendência interna de cada seção
     """
     try:
-        hop_length = 512
+        if ctx is None:
+            ctx = AnalysisContext(y, sr)
+        hop_length = ctx.HOP_LENGTH
         frame_dur = hop_length / sr
 
         # 1. Curva de energia
-        rms = librosa.feature.rms(y=y, hop_length=hop_length)[0]
+        rms = ctx.rms()
         rms_norm = rms / (np.max(rms) + 1e-10)
 
         # 2. Suavização forte para análise estrutural (~6 segundos)
@@ -2077,7 +2890,7 @@ def detect_structure_adaptive(y, sr, duration, bpm=None):
         rms_smooth = np.convolve(rms_norm, kernel, mode='same')
 
         # 3. MFCCs para detectar mudanças timbrais (mais robusto que spectral centroid)
-        mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13, hop_length=hop_length)
+        mfcc = ctx.mfcc(n_mfcc=13)
         mfcc_delta = np.sqrt(np.sum(np.diff(mfcc, axis=1) ** 2, axis=0))
         mfcc_delta = np.append(mfcc_delta, 0)
         mfcc_smooth = np.convolve(mfcc_delta, kernel, mode='same')
@@ -2205,7 +3018,7 @@ def detect_structure_adaptive(y, sr, duration, bpm=None):
         sys.stderr.write(f"[Warning] detect_structure_adaptive falhou ({e}), usando fallback\n")
         import traceback
         traceback.print_exc(file=sys.stderr)
-        return analyze_structure_detailed(y, sr, duration)
+        return analyze_structure_detailed(y, sr, duration, ctx=ctx)
 
 
 # ──────────────────────────────────────────────────────────────────
@@ -2213,8 +3026,52 @@ def detect_structure_adaptive(y, sr, duration, bpm=None):
 # Substitui posicionamento por regras com análise espectral por janelas
 # ──────────────────────────────────────────────────────────────────
 
+def _band_window_energy(S, freqs, bands, frames_per_window, n_windows):
+    """Energia média de cada banda em cada janela: matriz (bandas × janelas).
+
+    Equivale a np.mean(S[mask_banda, janela]) para cada par, numa única passada:
+    o espectrograma é somado por janela (bins × janelas, em float64) e a matriz
+    de agregação (bandas × bins, 1/nº de bins na linha da banda) faz a média
+    espectral. Bandas sem nenhum bin saem com energia 0.
+
+    Trecho mais curto que uma janela: a janela única cobre os frames que
+    existem (mesma média do loop original, que cortava em min(fim, n_frames)).
+    """
+    n_frames = S.shape[1]
+    if n_frames == 0:
+        return np.zeros((len(bands), n_windows))
+    frames_per_window = min(frames_per_window, n_frames)
+    n_windows = min(n_windows, n_frames // frames_per_window)
+    n_used = n_windows * frames_per_window
+    window_sum = S[:, :n_used].reshape(S.shape[0], n_windows, frames_per_window).sum(
+        axis=2, dtype=np.float64)
+    agg = np.zeros((len(bands), S.shape[0]))
+    for i, (low, high) in enumerate(bands):
+        mask = (freqs >= low) & (freqs <= high)
+        if np.any(mask):
+            agg[i, mask] = 1.0 / np.count_nonzero(mask)
+    return agg @ window_sum / frames_per_window
+
+
+def _presence_blocks(presence, max_gap=1, min_len=1):
+    """Blocos contíguos [início, fim) de um vetor booleano, via run-length encoding.
+
+    Blocos separados por até `max_gap` janelas ausentes são fundidos; blocos
+    com menos de `min_len` janelas são descartados.
+    """
+    edges = np.diff(np.concatenate(([0], np.asarray(presence, dtype=np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) > 1:
+        breaks = (starts[1:] - ends[:-1]) > max_gap
+        starts = starts[np.concatenate(([True], breaks))]
+        ends = ends[np.concatenate((breaks, [True]))]
+    keep = (ends - starts) >= min_len
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
+
 def generate_temporal_arrangement_v2(y, sr, duration, bpm, y_harm, y_perc,
-                                      drums, bass, synth_layers, structure):
+                                      drums, bass, synth_layers, structure, ctx=None):
     """
     Gera arranjo temporal baseado em detecção real de elementos no áudio.
 
@@ -2230,7 +3087,9 @@ def generate_temporal_arrangement_v2(y, sr, duration, bpm, y_harm, y_perc,
     - Adapta-se fielmente a qualquer duração (8, 10, 12+ minutos)
     """
     try:
-        hop_length = 512
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_harm=y_harm, y_perc=y_perc)
+        hop_length = ctx.HOP_LENGTH
         frame_rate = sr / hop_length
 
         # Janela temporal: ~2 compassos (boa estabilidade sem perder resolução)
@@ -2241,10 +3100,10 @@ def generate_temporal_arrangement_v2(y, sr, duration, bpm, y_harm, y_perc,
             window_sec = 4.0
 
         # Espectrogramas
-        D_perc = np.abs(librosa.stft(y_perc, hop_length=hop_length))
-        D_harm = np.abs(librosa.stft(y_harm, hop_length=hop_length))
-        D_full = np.abs(librosa.stft(y, hop_length=hop_length))
-        freqs = librosa.fft_frequencies(sr=sr)
+        D_perc = ctx.magnitude('perc')
+        D_harm = ctx.magnitude('harm')
+        D_full = ctx.magnitude('full')
+        freqs = ctx.freqs
 
         n_frames = D_full.shape[1]
         frames_per_window = max(1, int(window_sec * frame_rate))
@@ -2396,25 +3255,28 @@ def generate_temporal_arrangement_v2(y, sr, duration, bpm, y_harm, y_perc,
                  'bands': [(300, 6000)], 'threshold_pct': 40, 'role': 'groove'},
             ]
 
-        # ── Análise por janelas para cada elemento ──
+        # ── Análise por janelas: matriz de energia (bandas × janelas) por fonte ──
+        # Uma passada por espectrograma, qualquer que seja o nº de elementos
         source_map = {'perc': D_perc, 'harm': D_harm, 'full': D_full}
-        timeline = []
-
+        band_rows = {}
         for elem in track_elements:
-            source = source_map[elem['source']]
-
-            # Computar energia por janela
-            window_energies = np.zeros(n_windows)
-            for w in range(n_windows):
-                sf = w * frames_per_window
-                ef = min((w + 1) * frames_per_window, n_frames)
-                e = 0.0
-                for (low, high) in elem['bands']:
-                    mask = (freqs >= low) & (freqs <= high)
-                    if np.any(mask):
-                        e += float(np.mean(source[mask, sf:ef]))
-                window_energies[w] = e
+            for band in elem['bands']:
+                band_rows.setdefault((elem['source'], band), len(band_rows))
+        band_energy = np.zeros((len(band_rows), n_windows))
+        for src, D in source_map.items():
+            keys = [k for k in band_rows if k[0] == src]
+            if keys:
+                band_energy[[band_rows[k] for k in keys]] = _band_window_energy(
+                    D, freqs, [k[1] for k in keys], frames_per_window, n_windows)
+        # Elemento = soma das suas bandas (matriz de incidência elementos × bandas)
+        incidence = np.zeros((len(track_elements), len(band_rows)))
+        for i, elem in enumerate(track_elements):
+            for band in elem['bands']:
+                incidence[i, band_rows[(elem['source'], band)]] = 1.0
+        element_energy = incidence @ band_energy
+        timeline = []
 
+        for elem, window_energies in zip(track_elements, element_energy):
             # Threshold adaptativo por percentil
             if np.max(window_energies) < 1e-10:
                 continue
@@ -2423,31 +3285,11 @@ def generate_temporal_arrangement_v2(y, sr, duration, bpm, y_harm, y_perc,
             presence = window_energies > threshold
             max_e = np.max(window_energies) + 1e-10
 
-            # Encontrar blocos contíguos de presença
-            blocks = []
-            in_block = False
-            bstart = 0
-            for w in range(len(presence)):
-                if presence[w] and not in_block:
-                    in_block = True
-                    bstart = w
-                elif not presence[w] and in_block:
-                    in_block = False
-                    blocks.append((bstart, w))
-            if in_block:
-                blocks.append((bstart, len(presence)))
-
-            # Fundir gaps de 1 janela (evita fragmentação excessiva)
-            merged_blocks = []
-            for b in blocks:
-                if merged_blocks and (b[0] - merged_blocks[-1][1]) <= 1:
-                    merged_blocks[-1] = (merged_blocks[-1][0], b[1])
-                else:
-                    merged_blocks.append(b)
-
-            # Filtrar blocos muito curtos (exceto FX/impacto que pode ser pontual)
+            # Blocos contíguos de presença, fundindo gaps de 1 janela (evita
+            # fragmentação excessiva) e descartando blocos muito curtos (exceto
+            # FX/impacto, que pode ser pontual)
             min_win = 1 if elem['role'] == 'impacto' else 2
-            merged_blocks = [b for b in merged_blocks if (b[1] - b[0]) >= min_win]
+            merged_blocks = _presence_blocks(presence, max_gap=1, min_len=min_win)
 
             # Converter blocos em items do timeline
             for bs, be in merged_blocks:
@@ -2546,31 +3388,171 @@ def _select_extraction_segment(y, sr, bpm, target_beats=64):
     return y_seg, start_sample / float(sr), actual_beats
 
 
-def _bandpass_istft(y, sr, fmin, fmax):
-    """Isola uma faixa de frequência via STFT para detecção de onsets/pitch."""
-    D = librosa.stft(y)
-    freqs = librosa.fft_frequencies(sr=sr)
-    mask = (freqs >= fmin) & (freqs <= fmax)
-    D_filt = np.zeros_like(D)
-    D_filt[mask] = D[mask]
-    y_out = librosa.istft(D_filt)
-    peak = float(np.max(np.abs(y_out)) + 1e-10)
-    return y_out / peak
+class BeatGrid:
+    """Grade de beats real (tempos em s) com conversão vetorizada tempo ↔ beat.
 
+    `to_beats` interpola entre os beats da grade (e extrapola antes do primeiro
+    e depois do último com o intervalo da ponta) para um array inteiro de uma
+    vez; `to_times` é a inversa. Evita converter frame a frame/onset a onset
+    (centenas de milhares de chamadas numa faixa de 10 min).
+    """
 
-def _build_beat_grid(y_perc, sr, bpm, max_beats):
-    """Grade de beats ancorada ao BPM conhecido — corrige o drift que a
-    quantização por BPM constante acumula ao longo da faixa."""
-    try:
-        _t, beat_frames = librosa.beat.beat_track(y=y_perc, sr=sr, bpm=float(bpm), trim=False)
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr)
-        if len(beat_times) >= 4:
-            return np.asarray(beat_times, dtype=float)
-    except Exception:
-        pass
-    # Grade sintética a partir do BPM (offset 0)
-    beat_dur = 60.0 / float(bpm) if bpm and bpm > 0 else 0.5
-    return np.arange(int(max_beats) + 2, dtype=float) * beat_dur
+    def __init__(self, beat_times):
+        self.beat_times = np.asarray(beat_times, dtype=float)
+
+    def __len__(self):
+        return len(self.beat_times)
+
+    def _edge_durations(self):
+        bt = self.beat_times
+        if len(bt) >= 2:
+            return bt[1] - bt[0], bt[-1] - bt[-2]
+        return 0.5, 0.5
+
+    def to_beats(self, times):
+        """Tempos (s) → posições fracionárias em beats (mesmo shape da entrada)."""
+        t = np.asarray(times, dtype=float)
+        bt = self.beat_times
+        n = len(bt)
+        if n == 0:
+            return np.zeros_like(t)
+        first_bd, last_bd = self._edge_durations()
+        i = np.searchsorted(bt, t)
+        before = (t - bt[0]) / (first_bd + 1e-9)
+        after = (n - 1) + (t - bt[-1]) / (last_bd + 1e-9)
+        if n < 2:
+            return np.where(i <= 0, before, after)
+        ic = np.clip(i, 1, n - 1)
+        b0, b1 = bt[ic - 1], bt[ic]
+        inside = (ic - 1) + (t - b0) / (b1 - b0 + 1e-9)
+        return np.where(i <= 0, before, np.where(i >= n, after, inside))
+
+    def to_times(self, beats):
+        """Posições em beats → tempos (s); inversa de to_beats."""
+        b = np.asarray(beats, dtype=float)
+        bt = self.beat_times
+        n = len(bt)
+        if n == 0:
+            return np.zeros_like(b)
+        first_bd, last_bd = self._edge_durations()
+        if n < 2:
+            return bt[0] + b * first_bd
+        idx = np.clip(np.floor(b).astype(int), 0, n - 2)
+        inside = bt[idx] + (b - idx) * (bt[idx + 1] - bt[idx])
+        return np.where(b < 0, bt[0] + b * first_bd,
+                        np.where(b > n - 1, bt[-1] + (b - (n - 1)) * last_bd, inside))
+
+    def shifted(self, seconds):
+        return BeatGrid(self.beat_times + seconds)
+
+    def quantize(self, onset_times, strengths, max_beats, grid_div=4):
+        """Onsets (crescentes, como saem do onset_detect) → eventos no grid.
+
+        Posição no grid, descarte fora de [-0.25, max_beats), dedupe de onsets
+        que caem no mesmo slot (gap < meio slot) e velocity pelo onset strength,
+        tudo em operações de array.
+        """
+        onset_times = np.asarray(onset_times, dtype=float)
+        if len(onset_times) == 0:
+            return []
+        pos = self.to_beats(onset_times)
+        idx = np.flatnonzero((pos >= -0.25) & (pos < max_beats))
+        if len(idx) == 0:
+            return []
+        q = np.maximum(0.0, np.round(pos[idx] * grid_div) / grid_div)
+        min_gap = (1.0 / grid_div) * 0.5
+        # q é não-decrescente em múltiplos de 1/grid_div: fica o 1º onset de cada slot
+        keep = np.concatenate(([True], np.diff(q) >= min_gap))
+        idx, q = idx[keep], q[keep]
+
+        if strengths is not None and len(strengths):
+            strengths = np.asarray(strengths, dtype=float)
+            smax = float(np.max(strengths))
+            has = idx < len(strengths)
+            s = np.full(len(idx), 0.6)
+            s[has] = strengths[idx[has]] / (smax + 1e-9)
+        else:
+            s = np.full(len(idx), 0.6)
+        vel = np.clip(45 + s * 80, 35, 127).astype(int)
+        dur = round(1.0 / grid_div, 4)
+        return [
+            {"beat": round(float(qq), 4), "duration_beats": dur, "velocity": int(v)}
+            for qq, v in zip(q, vel)
+        ]
+
+
+class SlotGroups:
+    """Frames agrupados por slot [starts[s], ends[s]) uma única vez.
+
+    Cada frame é atribuído ao seu slot por busca binária nos inícios, os frames
+    válidos são ordenados por slot (sort estável, mantém a ordem temporal) e as
+    reduções por slot viram reduções segmentadas sobre esse array — O(frames)
+    em vez de refazer `mask = (pos >= b0) & (pos < b1)` sobre a faixa inteira
+    para cada slot. `starts` deve ser crescente e os slots não se sobrepõem.
+    """
+
+    def __init__(self, values, starts, ends, mask=None):
+        values = np.asarray(values, dtype=float)
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        self.n_slots = len(starts)
+        if self.n_slots == 0 or len(values) == 0:
+            self.order = np.zeros(0, dtype=int)
+            self._slots = np.zeros(0, dtype=int)
+            self.offsets = np.zeros(self.n_slots, dtype=int)
+            self.counts = np.zeros(self.n_slots, dtype=int)
+            return
+        slot = np.searchsorted(starts, values, side="right") - 1
+        ok = (slot >= 0) & (values < ends[np.clip(slot, 0, self.n_slots - 1)])
+        if mask is not None:
+            ok &= np.asarray(mask, dtype=bool)
+        idx = np.flatnonzero(ok)
+        self.order = idx[np.argsort(slot[idx], kind="stable")]
+        self._slots = slot[self.order]
+        all_slots = np.arange(self.n_slots)
+        self.offsets = np.searchsorted(self._slots, all_slots, side="left")
+        self.counts = np.searchsorted(self._slots, all_slots, side="right") - self.offsets
+
+    @classmethod
+    def from_positions(cls, positions, step, n_slots, mask=None):
+        """Slots regulares [s·step, s·step + step) sobre posições em beats."""
+        b0 = np.arange(int(n_slots)) * step
+        return cls(positions, b0, b0 + step, mask=mask)
+
+    def mean(self, values):
+        """Média por slot ignorando NaN (eixo dos frames = último); NaN em slot vazio.
+
+        Acumula em float64 e devolve no dtype de entrada (float32 para o
+        cromagrama), como o np.mean — os limiares relativos ao pico dependem disso.
+        """
+        values = np.asarray(values)
+        out_dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+        v = values.astype(float)[..., self.order]
+        finite = ~np.isnan(v)
+        out = np.full(v.shape[:-1] + (self.n_slots,), np.nan)
+        nz = np.flatnonzero(self.counts > 0)
+        if len(nz) == 0:
+            return out.astype(out_dtype, copy=False)
+        sums = np.add.reduceat(np.where(finite, v, 0.0), self.offsets[nz], axis=-1)
+        cnt = np.add.reduceat(finite.astype(np.int64), self.offsets[nz], axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[..., nz] = np.where(cnt > 0, sums / np.maximum(cnt, 1), np.nan)
+        return out.astype(out_dtype, copy=False)
+
+    def median(self, values):
+        """Mediana por slot de um array 1-D (mesma regra do np.median); NaN em slot vazio."""
+        v = np.asarray(values, dtype=float)[self.order]
+        out = np.full(self.n_slots, np.nan)
+        nz = np.flatnonzero(self.counts > 0)
+        if len(nz) == 0:
+            return out
+        # ordena por (slot, valor): cada segmento fica ordenado, mediana = meio do segmento
+        v = v[np.lexsort((v, self._slots))]
+        off, cnt = self.offsets[nz], self.counts[nz]
+        lo = v[off + (cnt - 1) // 2]
+        hi = v[off + cnt // 2]
+        out[nz] = (lo + hi) / 2
+        return out
 
 
 def _align_grid_phase(beat_times, onset_times):
@@ -2580,7 +3562,7 @@ def _align_grid_phase(beat_times, onset_times):
     if beat_times is None or len(beat_times) < 4 or onset_times is None or len(onset_times) < 4:
         return beat_times
     try:
-        fracs = np.array([_beat_position(t, beat_times) % 1.0 for t in onset_times])
+        fracs = BeatGrid(beat_times).to_beats(onset_times) % 1.0
         ang = fracs * 2 * np.pi
         c, s = float(np.mean(np.cos(ang))), float(np.mean(np.sin(ang)))
         R = (c * c + s * s) ** 0.5  # concentração 0–1
@@ -2596,67 +3578,31 @@ def _align_grid_phase(beat_times, onset_times):
         return beat_times
 
 
-def _beat_position(t, beat_times):
-    """Tempo (s) → posição em beats usando a grade real (interpola entre beats)."""
-    n = len(beat_times)
-    if n == 0:
-        return 0.0
-    i = int(np.searchsorted(beat_times, t))
-    if i <= 0:
-        bd = (beat_times[1] - beat_times[0]) if n >= 2 else 0.5
-        return (t - beat_times[0]) / (bd + 1e-9)
-    if i >= n:
-        bd = (beat_times[-1] - beat_times[-2]) if n >= 2 else 0.5
-        return (n - 1) + (t - beat_times[-1]) / (bd + 1e-9)
-    b0, b1 = beat_times[i - 1], beat_times[i]
-    return (i - 1) + (t - b0) / (b1 - b0 + 1e-9)
-
-
 def _quantize_events_to_grid(onset_times, strengths, beat_times, max_beats, grid_div=4):
     """Quantiza onsets ao grid real de beats, com velocidade derivada do onset strength."""
-    events = []
-    last_q = -99.0
-    smax = float(np.max(strengths)) if strengths is not None and len(strengths) else 1.0
-    min_gap = (1.0 / grid_div) * 0.5
-    for i, t in enumerate(onset_times):
-        pos = _beat_position(t, beat_times)
-        if pos < -0.25 or pos >= max_beats:
-            continue
-        q = max(0.0, round(pos * grid_div) / grid_div)
-        if abs(q - last_q) < min_gap:
-            continue
-        last_q = q
-        if strengths is not None and i < len(strengths):
-            s = float(strengths[i]) / (smax + 1e-9)
-        else:
-            s = 0.6
-        vel = int(np.clip(45 + s * 80, 35, 127))
-        events.append({
-            "beat": round(float(q), 4),
-            "duration_beats": round(1.0 / grid_div, 4),
-            "velocity": vel,
-        })
-    return events
+    return BeatGrid(beat_times).quantize(onset_times, strengths, max_beats, grid_div)
 
 
-def _extract_drum_stem_events_v2(y_band, sr, beat_times, max_beats, grid_div=4,
-                                 delta=0.07, wait=2, strength_pct=0.0):
-    """Detecta onsets numa banda (aggregate=mean) e quantiza ao grid real.
+def _extract_drum_stem_events_v2(onset_env, sr, beat_times, max_beats, grid_div=4,
+                                 delta=0.07, wait=2, strength_pct=0.0, hop_length=512):
+    """Detecta onsets no envelope de uma banda e quantiza ao grid real.
 
-    Usa mean (não median): no sinal bandpass a maioria dos bins é zero, então a
-    mediana zera o envelope e nenhum onset é detectado (bug que jogava tudo no fallback).
+    `onset_env`: envelope da banda (AnalysisContext.band_onset_envelopes, média
+    do fluxo espectral nos bins da banda); `sr`/`hop_length` do espectrograma de
+    onde ele saiu — mesma taxa de frames, então `wait` vale o mesmo tempo.
 
     strength_pct: descarta onsets cuja força está abaixo do percentil dado — remove o
     ruído de fundo/vazamento entre bandas, mantendo só os hits reais do elemento.
     """
     try:
-        env = librosa.onset.onset_strength(y=y_band, sr=sr)
+        env = onset_env
         frames = librosa.onset.onset_detect(
-            onset_envelope=env, sr=sr, units='frames', backtrack=True, delta=delta, wait=wait
+            onset_envelope=env, sr=sr, hop_length=hop_length, units='frames', backtrack=True,
+            delta=delta, wait=wait
         )
         if len(frames) < 2:
             return []
-        times = librosa.frames_to_time(frames, sr=sr)
+        times = librosa.frames_to_time(frames, sr=sr, hop_length=hop_length)
         strengths = env[frames]
         if strength_pct > 0 and len(strengths) > 4:
             thresh = float(np.percentile(strengths, strength_pct))
@@ -2749,11 +3695,12 @@ def _extract_drum_stem_events(y_band, sr, bpm, max_beats, grid_div=4):
         return []
 
 
-def _extract_kick_from_beats(y_perc, sr, bpm, max_beats):
+def _extract_kick_from_beats(y_perc, sr, bpm, max_beats, ctx=None):
     """Fallback: kick alinhado à grade de beats quando onsets por banda falham."""
     try:
-        _tempo, beat_frames = librosa.beat.beat_track(y=y_perc, sr=sr, bpm=float(bpm))
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr)
+        if ctx is None:
+            ctx = AnalysisContext(y_perc, sr, y_perc=y_perc)
+        _tempo, beat_times = ctx.beats.track('perc', bpm=bpm)
         beat_dur = 60.0 / float(bpm)
         events = []
         for t in beat_times:
@@ -2798,26 +3745,101 @@ def _hz_to_midi_note(hz):
     return int(np.clip(midi, 24, 84))
 
 
-def _extract_bass_pitch_events(y_harm, sr, bpm, key, beat_times, max_beats=32, grid_div=2):
-    """Extrai a bassline com pyin, segmentada por slot do beat grid.
+# Motores de pitch da bassline e do lead: "pyin" (probabilístico, o mais fiel e
+# o mais lento) ou "salience" (soma de harmônicas sobre o |CQT| harmônico que os
+# cromagramas já calculam — sem transformada extra, ordens de grandeza mais rápido)
+PITCH_ENGINES = ("pyin", "salience")
+DEFAULT_PITCH_ENGINE = "pyin"
+# Pesos das harmônicas 1–4 na saliência (decaimento típico de baixo/lead sintetizado)
+SALIENCE_HARMONIC_WEIGHTS = (1.0, 0.8, 0.6, 0.4)
+
+
+def resolve_pitch_engine(engine=None):
+    """Nome do motor de pitch (None = LEGOLAS_PITCH_ENGINE ou DEFAULT_PITCH_ENGINE)."""
+    name = (engine or os.environ.get("LEGOLAS_PITCH_ENGINE") or DEFAULT_PITCH_ENGINE).strip().lower()
+    if name not in PITCH_ENGINES:
+        raise ValueError(f"Motor de pitch desconhecido: {name} (válidos: {', '.join(PITCH_ENGINES)})")
+    return name
+
+
+def _salience_pitch(ctx, fmin, fmax):
+    """f0 por frame pela saliência harmônica no |CQT| compartilhado do contexto.
+
+    Cada candidato na faixa [fmin, fmax] soma as magnitudes das suas harmônicas
+    (bins deslocados de bins_per_octave·log2(h)); o pico é o f0. A confiança do
+    frame é o quanto o pico domina a faixa (1 − média/pico) e o frame só conta
+    como vozeado com energia acima de 10% do p95 da faixa. Mesmo hop do pyin.
+    Retorna (f0, voiced_flag, voiced_prob), f0 = NaN nos frames não vozeados.
+    """
+    C = ctx.cqt()
+    freqs = ctx.cqt_freqs
+    bpo = ctx.CQT_BINS_PER_OCTAVE
+    lo = int(np.searchsorted(freqs, fmin * 0.99))
+    hi = int(np.searchsorted(freqs, fmax * 1.01))
+    sal = np.zeros((hi - lo, C.shape[1]), dtype=np.float32)
+    for h, w in enumerate(SALIENCE_HARMONIC_WEIGHTS, start=1):
+        off = int(round(bpo * np.log2(h)))
+        a, b = lo + off, min(hi + off, C.shape[0])
+        if a >= b:
+            break
+        sal[: b - a] += w * C[a:b]
+    peak_bin = np.argmax(sal, axis=0)
+    peak = sal[peak_bin, np.arange(sal.shape[1])]
+    prob = np.clip(1.0 - sal.mean(axis=0) / (peak + 1e-10), 0.0, 1.0)
+    voiced = (peak >= 0.1 * (np.percentile(peak, 95) + 1e-10)) & (prob >= 0.5)
+    f0 = np.where(voiced, freqs[lo + peak_bin], np.nan)
+    return f0, voiced, prob
+
+
+def _track_pitch(y_harm, sr, band, fmin, fmax, engine, ctx, label):
+    """Trilha de pitch monofônica pelo motor escolhido, na taxa de frames do hop 512.
+
+    `band`: passa-faixa (Hz) aplicado antes do pyin, que roda no nível da
+    pirâmide do contexto que cobre a banda; o motor de saliência já recorta a
+    faixa nos bins do CQT. Retorna (times, f0, voiced, voiced_prob).
+    """
+    if ctx is None:
+        ctx = AnalysisContext(y_harm, sr, y_harm=y_harm)
+    hop = ctx.HOP_LENGTH
+    if engine == "salience":
+        with _profile(f"salience.{label}"):
+            f0, voiced, voiced_prob = _salience_pitch(ctx, fmin, fmax)
+    else:
+        # pyin no menor nível da pirâmide que cobre a banda (baixo: 2756 Hz),
+        # sobre a banda servida pela STFT do nível (memoizada: o lead de várias
+        # camadas não refaz STFT/ISTFT)
+        y_band, sr, spec = ctx.band_signals({label: band})[label]
+        hop = spec["hop_length"]
+        with _profile(f"pyin.{label}"):
+            f0, voiced_flag, voiced_prob = librosa.pyin(
+                y_band, fmin=fmin, fmax=fmax, sr=sr, frame_length=spec["n_fft"], fill_na=np.nan,
+                hop_length=hop
+            )
+        voiced = np.asarray(voiced_flag, dtype=bool) & ~np.isnan(f0)
+    times = librosa.frames_to_time(np.arange(len(f0)), sr=sr, hop_length=hop)
+    return times, f0, voiced, voiced_prob
+
+
+def _extract_bass_pitch_events(y_harm, sr, bpm, key, beat_times, max_beats=32, grid_div=2,
+                               engine=DEFAULT_PITCH_ENGINE, ctx=None):
+    """Extrai a bassline pelo motor de pitch (pyin por padrão), por slot do beat grid.
 
     Para cada slot (colcheia por padrão) coleta os f0 vozeados e usa a MEDIANA —
     robusto a outliers, evita os pulos do método frame-a-frame. Notas iguais
     consecutivas são sustentadas. Retorna (events, confidence), confiança = voiced_prob.
     """
     try:
-        y_bass = _bandpass_istft(y_harm, sr, 35, 280)
-        hop = 512
-        f0, voiced_flag, voiced_prob = librosa.pyin(
-            y_bass, fmin=librosa.note_to_hz('C1'), fmax=librosa.note_to_hz('C3'),
-            sr=sr, fill_na=np.nan, hop_length=hop
+        times, f0, voiced, voiced_prob = _track_pitch(
+            y_harm, sr, (35, 280), librosa.note_to_hz('C1'), librosa.note_to_hz('C3'),
+            engine, ctx, "bass"
         )
-        times = librosa.frames_to_time(np.arange(len(f0)), sr=sr, hop_length=hop)
-        positions = np.array([_beat_position(t, beat_times) for t in times])
-        voiced = np.asarray(voiced_flag, dtype=bool) & ~np.isnan(f0)
+        positions = BeatGrid(beat_times).to_beats(times)
 
         step = 1.0 / grid_div
         n_slots = int(max_beats * grid_div)
+        groups = SlotGroups.from_positions(positions, step, n_slots, mask=voiced)
+        slot_f0 = groups.median(f0)
+        slot_prob = groups.mean(voiced_prob) if voiced_prob is not None else None
         events = []
         used_probs = []
         last_midi = None
@@ -2826,16 +3848,15 @@ def _extract_bass_pitch_events(y_harm, sr, bpm, key, beat_times, max_beats=32, g
         for s in range(n_slots):
             b0 = s * step
             b1 = b0 + step
-            mask = voiced & (positions >= b0) & (positions < b1)
-            if not np.any(mask):
+            if groups.counts[s] == 0:
                 last_midi = None  # silêncio corta o sustain
                 continue
-            midi = _hz_to_midi_note(float(np.median(f0[mask])))
+            midi = _hz_to_midi_note(float(slot_f0[s]))
             if midi is None:
                 last_midi = None
                 continue
-            if voiced_prob is not None:
-                pr = float(np.nanmean(voiced_prob[mask]))
+            if slot_prob is not None:
+                pr = float(slot_prob[s])
                 if not np.isnan(pr):
                     used_probs.append(pr)
             else:
@@ -2898,9 +3919,11 @@ def _pc_to_midi(pc, octave):
     return int(np.clip((octave + 2) * 12 + (pc % 12), 36, 96))
 
 
-def _chroma_for_band(y_harm, sr, fmin, fmax, hop_length=512):
-    y_band = _bandpass_istft(y_harm, sr, fmin, fmax)
-    return librosa.feature.chroma_cqt(y=y_band, sr=sr, hop_length=hop_length)
+def _chroma_for_band(y_harm, sr, fmin, fmax, ctx=None):
+    """Cromagrama da banda [fmin, fmax] recortado do CQT harmônico compartilhado."""
+    if ctx is None:
+        ctx = AnalysisContext(y_harm, sr, y_harm=y_harm)
+    return ctx.chroma(fmin, fmax)
 
 
 def _layer_to_synth_stem_key(layer):
@@ -2919,23 +3942,26 @@ def _layer_to_synth_stem_key(layer):
     return None
 
 
-def _extract_pad_chroma_events(y_harm, sr, bpm, key, max_beats):
+def _extract_pad_chroma_events(y_harm, sr, bpm, key, max_beats, ctx=None):
     """Pads: acordes por compasso a partir do cromagrama (grave-médio)."""
     try:
-        chroma = _chroma_for_band(y_harm, sr, 180, 1400)
+        chroma = _chroma_for_band(y_harm, sr, 180, 1400, ctx=ctx)
         root, is_minor = _parse_key_root(key)
         hop = 512
         times = librosa.frames_to_time(np.arange(chroma.shape[1]), sr=sr, hop_length=hop)
         beat_dur = 60.0 / float(bpm)
+        bar_starts = np.arange(0, max_beats, 4.0)
+        bar_ends = np.minimum(bar_starts + 4.0, max_beats)
+        groups = SlotGroups(times, bar_starts * beat_dur, bar_ends * beat_dur)
+        bar_means = groups.mean(chroma)
         events = []
 
-        bar_start = 0.0
-        while bar_start < max_beats:
-            bar_end = min(bar_start + 4.0, max_beats)
-            mask = (times >= bar_start * beat_dur) & (times < bar_end * beat_dur)
-            if not np.any(mask):
+        for s, bar_start in enumerate(bar_starts):
+            bar_start = float(bar_start)
+            bar_end = float(bar_ends[s])
+            if groups.counts[s] == 0:
                 break
-            bar_chroma = np.mean(chroma[:, mask], axis=1)
+            bar_chroma = bar_means[:, s]
             peak = float(np.max(bar_chroma) + 1e-10)
             threshold = peak * 0.5
 
@@ -2949,7 +3975,6 @@ def _extract_pad_chroma_events(y_harm, sr, bpm, key, max_beats):
             active_pcs = active_pcs[:4]
 
             if len(active_pcs) < 2:
-                bar_start += 4.0
                 continue
 
             vel_base = int(np.clip(55 + peak * 120, 50, 100))
@@ -2960,7 +3985,6 @@ def _extract_pad_chroma_events(y_harm, sr, bpm, key, max_beats):
                     "midi": _pc_to_midi(pc, 3 + (i // 2)),
                     "velocity": vel_base - i * 4,
                 })
-            bar_start += 4.0
 
         return events
     except Exception as e:
@@ -2968,27 +3992,27 @@ def _extract_pad_chroma_events(y_harm, sr, bpm, key, max_beats):
         return []
 
 
-def _extract_lead_pitch_events(y_harm, sr, key, beat_times, max_beats, grid_div=2):
-    """Lead/melodia via pyin na região média-aguda, segmentado por slot do grid.
+def _extract_lead_pitch_events(y_harm, sr, key, beat_times, max_beats, grid_div=2,
+                               engine=DEFAULT_PITCH_ENGINE, ctx=None):
+    """Lead/melodia pelo motor de pitch na região média-aguda, por slot do grid.
 
     Mais fiel que o argmax do cromagrama para uma melodia monofônica. A polifonia
     ainda limita a precisão, por isso o stem é marcado como 'estimated'.
     Retorna (events, confidence).
     """
     try:
-        y_mid = _bandpass_istft(y_harm, sr, 250, 2500)
-        hop = 512
-        f0, voiced_flag, voiced_prob = librosa.pyin(
-            y_mid, fmin=librosa.note_to_hz('C3'), fmax=librosa.note_to_hz('C6'),
-            sr=sr, fill_na=np.nan, hop_length=hop
+        times, f0, voiced, voiced_prob = _track_pitch(
+            y_harm, sr, (250, 2500), librosa.note_to_hz('C3'), librosa.note_to_hz('C6'),
+            engine, ctx, "lead"
         )
-        times = librosa.frames_to_time(np.arange(len(f0)), sr=sr, hop_length=hop)
-        positions = np.array([_beat_position(t, beat_times) for t in times])
-        voiced = np.asarray(voiced_flag, dtype=bool) & ~np.isnan(f0)
+        positions = BeatGrid(beat_times).to_beats(times)
         root, is_minor = _parse_key_root(key)
 
         step = 1.0 / grid_div
         n_slots = int(max_beats * grid_div)
+        groups = SlotGroups.from_positions(positions, step, n_slots, mask=voiced)
+        slot_f0 = groups.median(f0)
+        slot_prob = groups.mean(voiced_prob) if voiced_prob is not None else None
         events = []
         used_probs = []
         last_midi = None
@@ -2996,11 +4020,10 @@ def _extract_lead_pitch_events(y_harm, sr, key, beat_times, max_beats, grid_div=
 
         for s in range(n_slots):
             b0 = s * step
-            mask = voiced & (positions >= b0) & (positions < b0 + step)
-            if not np.any(mask):
+            if groups.counts[s] == 0:
                 last_midi = None
                 continue
-            hz = float(np.median(f0[mask]))
+            hz = float(slot_f0[s])
             if hz <= 0 or np.isnan(hz):
                 last_midi = None
                 continue
@@ -3009,7 +4032,7 @@ def _extract_lead_pitch_events(y_harm, sr, key, beat_times, max_beats, grid_div=
             pc = _snap_pc_to_scale(midi % 12, root, is_minor)
             midi = (midi // 12) * 12 + pc
             midi = int(np.clip(midi, 48, 96))
-            pr = float(np.nanmean(voiced_prob[mask])) if voiced_prob is not None else 0.5
+            pr = float(slot_prob[s]) if slot_prob is not None else 0.5
             if not np.isnan(pr):
                 used_probs.append(pr)
             if last_midi == midi and last_ev is not None:
@@ -3027,43 +4050,40 @@ def _extract_lead_pitch_events(y_harm, sr, key, beat_times, max_beats, grid_div=
         conf = round(float(np.mean(used_probs)), 2) if used_probs else 0.0
         return events, conf
     except Exception as e:
-        sys.stderr.write(f"[Warning] extração lead/pyin falhou: {e}\n")
+        sys.stderr.write(f"[Warning] extração lead/{engine} falhou: {e}\n")
         return [], 0.0
 
 
-def _extract_lead_chroma_events(y_harm, sr, bpm, key, max_beats):
+def _extract_lead_chroma_events(y_harm, sr, bpm, key, max_beats, ctx=None):
     """Lead: melodia dominante por colcheia (cromagrama médio-agudo)."""
     try:
-        chroma = _chroma_for_band(y_harm, sr, 700, 6000)
+        chroma = _chroma_for_band(y_harm, sr, 700, 6000, ctx=ctx)
         root, is_minor = _parse_key_root(key)
         hop = 512
         times = librosa.frames_to_time(np.arange(chroma.shape[1]), sr=sr, hop_length=hop)
         beat_dur = 60.0 / float(bpm)
         grid = 1.0 if max_beats > 768 else 0.5
+        beats = np.arange(0, max_beats, grid)
+        groups = SlotGroups(times, beats * beat_dur, (beats + grid) * beat_dur)
+        seg_means = groups.mean(chroma)
+        seg_argmax = np.argmax(np.nan_to_num(seg_means, nan=-1.0), axis=0)
         events = []
         last_pc = None
         last_beat = -1.0
 
-        beat = 0.0
-        while beat < max_beats:
-            t0 = beat * beat_dur
-            t1 = (beat + grid) * beat_dur
-            mask = (times >= t0) & (times < t1)
-            if not np.any(mask):
-                beat += grid
+        for s, beat in enumerate(beats):
+            beat = float(beat)
+            if groups.counts[s] == 0:
                 continue
 
-            seg = np.mean(chroma[:, mask], axis=1)
+            seg = seg_means[:, s]
             peak = float(np.max(seg) + 1e-10)
             if peak < 0.08:
-                beat += grid
                 continue
 
-            pc = int(np.argmax(seg))
-            pc = _snap_pc_to_scale(pc, root, is_minor)
+            pc = _snap_pc_to_scale(int(seg_argmax[s]), root, is_minor)
 
             if pc == last_pc and abs(beat - last_beat) < grid * 0.9:
-                beat += grid
                 continue
 
             vel = int(np.clip(65 + (seg[pc] / peak) * 45, 55, 115))
@@ -3076,7 +4096,6 @@ def _extract_lead_chroma_events(y_harm, sr, bpm, key, max_beats):
             })
             last_pc = pc
             last_beat = beat
-            beat += grid
 
         return events
     except Exception as e:
@@ -3084,38 +4103,37 @@ def _extract_lead_chroma_events(y_harm, sr, bpm, key, max_beats):
         return []
 
 
-def _extract_arp_chroma_events(y_harm, sr, bpm, key, max_beats):
+def _extract_arp_chroma_events(y_harm, sr, bpm, key, max_beats, ctx=None):
     """Arp: sequência de notas em semicolcheias (cromagrama agudo)."""
     try:
-        chroma = _chroma_for_band(y_harm, sr, 1800, 9000)
+        chroma = _chroma_for_band(y_harm, sr, 1800, 9000, ctx=ctx)
         root, is_minor = _parse_key_root(key)
         hop = 512
         times = librosa.frames_to_time(np.arange(chroma.shape[1]), sr=sr, hop_length=hop)
         beat_dur = 60.0 / float(bpm)
         # Faixas longas: colcheias em vez de semicolcheias (menos eventos, mesma cobertura)
         grid = 0.5 if max_beats > 512 else 0.25
+        beats = np.arange(0, max_beats, grid)
+        groups = SlotGroups(times, beats * beat_dur, (beats + grid) * beat_dur)
+        seg_means = groups.mean(chroma)
+        seg_argmax = np.argmax(np.nan_to_num(seg_means, nan=-1.0), axis=0)
         events = []
 
-        beat = 0.0
         degree = 0
         arp_degrees = [0, 3, 5, 7] if is_minor else [0, 2, 4, 7]
 
-        while beat < max_beats:
-            t0 = beat * beat_dur
-            t1 = (beat + grid) * beat_dur
-            mask = (times >= t0) & (times < t1)
-            if not np.any(mask):
-                beat += grid
+        for s, beat in enumerate(beats):
+            beat = float(beat)
+            if groups.counts[s] == 0:
                 continue
 
-            seg = np.mean(chroma[:, mask], axis=1)
+            seg = seg_means[:, s]
             peak = float(np.max(seg) + 1e-10)
             if peak < 0.06:
-                beat += grid
                 degree += 1
                 continue
 
-            detected_pc = int(np.argmax(seg))
+            detected_pc = int(seg_argmax[s])
             scale_pc = _snap_pc_to_scale(
                 (root + arp_degrees[degree % len(arp_degrees)]) % 12, root, is_minor
             )
@@ -3129,7 +4147,6 @@ def _extract_arp_chroma_events(y_harm, sr, bpm, key, max_beats):
                 "velocity": vel,
             })
             degree += 1
-            beat += grid
 
         return events
     except Exception as e:
@@ -3137,23 +4154,24 @@ def _extract_arp_chroma_events(y_harm, sr, bpm, key, max_beats):
         return []
 
 
-def _extract_texture_chroma_events(y_harm, sr, bpm, key, max_beats):
+def _extract_texture_chroma_events(y_harm, sr, bpm, key, max_beats, ctx=None):
     """Textura/FX: notas sustentadas esparsas do cromagrama amplo."""
     try:
-        chroma = _chroma_for_band(y_harm, sr, 400, 10000)
+        chroma = _chroma_for_band(y_harm, sr, 400, 10000, ctx=ctx)
         root, is_minor = _parse_key_root(key)
         hop = 512
         times = librosa.frames_to_time(np.arange(chroma.shape[1]), sr=sr, hop_length=hop)
         beat_dur = 60.0 / float(bpm)
+        bar_starts = np.arange(0, max_beats, 8.0)
+        groups = SlotGroups(times, bar_starts * beat_dur,
+                            np.minimum(bar_starts + 8.0, max_beats) * beat_dur)
+        bar_means = groups.mean(chroma)
         events = []
 
-        for bar_start in np.arange(0, max_beats, 8.0):
-            t0 = bar_start * beat_dur
-            t1 = min((bar_start + 8.0), max_beats) * beat_dur
-            mask = (times >= t0) & (times < t1)
-            if not np.any(mask):
+        for s, bar_start in enumerate(bar_starts):
+            if groups.counts[s] == 0:
                 continue
-            seg = np.mean(chroma[:, mask], axis=1)
+            seg = bar_means[:, s]
             pc = _snap_pc_to_scale(int(np.argmax(seg)), root, is_minor)
             vel = int(np.clip(45 + float(np.max(seg)) * 80, 40, 85))
             events.append({
@@ -3176,20 +4194,30 @@ def _extract_texture_chroma_events(y_harm, sr, bpm, key, max_beats):
         return []
 
 
-def _extract_synth_layers_chroma(y_harm, sr, bpm, key, max_beats, synth_layers, beat_times=None):
+def _extract_synth_layers_chroma(y_harm, sr, bpm, key, max_beats, synth_layers, beat_times=None,
+                                 ctx=None, pitch_engine=DEFAULT_PITCH_ENGINE, engines=None):
     """Extrai MIDI de pads/leads/arps/texturas via cromagrama por camada detectada.
 
-    O lead usa pyin (melodia monofônica, mais fiel) quando há beat grid,
-    caindo no cromagrama quando a melodia não é confiável.
+    O lead usa o motor de pitch (melodia monofônica, mais fiel) quando há beat
+    grid, caindo no cromagrama quando a melodia não é confiável. Todos os
+    cromagramas saem do mesmo CQT harmônico do contexto. `engines` (dict opcional)
+    recebe o motor de pitch dos stems que saíram dele (hoje só synth_lead).
     """
     stems = {}
+    if ctx is None:
+        ctx = AnalysisContext(y_harm, sr, y_harm=y_harm)
 
-    def _lead_extractor(yh, s, b, k, mb):
+    def _lead_extractor(yh, s, b, k, mb, ctx=None):
         if beat_times is not None:
-            ev, _conf = _extract_lead_pitch_events(yh, s, k, beat_times, mb)
+            ev, _conf = _extract_lead_pitch_events(yh, s, k, beat_times, mb,
+                                                   engine=pitch_engine, ctx=ctx)
             if len(ev) >= 3:
+                if engines is not None:
+                    engines["synth_lead"] = pitch_engine
                 return ev
-        return _extract_lead_chroma_events(yh, s, b, k, mb)
+        if engines is not None:
+            engines.pop("synth_lead", None)
+        return _extract_lead_chroma_events(yh, s, b, k, mb, ctx=ctx)
 
     extractors = {
         "synth_pad": _extract_pad_chroma_events,
@@ -3214,7 +4242,8 @@ def _extract_synth_layers_chroma(y_harm, sr, bpm, key, max_beats, synth_layers,
         fn = extractors.get(stem_key)
         if not fn:
             continue
-        raw = fn(y_harm, sr, bpm, key, max_beats)
+        with _profile(f"synth.{stem_key}"):
+            raw = fn(y_harm, sr, bpm, key, max_beats, ctx=ctx)
         if len(raw) >= min_events.get(stem_key, 2):
             stems[stem_key] = raw
 
@@ -3222,18 +4251,68 @@ def _extract_synth_layers_chroma(y_harm, sr, bpm, key, max_beats, synth_layers,
     for stem_key, fn in extractors.items():
         if stem_key in stems:
             continue
-        raw = fn(y_harm, sr, bpm, key, max_beats)
+        with _profile(f"synth.{stem_key}.fallback"):
+            raw = fn(y_harm, sr, bpm, key, max_beats, ctx=ctx)
         if len(raw) >= min_events.get(stem_key, 2):
             stems[stem_key] = raw
 
     return stems
 
 
-def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers=None):
+# banda (fmin, fmax), grid_div, delta, wait, strength_pct (filtro de força)
+# Bandas estreitas e pouco sobrepostas + filtro de força evitam que um
+# elemento capte os hits dos outros (que gerava stems densos = ruído).
+DRUM_BANDS = {
+    "kick": (30, 110, 4, 0.12, 5, 35),
+    "snare_clap": (180, 450, 4, 0.10, 4, 65),
+    "hihats": (7000, 13000, 8, 0.06, 2, 45),
+    "cymbals_rides": (9000, 18000, 8, 0.08, 6, 70),
+    "percussion": (1000, 4000, 8, 0.10, 3, 70),
+    "fills": (250, 2500, 16, 0.12, 2, 85),
+}
+
+
+def _drum_band_ranges(sr, sr_top=None):
+    """Bandas (fmin, fmax) dos onsets da bateria, ajustadas ao Nyquist disponível.
+
+    Inclui as auxiliares "kick_phase" (fase da grade) e "hihats_wide" (fallback
+    de hi-hats). `sr_top`: topo da pirâmide, quando a faixa foi decodificada nele.
+    """
+    # Nyquist do sr (adaptativo): faixas longas usam sr baixo (ex. 11025 → 5512 Hz).
+    # Com o topo da pirâmide (ctx.y_top) as bandas de hihat/cymbal sobem para ele;
+    # sem ele, bandas acima do Nyquist precisam ser rebaixadas, senão somem.
+    nyq = (sr_top or sr) * 0.48
+    band_ranges = {}
+    for stem_key, (fmin, fmax, *_rest) in DRUM_BANDS.items():
+        fmax_eff = min(float(fmax), nyq)
+        fmin_eff = float(fmin)
+        if fmax_eff < fmax and fmin_eff >= fmax_eff - 200:
+            # Banda inteira acima do Nyquist (sr baixo de faixa longa).
+            # Cymbals não se distinguem de hi-hats nesse caso → não duplica.
+            if stem_key == "cymbals_rides":
+                continue
+            # Hi-hats: rebaixa para captar o corpo do som no topo do espectro.
+            fmin_eff = max(2500.0, nyq * 0.6)
+            fmax_eff = nyq
+        band_ranges[stem_key] = (fmin_eff, fmax_eff)
+    # Fase da grade (kick largo, ctx.beats.aligned_grid) e fallback de hi-hats (banda larga)
+    band_ranges["kick_phase"] = (20.0, 120.0)
+    band_ranges["hihats_wide"] = (2000.0, min(16000.0, nyq))
+    return band_ranges
+
+
+def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers=None,
+                            y_harm=None, y_perc=None, ctx=None, pitch_engine=None):
     """
     Extrai eventos MIDI por stem a partir do áudio (faixa inteira, não templates).
+
+    Reaproveita o HPSS já calculado (via `ctx` ou `y_harm`/`y_perc`); só roda
+    o HPSS quando chamado isoladamente, sem nenhum dos dois. `pitch_engine`:
+    motor da bassline e do lead (ver PITCH_ENGINES; None = resolve_pitch_engine),
+    gravado em stem_meta[...]["engine"] dos stems que ele produziu.
     """
     try:
+        pitch_engine = resolve_pitch_engine(pitch_engine)
         if not bpm or bpm <= 0:
             bpm = 128.0
         beat_dur = 60.0 / float(bpm)
@@ -3241,20 +4320,21 @@ def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers
         # Teto de segurança (~32 min a 200 BPM)
         max_beats = min(float(total_beats), 4096.0)
 
-        y_harm, y_perc = librosa.effects.hpss(y)
+        if ctx is None:
+            ctx = AnalysisContext(y, sr, y_harm=y_harm, y_perc=y_perc)
+        y_harm, y_perc = ctx.y_harm, ctx.y_perc
 
-        # Grade de beats ancorada ao BPM (corrige drift na quantização)
-        beat_times = _build_beat_grid(y_perc, sr, bpm, max_beats)
-        # Alinhar a fase da grade ao kick para o groove cair no downbeat correto
-        try:
-            _y_kick = _bandpass_istft(y_perc, sr, 20, 120)
-            _kf = librosa.onset.onset_detect(
-                onset_envelope=librosa.onset.onset_strength(y=_y_kick, sr=sr),
-                sr=sr, backtrack=True, delta=0.10, wait=4
-            )
-            beat_times = _align_grid_phase(beat_times, librosa.frames_to_time(_kf, sr=sr))
-        except Exception:
-            pass
+        band_ranges = _drum_band_ranges(sr, ctx.sr_top)
+
+        # Envelopes de onset de todas as bandas de um só espectrograma do percussivo
+        # (sem ressintetizar banda por banda)
+        with _profile("drums.onsets"):
+            band_envs = ctx.band_onset_envelopes(band_ranges)
+
+        # Grade de beats ancorada ao BPM (corrige drift na quantização), com a
+        # fase alinhada ao kick para o groove cair no downbeat correto
+        with _profile("beat_grid"):
+            beat_times = ctx.beats.aligned_grid(bpm, max_beats)
 
         # GM drum note numbers
         GM = {
@@ -3266,81 +4346,60 @@ def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers
         # Metadados de fidelidade por stem: {"confidence": 0–1, "method": "detected"|"estimated"}
         stem_meta = {}
 
-        # banda (fmin, fmax), grid_div, delta, wait, strength_pct (filtro de força)
-        # Bandas estreitas e pouco sobrepostas + filtro de força evitam que um
-        # elemento capte os hits dos outros (que gerava stems densos = ruído).
-        drum_bands = {
-            "kick": (30, 110, 4, 0.12, 5, 35),
-            "snare_clap": (180, 450, 4, 0.10, 4, 65),
-            "hihats": (7000, 13000, 8, 0.06, 2, 45),
-            "cymbals_rides": (9000, 18000, 8, 0.08, 6, 70),
-            "percussion": (1000, 4000, 8, 0.10, 3, 70),
-            "fills": (250, 2500, 16, 0.12, 2, 85),
-        }
-
-        def _band_has_signal(y_band, floor=0.025):
-            return float(np.max(np.abs(y_band))) > floor
-
-        # Nyquist do sr (adaptativo): faixas longas usam sr baixo (ex. 11025 → 5512 Hz),
-        # então bandas de hihat/cymbal acima disso precisam ser rebaixadas, senão somem.
-        nyq = sr * 0.48
-
-        for stem_key, (fmin, fmax, grid, delta, wait, spct) in drum_bands.items():
+        for stem_key, (fmin, fmax, grid, delta, wait, spct) in DRUM_BANDS.items():
+            if stem_key not in band_ranges:
+                continue
             flagged = drums.get(stem_key, {}).get("present", False)
-            fmax_eff = min(float(fmax), nyq)
-            fmin_eff = float(fmin)
-            if fmin_eff >= fmax_eff - 200:
-                # Banda inteira acima do Nyquist (sr baixo de faixa longa).
-                # Cymbals não se distinguem de hi-hats nesse caso → não duplica.
-                if stem_key == "cymbals_rides":
+            with _profile(f"drums.{stem_key}"):
+                env, sr_band, hop_band = band_envs[stem_key]
+                # Banda sem energia nenhuma → fluxo espectral todo zero
+                if not flagged and not np.any(env > 0):
                     continue
-                # Hi-hats: rebaixa para captar o corpo do som no topo do espectro.
-                fmin_eff = max(2500.0, nyq * 0.6)
-                fmax_eff = nyq
-            y_band = _bandpass_istft(y_perc, sr, fmin_eff, fmax_eff)
-            if not flagged and not _band_has_signal(y_band):
-                continue
-            method = "detected"
-            raw_events = _extract_drum_stem_events_v2(
-                y_band, sr, beat_times, max_beats, grid_div=grid, delta=delta, wait=wait,
-                strength_pct=spct
-            )
-            # Fallbacks só quando a detecção real falha de vez (marcados como estimados)
-            if len(raw_events) < 2 and stem_key == "kick":
-                raw_events = _extract_kick_from_beats(y_perc, sr, bpm, max_beats)
-                method = "estimated"
-            elif len(raw_events) < 2 and stem_key == "snare_clap":
-                raw_events = _extract_backbeat_snare(y_perc, sr, bpm, max_beats)
-                method = "estimated"
-            elif len(raw_events) < 2 and stem_key == "hihats":
-                y_wide = _bandpass_istft(y_perc, sr, 2000, 16000)
+                method = "detected"
                 raw_events = _extract_drum_stem_events_v2(
-                    y_wide, sr, beat_times, max_beats, grid_div=grid, delta=0.05, wait=2,
-                    strength_pct=40
+                    env, sr_band, beat_times, max_beats, grid_div=grid, delta=delta, wait=wait,
+                    strength_pct=spct, hop_length=hop_band
                 )
-            if len(raw_events) < 2:
-                continue
-            midi_num = GM.get(stem_key, 36)
-            for ev in raw_events:
-                ev["midi"] = midi_num
-            stems[stem_key] = raw_events
-            if method == "estimated":
-                conf = 0.4
-            else:
-                conf = _stem_confidence_from_coverage(raw_events, max_beats, grid, ceiling=0.92)
-            stem_meta[stem_key] = {"confidence": conf, "method": method}
+                # Fallbacks só quando a detecção real falha de vez (marcados como estimados)
+                if len(raw_events) < 2 and stem_key == "kick":
+                    raw_events = _extract_kick_from_beats(y_perc, sr, bpm, max_beats, ctx=ctx)
+                    method = "estimated"
+                elif len(raw_events) < 2 and stem_key == "snare_clap":
+                    raw_events = _extract_backbeat_snare(y_perc, sr, bpm, max_beats)
+                    method = "estimated"
+                elif len(raw_events) < 2 and stem_key == "hihats":
+                    env_wide, sr_band, hop_band = band_envs["hihats_wide"]
+                    raw_events = _extract_drum_stem_events_v2(
+                        env_wide, sr_band, beat_times, max_beats, grid_div=grid, delta=0.05, wait=2,
+                        strength_pct=40, hop_length=hop_band
+                    )
+                if len(raw_events) < 2:
+                    continue
+                midi_num = GM.get(stem_key, 36)
+                for ev in raw_events:
+                    ev["midi"] = midi_num
+                stems[stem_key] = raw_events
+                if method == "estimated":
+                    conf = 0.4
+                else:
+                    conf = _stem_confidence_from_coverage(raw_events, max_beats, grid, ceiling=0.92)
+                stem_meta[stem_key] = {"confidence": conf, "method": method}
 
         # Baixo: sempre tentar extrair pitch; usar flags só para variantes sub/mid
-        bass_events, bass_conf = _extract_bass_pitch_events(y_harm, sr, bpm, key, beat_times, max_beats)
+        with _profile("bass"):
+            bass_events, bass_conf = _extract_bass_pitch_events(
+                y_harm, sr, bpm, key, beat_times, max_beats, engine=pitch_engine, ctx=ctx
+            )
         if len(bass_events) >= 2:
             stems["bassline"] = bass_events
-            stem_meta["bassline"] = {"confidence": bass_conf, "method": "detected"}
+            stem_meta["bassline"] = {"confidence": bass_conf, "method": "detected", "engine": pitch_engine}
             if bass.get("mid_bass", {}).get("present", True):
                 stems["mid_bass"] = [
                     {**ev, "midi": min(127, ev["midi"] + 12)} for ev in bass_events
                 ]
                 # Derivado da bassline (oitava acima): confiança levemente menor
-                stem_meta["mid_bass"] = {"confidence": round(bass_conf * 0.9, 2), "method": "detected"}
+                stem_meta["mid_bass"] = {"confidence": round(bass_conf * 0.9, 2), "method": "detected",
+                                         "engine": pitch_engine}
             if bass.get("sub_bass", {}).get("present", True):
                 root_midi = bass_events[0]["midi"]
                 stems["sub_bass"] = [
@@ -3352,12 +4411,16 @@ def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers
                     }
                     for ev in bass_events
                 ]
-                stem_meta["sub_bass"] = {"confidence": round(bass_conf * 0.85, 2), "method": "detected"}
-
-        # Synths: pads, leads, arps, texturas via cromagrama harmônico (lead via pyin)
-        synth_stems = _extract_synth_layers_chroma(
-            y_harm, sr, bpm, key, max_beats, synth_layers, beat_times=beat_times
-        )
+                stem_meta["sub_bass"] = {"confidence": round(bass_conf * 0.85, 2), "method": "detected",
+                                         "engine": pitch_engine}
+
+        # Synths: pads, leads, arps, texturas via cromagrama harmônico (lead via motor de pitch)
+        synth_engines = {}
+        with _profile("synths"):
+            synth_stems = _extract_synth_layers_chroma(
+                y_harm, sr, bpm, key, max_beats, synth_layers, beat_times=beat_times, ctx=ctx,
+                pitch_engine=pitch_engine, engines=synth_engines
+            )
         stems.update(synth_stems)
         # Synths vêm do cromagrama (classe de altura, não nota real) → método "estimated",
         # com teto de confiança menor por stem conforme a dificuldade.
@@ -3371,6 +4434,8 @@ def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers
                 "confidence": _stem_confidence_from_coverage(events, max_beats, 4, ceiling=ceiling),
                 "method": "estimated",
             }
+            if stem_key in synth_engines:
+                stem_meta[stem_key]["engine"] = synth_engines[stem_key]
 
         bars = max(1, int(np.ceil(max_beats / 4)))
 
@@ -3390,174 +4455,1536 @@ def extract_midi_from_audio(y, sr, duration, bpm, key, drums, bass, synth_layers
 
 
 # ──────────────────────────────────────────────────────────────────
-# FUNÇÃO PRINCIPAL
+# ANÁLISE EM STREAMING (mixes longos, memória constante)
 # ──────────────────────────────────────────────────────────────────
 
-def analyze_audio(file_path):
-    """Função principal de análise completa."""
-    try:
-        if not os.path.exists(file_path):
-            return {"success": False, "error": f"Arquivo não encontrado: {file_path}"}
+# Acima disso a carga completa sugere (no log) o modo streaming — que é só opt-in
+# (--stream, ou "stream" no job do --serve): o resultado dele não traz
+# bateria/baixo/synths/arranjo/MIDI
+STREAMING_MIN_DURATION = 1800.0
 
-        import time as _time
-        t0 = _time.time()
+# `streaming` que escolhe o modo pela duração, lida só num miss do cache
+# (--stream-auto, ou "stream": "auto" no job; é o que a rota /api/analyze-music pede)
+STREAMING_AUTO = "auto"
 
-        # Obter duração real do arquivo ANTES de carregar (sem limite)
-        real_duration = librosa.get_duration(path=file_path)
-        sys.stderr.write(f"[Info] Duração real do arquivo: {real_duration:.1f}s ({real_duration/60:.1f} min)\n")
+# Saídas que o streaming calcula; as demais saem marcadas como indisponíveis
+STREAMING_OUTPUTS = ("bpm", "key", "loudness", "frequency_analysis", "structure", "dynamics")
 
-        # Carregar áudio (mono) - ajustar sr baseado no tamanho/duração
-        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        # Para arquivos muito longos (>10min) ou grandes (>50MB), usar sr menor para economia de memória
-        if real_duration > 600 or file_size_mb > 50:
-            target_sr = 11025
-        elif real_duration > 300 or file_size_mb > 25:
-            target_sr = 16000
-        else:
-            target_sr = 22050
-        y, sr = librosa.load(file_path, sr=target_sr, mono=True)
-        duration = librosa.get_duration(y=y, sr=sr)
 
-        t_load = _time.time()
-        sys.stderr.write(f"[Perf] Carregamento mono: {t_load - t0:.1f}s (sr={sr}, size={file_size_mb:.0f}MB)\n")
+class StreamingContext(AnalysisContext):
+    """
+    Contexto montado a partir das curvas acumuladas bloco a bloco, sem o sinal.
 
-        # Pré-computar HPSS uma única vez (operação cara)
-        y_harm, y_perc = librosa.effects.hpss(y)
+    Expõe só o que as análises de energia/estrutura consomem: RMS, bandwidth e
+    MFCC por frame, e o espectro médio. `magnitude('full')` devolve esse espectro
+    médio como uma coluna (bins × 1) — a média por banda (np.mean(D[mask, :]))
+    sai idêntica à do espectrograma completo. Análises que precisam do sinal ou
+    do HPSS não rodam neste modo.
+    """
 
-        t_hpss = _time.time()
-        sys.stderr.write(f"[Perf] HPSS: {t_hpss - t_load:.1f}s\n")
+    def __init__(self, sr, n_fft, hop_length, mean_spectrum, rms, bandwidth, mfcc):
+        super().__init__(None, sr)
+        self.N_FFT = n_fft
+        self.HOP_LENGTH = hop_length
+        self._cache.update({
+            ('mag', 'full'): mean_spectrum[:, None],
+            'rms': rms,
+            ('bandwidth', 'full'): bandwidth[None, :],
+            ('mfcc', mfcc.shape[0]): mfcc,
+        })
+
+    def _ensure_hpss(self):
+        raise RuntimeError("HPSS indisponível no modo streaming")
 
-        # Tentar carregar em estéreo para análise de mix (usar sr menor)
-        try:
-            y_stereo, sr_stereo = librosa.load(file_path, sr=target_sr, mono=False)
-        except Exception:
-            y_stereo = None
 
-        t_stereo = _time.time()
-        sys.stderr.write(f"[Perf] Carregamento stereo: {t_stereo - t_hpss:.1f}s\n")
+def _stream_accumulate(file_path, block_frames=1024):
+    """Decodifica em blocos (librosa.stream) e acumula as curvas por frame.
 
-        # RMS curve para uso em múltiplas análises
-        rms_curve = librosa.feature.rms(y=y)[0]
+    Cada bloco tem `block_frames` frames de STFT e os blocos se sobrepõem em
+    n_fft - hop amostras, então os frames (center=False) se encadeiam sem
+    lacunas. Em memória ficam só um bloco de áudio e as curvas por frame
+    (RMS, bandwidth, 13 MFCCs, onset, soma do espectro e do chroma).
 
-        # ── Executar todas as análises (passando y_harm, y_perc pré-computados) ──
+    Roda na taxa nativa do arquivo (nada de rebaixar o sr de faixas longas);
+    n_fft/hop escalam com o sr para manter a mesma resolução em Hz e em tempo
+    da análise completa a 22050 Hz.
+    """
+    import soundfile as sf
+    info = sf.info(file_path)
+    sr = info.samplerate
+    scale = max(1, int(round(sr / 22050.0)))
+    n_fft = AnalysisContext.N_FFT * scale
+    hop = AnalysisContext.HOP_LENGTH * scale
+    # Frames reais do arquivo: o último bloco vem completado com zeros
+    total_frames = max(1, 1 + (info.frames - n_fft) // hop)
+    stream = librosa.stream(file_path, block_length=block_frames, frame_length=n_fft,
+                            hop_length=hop, mono=True, fill_value=0)
+
+    spectrum_sum = None
+    chroma_sum = np.zeros(12)
+    n_frames = 0
+    rms_parts, bw_parts, mfcc_parts, onset_parts = [], [], [], []
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+
+    for block in stream:
+        if n_frames >= total_frames:
+            break
+        if len(block) < n_fft:
+            block = np.pad(block, (0, n_fft - len(block)))
+        keep = min(total_frames - n_frames, 1 + (len(block) - n_fft) // hop)
+        block = block[:n_fft + (keep - 1) * hop]
+        S = np.abs(librosa.stft(block, n_fft=n_fft, hop_length=hop, center=False))
+        mel_db = librosa.power_to_db(mel_basis.dot(S ** 2))
+
+        spectrum_sum = S.sum(axis=1) if spectrum_sum is None else spectrum_sum + S.sum(axis=1)
+        n_frames += S.shape[1]
+        rms_parts.append(librosa.feature.rms(y=block, frame_length=n_fft, hop_length=hop, center=False)[0])
+        bw_parts.append(librosa.feature.spectral_bandwidth(S=S, sr=sr)[0])
+        mfcc_parts.append(librosa.feature.mfcc(S=mel_db, n_mfcc=13))
+        onset_parts.append(librosa.onset.onset_strength(S=mel_db, sr=sr, center=False))
+        chroma_sum += librosa.feature.chroma_stft(S=S ** 2, sr=sr).sum(axis=1)
+
+    if n_frames == 0:
+        raise ValueError("arquivo sem áudio decodificável")
+    return {
+        "sr": sr,
+        "n_fft": n_fft,
+        "hop_length": hop,
+        "n_frames": n_frames,
+        "mean_spectrum": spectrum_sum / n_frames,
+        "rms": np.concatenate(rms_parts),
+        "bandwidth": np.concatenate(bw_parts),
+        "mfcc": np.concatenate(mfcc_parts, axis=1),
+        "onset_env": np.concatenate(onset_parts),
+        "chroma_mean": chroma_sum / n_frames,
+    }
 
-        # 1. Dados básicos
-        bpm = detect_bpm(y, sr)
+
+def _streaming_tempo(onset_env, sr, hop_length, chunk_frames=8192):
+    """BPM pelo tempograma médio, acumulado em pedaços do envelope de onset.
+
+    O beat_track monta o tempograma da faixa inteira de uma vez (centenas de MB
+    numa mix de 20 min); aqui só um pedaço existe por vez. Com aggregate=mean,
+    o tempo estimado do tempograma médio é o mesmo estimador do detect_bpm.
+    """
+    win_length = int(librosa.time_to_frames(8.0, sr=sr, hop_length=hop_length))
+    tg_sum = None
+    n = 0
+    for start in range(0, len(onset_env), chunk_frames):
+        chunk = onset_env[max(0, start - win_length):start + chunk_frames]
+        tg = librosa.feature.tempogram(onset_envelope=chunk, sr=sr, hop_length=hop_length,
+                                       win_length=win_length)
+        lead = start - max(0, start - win_length)  # descarta o trecho de contexto
+        tg = tg[:, lead:]
+        tg_sum = tg.sum(axis=1) if tg_sum is None else tg_sum + tg.sum(axis=1)
+        n += tg.shape[1]
+    tempo, _score = _tempo_candidates(tg_sum / max(1, n), sr, hop_length)[0]
+    return round(float(tempo), 1)
+
+
+def analyze_audio_streaming(file_path, real_duration=None, progress=None, hints=None):
+    """Análise de memória constante para mixes/programas longos (1–2 h+).
+
+    Cobre BPM, tonalidade, bandas de frequência, loudness, dinâmica e estrutura
+    a partir das curvas acumuladas em blocos. Os eixos que exigem o sinal inteiro
+    em memória (HPSS, bateria/synths detalhados, arranjo, extração MIDI) ficam
+    de fora — o resultado marca "analysis_mode": "streaming".
+    """
+    t0 = time.time()
+    progress = progress or ProgressReporter()
+    progress.use_plan(PROGRESS_STAGES_STREAMING)
+    progress.start("decode")
+    acc = _stream_accumulate(file_path)
+    sr = acc["sr"]
+    duration = real_duration or acc["n_frames"] * acc["hop_length"] / float(sr)
+    sys.stderr.write(f"[Perf] Streaming (decode + curvas): {time.time() - t0:.1f}s "
+                     f"(sr={sr}, {acc['n_frames']} frames)\n")
+
+    progress.start("structure")
+    ctx = StreamingContext(sr, acc["n_fft"], acc["hop_length"], acc["mean_spectrum"],
+                           acc["rms"], acc["bandwidth"], acc["mfcc"])
+
+    hints = hints or {}
+    if hints.get("bpm"):
+        bpm = _checked_bpm_hint(file_path, hints)
+    else:
+        try:
+            bpm = _streaming_tempo(acc["onset_env"], sr, acc["hop_length"])
+        except Exception:
+            bpm = None
         bpm_hint = _bpm_from_filename(file_path)
         bpm_reconciled = _reconcile_bpm(bpm, bpm_hint)
         if bpm_hint and bpm_reconciled != bpm:
             sys.stderr.write(f"[Info] BPM detectado={bpm} corrigido para {bpm_reconciled} (nome Beatport)\n")
         bpm = bpm_reconciled
-        key = detect_key(y, sr)
-        frequency_analysis = analyze_frequency_bands(y, sr)
-        loudness = analyze_loudness(y, sr)
-
-        t_basic = _time.time()
-        sys.stderr.write(f"[Perf] Dados básicos: {t_basic - t_stereo:.1f}s\n")
-
-        # 2. Análises principais (reutilizando HPSS)
-        identity = analyze_musical_identity(y, sr, bpm, key, frequency_analysis, rms_curve,
-                                            y_harm=y_harm, y_perc=y_perc)
-        groove = analyze_groove_and_rhythm(y, sr, bpm, y_perc=y_perc)
-        drums = detect_drums_detailed(y, sr, y_harm=y_harm, y_perc=y_perc)
-        bass = analyze_bass_detailed(y, sr, y_perc=y_perc)
-        synth_layers = analyze_synths_and_layers(y, sr, y_harm=y_harm)
-        harmony = analyze_harmony(y, sr, key)
-        structure = detect_structure_adaptive(y, sr, duration, bpm=bpm)
-        dynamics = analyze_dynamics(y, sr, duration)
-        mix_analysis = analyze_mix(y, y_stereo, sr)
-        dj_analysis = analyze_for_dj(
-            y, sr, bpm, key, duration,
-            structure.get("sections", []),
-            identity.get("energy_score", 50),
-            identity.get("genre", "Electronic")
-        )
-        executive_summary = generate_executive_summary(
-            identity, groove, harmony, dynamics, dj_analysis, synth_layers
-        )
+    if hints.get("key") and _verify_key_hint(acc["chroma_mean"], hints["key"]):
+        key, key_method = hints["key"], "tag"
+    else:
+        key, key_method = _key_from_chroma_mean(acc["chroma_mean"]), "mix_stft"
+    if hints.get("key"):
+        hints["key_verified"] = key == hints["key"]
+
+    frequency_analysis = analyze_frequency_bands(None, sr, ctx=ctx)
+    loudness = analyze_loudness(None, sr, ctx=ctx)
+    dynamics = analyze_dynamics(None, sr, duration, ctx=ctx)
+    structure = detect_structure_adaptive(None, sr, duration, bpm=bpm, ctx=ctx)
+    progress.end()
+
+    sys.stderr.write(f"[Perf] TOTAL (streaming): {time.time() - t0:.1f}s\n")
+    result = {
+        "success": True,
+        "filename": os.path.basename(file_path),
+        "duration": round(float(duration), 2),
+        "sample_rate": int(sr),
+        "analysis_method": ANALYSIS_METHOD,
+        "analysis_mode": "streaming",
+        "bpm": float(bpm) if bpm is not None else None,
+        "key": key,
+        "key_method": key_method,
+        "loudness": convert_numpy(loudness),
+        "frequency_analysis": convert_numpy(frequency_analysis),
+        "structure": convert_numpy(structure),
+        "dynamics": convert_numpy(dynamics),
+    }
+    return _fill_unavailable_outputs(result)
 
-        t_analysis = _time.time()
-        sys.stderr.write(f"[Perf] Análises principais: {t_analysis - t_basic:.1f}s\n")
 
-        # 3. Arranjo temporal (v2: detecção real por janelas)
-        temporal_arrangement = generate_temporal_arrangement_v2(
-            y, sr, duration, bpm, y_harm, y_perc,
-            drums, bass, synth_layers, structure
-        )
+def _fill_unavailable_outputs(result):
+    """Completa um resultado do streaming com o esquema da análise completa.
+
+    Cada saída que o streaming não calcula vira {"available": false, ...}
+    (a extração MIDI mantém a forma vazia de sempre, com stems/stem_meta) e
+    os campos de retrocompatibilidade saem null — False/[] diriam "ausente",
+    não "não analisado"; "unavailable" lista quais.
+    """
+    reason = "indisponível no modo streaming (sem o sinal inteiro em memória)"
+    missing = [name for name in ANALYSIS_OUTPUTS if name not in STREAMING_OUTPUTS]
+    for name in missing:
+        if name == "midi_extraction":
+            result[name] = {"source": "none", "bars": 0, "max_beats": 0, "stems": {}, "stem_meta": {},
+                            "available": False, "reason": reason}
+        else:
+            result[name] = {"available": False, "reason": reason}
+    result.update({
+        "drum_detection": None,
+        "bass_detection": None,
+        "detected_synths": None,
+        "detected_instruments": None,
+        "unavailable": missing,
+    })
+    return result
+
+
+# ──────────────────────────────────────────────────────────────────
+# CACHE DE RESULTADOS (em disco, endereçado pelo conteúdo)
+# ──────────────────────────────────────────────────────────────────
+
+def _default_cache_path():
+    base = os.environ.get("LEGOLAS_ANALYSIS_CACHE_DIR")
+    if not base:
+        xdg = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        base = os.path.join(xdg, "legolas")
+    return os.path.join(base, "analysis_cache.sqlite")
 
-        # 4. Post-processar: preencher elements_entering/exiting nas seções
-        _fill_section_elements(structure, temporal_arrangement)
 
-        # 5. Extração de eventos MIDI reais (onsets + pitch)
-        midi_extraction = extract_midi_from_audio(
-            y, sr, duration, bpm, key, drums, bass, synth_layers
+def _audio_fingerprint(file_path, block_size=64 * 1024, n_blocks=16):
+    """Identidade do arquivo sem ler tudo: tamanho + mtime + hash de blocos amostrados.
+
+    Lê `n_blocks` blocos espaçados uniformemente (início, meio, fim…) — alguns
+    MB no máximo, mesmo para um FLAC de 100 MB.
+    """
+    import hashlib
+    st = os.stat(file_path)
+    h = hashlib.sha1()
+    h.update(f"{st.st_size}:{int(st.st_mtime)}".encode())
+    with open(file_path, "rb") as fh:
+        if st.st_size <= block_size * n_blocks:
+            h.update(fh.read())
+        else:
+            step = (st.st_size - block_size) // (n_blocks - 1)
+            for i in range(n_blocks):
+                fh.seek(i * step)
+                h.update(fh.read(block_size))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Cache SQLite de resultados de analyze_audio, com despejo LRU por tamanho.
+
+    Chave = fingerprint do arquivo + nome (o hint de BPM do Beatport sai do nome)
+    + ANALYSIS_METHOD + PIPELINE_VERSION + opções que mudam o resultado. Subir a
+    versão do pipeline invalida tudo naturalmente. Falhas no cache nunca
+    derrubam a análise.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or _default_cache_path()
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("LEGOLAS_ANALYSIS_CACHE_MB", "512")) * 1024 * 1024)
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        import sqlite3
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
         )
+        return conn
+
+    @staticmethod
+    def key_for(file_path, options=None):
+        import hashlib
+        parts = [
+            _audio_fingerprint(file_path),
+            os.path.basename(file_path),
+            ANALYSIS_METHOD,
+            f"pipeline={PIPELINE_VERSION}",
+            json.dumps(options or {}, sort_keys=True),
+        ]
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                with conn:
+                    conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+                return json.loads(row[0])
+            finally:
+                conn.close()
+        except Exception as e:
+            sys.stderr.write(f"[Warning] leitura do cache falhou: {e}\n")
+            return None
+
+    def put(self, key, result):
+        try:
+            value = json.dumps(convert_numpy(result), ensure_ascii=False)
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                        (key, value, len(value), time.time())
+                    )
+                    self._evict(conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            sys.stderr.write(f"[Warning] escrita no cache falhou: {e}\n")
+
+    def _evict(self, conn):
+        """Remove os menos usados recentemente até caber em max_bytes."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM results ORDER BY accessed ASC"):
+            if freed >= excess:
+                break
+            victims.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM results WHERE key = ?", victims)
+
+
+# ──────────────────────────────────────────────────────────────────
+# PERFIL (--profile): wall, CPU e memória por estágio e sub-estágio
+# ──────────────────────────────────────────────────────────────────
+
+def _rss_mb():
+    """RSS atual do processo em MB (Linux via /proc; None onde não houver)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+def _peak_rss_mb():
+    """Pico de RSS do processo até agora em MB (None sem o módulo resource)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reporta em KB, macOS em bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+class StageProfiler:
+    """Mede wall time, CPU time e memória de estágios aninhados.
+
+    Cada estágio vira uma entrada com o caminho completo ("midi/drums.kick/bandpass"),
+    na ordem em que começou:
+      wall_s / cpu_s   — tempo de relógio e de CPU do processo (inclui threads BLAS)
+      rss_delta_mb     — variação da RSS entre início e fim (o que ficou alocado)
+      peak_growth_mb   — quanto o estágio empurrou o pico de RSS do processo
+      peak_rss_mb      — pico de RSS do processo ao fim do estágio
+
+    Os estágios principais vêm do ProgressReporter; os sub-estágios das funções
+    internas, via `_profile(nome)`, que não custa nada sem profiler ativo. No
+    modo paralelo os grupos se sobrepõem (open/close, fora da pilha) e cada nó
+    roda na pilha vazia da sua thread, com o grupo como `parent`: os caminhos
+    são os mesmos da execução serial.
+    """
+
+    def __init__(self):
+        self._clock = time.perf_counter
+        self._cpu = time.process_time
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._detached = {}
+        self.entries = []
+        self.t0 = self._clock()
+        self.cpu0 = self._cpu()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _new_entry(self, path, name):
+        entry = {
+            "name": path, "stage": name,
+            "_wall0": self._clock(), "_cpu0": self._cpu(),
+            "_rss0": _rss_mb(), "_peak0": _peak_rss_mb(),
+        }
+        with self._lock:
+            self.entries.append(entry)
+        return entry
+
+    def push(self, name, parent=None):
+        stack = self._stack()
+        prefix = stack[-1]["name"] if stack else parent
+        entry = self._new_entry(f"{prefix}/{name}" if prefix else name, name)
+        stack.append(entry)
+
+    def pop(self):
+        stack = self._stack()
+        if not stack:
+            return
+        self._finish(stack.pop())
+
+    def open(self, name):
+        """Abre um estágio de topo fora da pilha (grupos concorrentes)."""
+        entry = self._new_entry(name, name)
+        with self._lock:
+            self._detached[name] = entry
+
+    def close(self, name):
+        """Fecha o estágio aberto por open(); no-op se não houver."""
+        with self._lock:
+            entry = self._detached.pop(name, None)
+        if entry is not None:
+            self._finish(entry)
+
+    def _finish(self, entry):
+        rss, peak = _rss_mb(), _peak_rss_mb()
+        entry["wall_s"] = round(self._clock() - entry.pop("_wall0"), 4)
+        entry["cpu_s"] = round(self._cpu() - entry.pop("_cpu0"), 4)
+        rss0, peak0 = entry.pop("_rss0"), entry.pop("_peak0")
+        entry["rss_delta_mb"] = round(rss - rss0, 1) if rss is not None and rss0 is not None else None
+        entry["peak_growth_mb"] = round(peak - peak0, 1) if peak is not None and peak0 is not None else None
+        entry["peak_rss_mb"] = round(peak, 1) if peak is not None else None
+
+    @contextmanager
+    def stage(self, name, parent=None):
+        self.push(name, parent)
+        try:
+            yield
+        finally:
+            self.pop()
+
+    def report(self):
+        """Bloco JSON do perfil: estágios em ordem de início + totais do processo."""
+        with self._lock:
+            stages = [
+                {k: v for k, v in entry.items() if not k.startswith("_")}
+                for entry in self.entries if "wall_s" in entry
+            ]
+        peak = _peak_rss_mb()
+        return {
+            "stages": stages,
+            "total": {
+                "wall_s": round(self._clock() - self.t0, 4),
+                "cpu_s": round(self._cpu() - self.cpu0, 4),
+                "peak_rss_mb": round(peak, 1) if peak is not None else None,
+            },
+        }
+
+
+# Profiler da análise em andamento (None = desligado); os sub-estágios o consultam
+_ACTIVE_PROFILER = None
+_NO_PROFILE = nullcontext()
+
+
+def _profile(name, parent=None):
+    """Sub-estágio medido pelo profiler ativo; no-op quando não há profiler."""
+    profiler = _ACTIVE_PROFILER
+    if profiler is None:
+        return _NO_PROFILE
+    return profiler.stage(name, parent)
+
+
+# ──────────────────────────────────────────────────────────────────
+# PROGRESSO (--progress ndjson): eventos de estágio em tempo real
+# ──────────────────────────────────────────────────────────────────
+
+# Peso relativo de cada estágio no tempo total (medido numa faixa de 60 s a 22 kHz);
+# usado só para estimar o tempo restante
+PROGRESS_STAGES = (
+    ("decode", 0.12), ("hpss", 0.20), ("basic", 0.15), ("identity", 0.02),
+    ("drums", 0.02), ("structure", 0.03), ("arrangement", 0.02), ("midi", 0.44),
+)
+PROGRESS_STAGES_STREAMING = (("decode", 0.90), ("structure", 0.10))
+
+
+class ProgressReporter:
+    """Emite um evento NDJSON no início e no fim de cada estágio da análise.
+
+    {"event": "stage_start", "stage": "hpss", "index": 2, "total": 8, "elapsed": 2.3}
+    {"event": "stage_end", "stage": "hpss", "duration": 3.6, "elapsed": 5.9,
+     "progress": 0.32, "eta": 12.4}
+
+    `eta` extrapola o tempo já gasto pelos pesos de PROGRESS_STAGES. Sem stream
+    o reporter é mudo (modo padrão). `job_id` acompanha os eventos no --serve.
+    Com `profiler`, cada estágio também vira um estágio do StageProfiler.
+    """
+
+    def __init__(self, stream=None, job_id=None, profiler=None):
+        self._clock = time.time
+        self.stream = stream
+        self.job_id = job_id
+        self.profiler = profiler
+        self.t0 = self._clock()
+        self.plan = PROGRESS_STAGES
+        self._done = 0.0
+        self._stage = None
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def use_plan(self, plan):
+        """Troca a lista de estágios (ex.: modo streaming) antes do primeiro evento."""
+        self.plan = plan
+        self._done = 0.0
+
+    def _emit(self, payload):
+        if self.stream is None:
+            return
+        if self.job_id is not None:
+            payload = {"id": self.job_id, **payload}
+        _emit_line(payload, self.stream)
+
+    def start(self, stage):
+        """Abre um estágio (fechando o anterior, se houver) — execução sequencial."""
+        self.end()
+        self._stage = stage
+        if self.profiler is not None:
+            self.profiler.push(stage)
+        self.begin(stage)
+
+    def end(self):
+        """Fecha o estágio aberto por start()."""
+        if self._stage is None:
+            return
+        stage, self._stage = self._stage, None
+        if self.profiler is not None:
+            self.profiler.pop()
+        self.finish(stage)
+
+    def is_open(self, stage):
+        with self._lock:
+            return stage in self._open
+
+    def begin(self, stage):
+        """Abre um estágio sem fechar os demais (estágios concorrentes)."""
+        if self.profiler is not None and stage != self._stage:
+            self.profiler.open(stage)
+        names = [name for name, _ in self.plan]
+        now = self._clock()
+        with self._lock:
+            self._open[stage] = now
+        self._emit({
+            "event": "stage_start", "stage": stage,
+            "index": names.index(stage) + 1 if stage in names else None,
+            "total": len(names),
+            "elapsed": round(now - self.t0, 2),
+        })
+
+    def finish(self, stage):
+        """Fecha um estágio e emite progresso acumulado + tempo restante."""
+        if self.profiler is not None:
+            self.profiler.close(stage)
+        now = self._clock()
+        with self._lock:
+            stage_t0 = self._open.pop(stage, None)
+            if stage_t0 is None:
+                return
+            self._done += dict(self.plan).get(stage, 0.0)
+            total_weight = sum(w for _, w in self.plan) or 1.0
+            fraction = min(1.0, self._done / total_weight)
+        elapsed = now - self.t0
+        eta = elapsed * (1.0 - fraction) / fraction if fraction > 0 else None
+        self._emit({
+            "event": "stage_end", "stage": stage,
+            "duration": round(now - stage_t0, 2),
+            "elapsed": round(elapsed, 2),
+            "progress": round(fraction, 3),
+            "eta": round(eta, 1) if eta is not None else None,
+        })
+
+
+# ──────────────────────────────────────────────────────────────────
+# GRAFO DE ESTÁGIOS (--only): roda só o que as saídas pedidas exigem
+# ──────────────────────────────────────────────────────────────────
+#
+# Cada nó produz uma saída do resultado (ou um intermediário, como o HPSS).
+# `st` é o estado da análise: y, y_stereo, sr, duration, file_path, ctx e as
+# saídas já calculadas. Os nós estão em ordem topológica (dependências antes),
+# que é também a ordem de execução da análise completa.
+
+def _stage_hpss(st):
+    ctx = st["ctx"]
+    return ctx.y_harm, ctx.y_perc
+
+
+def _checked_bpm_hint(file_path, hints):
+    """BPM do hint conferido por verify_bpm_hint; grava hints["bpm_verified"]."""
+    bpm, hints["bpm_verified"] = verify_bpm_hint(file_path, float(hints["bpm"]))
+    if bpm != hints["bpm"]:
+        sys.stderr.write(f"[Info] BPM {hints['bpm']} ({hints['bpm_source']}) corrigido para {bpm} "
+                         f"(autocorrelação do onset)\n")
+    else:
+        sys.stderr.write(f"[Info] BPM {hints['bpm']} ({hints['bpm_source']}): detecção de tempo pulada\n")
+    return float(bpm)
+
+
+def _stage_bpm(st):
+    hints = st.get("hints") or {}
+    if hints.get("bpm"):
+        # Hint confiável (tags/nome Beatport): sem busca livre de tempo, só a
+        # conferência da oitava num trecho curto
+        return _checked_bpm_hint(st["file_path"], hints)
+    bpm = detect_bpm(st["y"], st["sr"], ctx=st["ctx"])
+    bpm_hint = _bpm_from_filename(st["file_path"])
+    bpm_reconciled = _reconcile_bpm(bpm, bpm_hint)
+    if bpm_hint and bpm_reconciled != bpm:
+        sys.stderr.write(f"[Info] BPM detectado={bpm} corrigido para {bpm_reconciled} (nome Beatport)\n")
+    return bpm_reconciled
+
+
+def _stage_key(st):
+    hints = st.get("hints") or {}
+    key, st["key_method"] = detect_key_with_method(st["y"], st["sr"], ctx=st["ctx"], hint=hints.get("key"),
+                                                   cheap="key" in st.get("fast", ()))
+    if hints.get("key"):
+        hints["key_verified"] = key == hints["key"]
+        if not hints["key_verified"]:
+            sys.stderr.write(f"[Info] Tonalidade das tags ({hints['key']}) não confirmada: detectada {key}\n")
+    return key
+
+
+def _stage_groove(st):
+    hints = st.get("hints") or {}
+    return analyze_groove_and_rhythm(st["y"], st["sr"], st["bpm"], ctx=st["ctx"],
+                                     tempo_hint=st["bpm"] if hints.get("bpm") else None)
+
+
+def _stage_dj(st):
+    identity = st["musical_identity"]
+    return analyze_for_dj(
+        st["y"], st["sr"], st["bpm"], st["key"], st["duration"],
+        st["structure"].get("sections", []),
+        identity.get("energy_score", 50),
+        identity.get("genre", "Electronic"),
+        ctx=st["ctx"]
+    )
+
+
+def _stage_arrangement(st):
+    y_harm, y_perc = st["hpss"]
+    return generate_temporal_arrangement_v2(
+        st["y"], st["sr"], st["duration"], st["bpm"], y_harm, y_perc,
+        st["drum_elements"], st["bass_elements"], st["synth_layers"], st["structure"], ctx=st["ctx"]
+    )
+
+
+# nome → (dependências, grupo de progresso, função). "decode" e "hpss" são
+# pseudo-nós: "decode" (carga do áudio) roda antes do grafo, em analyze_audio, e
+# só entra no plano quando algum nó lê st["y"]
+ANALYSIS_STAGES = {
+    "decode": ((), "decode", None),
+    "hpss": (("decode",), "hpss", _stage_hpss),
+    "bpm": (("decode",), "basic", _stage_bpm),
+    "key": (("decode", "hpss"), "basic", _stage_key),
+    "loudness": (("decode",), "basic", lambda st: analyze_loudness(st["y"], st["sr"], ctx=st["ctx"])),
+    "frequency_analysis": (("decode",), "basic",
+                           lambda st: analyze_frequency_bands(st["y"], st["sr"], ctx=st["ctx"])),
+    "musical_identity": (("decode", "hpss", "bpm", "key", "frequency_analysis"), "identity",
+                         lambda st: analyze_musical_identity(
+                             st["y"], st["sr"], st["bpm"], st["key"], st["frequency_analysis"],
+                             st["ctx"].rms(), ctx=st["ctx"])),
+    "groove_and_rhythm": (("decode", "hpss", "bpm"), "identity", _stage_groove),
+    "drum_elements": (("decode", "hpss"), "drums",
+                      lambda st: detect_drums_detailed(st["y"], st["sr"], ctx=st["ctx"])),
+    "bass_elements": (("decode", "hpss"), "drums",
+                      lambda st: analyze_bass_detailed(st["y"], st["sr"], ctx=st["ctx"])),
+    "synth_layers": (("decode", "hpss"), "drums",
+                     lambda st: analyze_synths_and_layers(st["y"], st["sr"], ctx=st["ctx"])),
+    "harmony": (("decode", "hpss", "key"), "drums",
+                lambda st: analyze_harmony(st["y"], st["sr"], st["key"], ctx=st["ctx"])),
+    "structure": (("decode", "bpm"), "structure",
+                  lambda st: detect_structure_adaptive(st["y"], st["sr"], st["duration"], bpm=st["bpm"],
+                                                       ctx=st["ctx"])),
+    "dynamics": (("decode",), "structure",
+                 lambda st: analyze_dynamics(st["y"], st["sr"], st["duration"], ctx=st["ctx"])),
+    "mix_analysis": (("decode",), "structure",
+                     lambda st: analyze_mix(st["y"], st["y_stereo"], st["sr"], ctx=st["ctx"])),
+    "dj_analysis": (("decode", "bpm", "key", "structure", "musical_identity"), "structure", _stage_dj),
+    "executive_summary": (("musical_identity", "groove_and_rhythm", "harmony", "dynamics", "dj_analysis",
+                           "synth_layers"), "structure",
+                          lambda st: generate_executive_summary(
+                              st["musical_identity"], st["groove_and_rhythm"], st["harmony"],
+                              st["dynamics"], st["dj_analysis"], st["synth_layers"])),
+    "temporal_arrangement": (("decode", "hpss", "bpm", "drum_elements", "bass_elements", "synth_layers",
+                              "structure"), "arrangement", _stage_arrangement),
+    "midi_extraction": (("decode", "hpss", "bpm", "key", "drum_elements", "bass_elements", "synth_layers"),
+                        "midi",
+                        lambda st: extract_midi_from_audio(
+                            st["y"], st["sr"], st["duration"], st["bpm"], st["key"], st["drum_elements"],
+                            st["bass_elements"], st["synth_layers"], ctx=st["ctx"],
+                            pitch_engine=st.get("pitch_engine"))),
+}
+
+# Dependências trocadas quando há hint confiável: com o BPM das tags/nome, o bpm
+# só confere o hint num trecho curto (verify_bpm_hint) e dispensa a carga
+# completa; com a tonalidade, o key é só uma verificação no cromagrama do mix —
+# não precisa esperar o HPSS
+HINTED_STAGE_DEPS = {"bpm": (), "key": ("decode",)}
+
+# Versões baratas de nós cujo único motivo para esperar o HPSS é o próprio nó:
+# sem outro consumidor do HPSS no plano (ex.: --only bpm,key), o key sai do
+# cromagrama STFT do mix em vez de pagar HPSS + CQT harmônico (ver fast_stages)
+FAST_STAGE_DEPS = {"key": ("decode",)}
+
+# Saídas selecionáveis (na ordem do resultado) e apelidos aceitos pelo --only
+ANALYSIS_OUTPUTS = tuple(name for name in ANALYSIS_STAGES if name not in ("decode", "hpss"))
+OUTPUT_ALIASES = {
+    "identity": "musical_identity", "genre": "musical_identity", "groove": "groove_and_rhythm",
+    "drums": "drum_elements", "bass": "bass_elements", "synths": "synth_layers",
+    "bands": "frequency_analysis", "frequency": "frequency_analysis", "energy": "dynamics",
+    "mix": "mix_analysis", "dj": "dj_analysis", "summary": "executive_summary",
+    "arrangement": "temporal_arrangement", "midi": "midi_extraction",
+}
+
+# Rótulo das linhas [Perf] por grupo de progresso
+_PERF_LABELS = {
+    "hpss": "HPSS", "basic": "Dados básicos", "identity": "Análises principais",
+    "drums": "Análises principais", "structure": "Análises principais",
+    "arrangement": "Arranjo temporal", "midi": "Extração MIDI",
+}
+
+
+def resolve_outputs(only):
+    """Normaliza a lista do --only (nomes do resultado ou apelidos); None = tudo.
+
+    Levanta ValueError para nomes desconhecidos.
+    """
+    if only is None:
+        return None
+    if isinstance(only, str):
+        only = only.split(",")
+    outputs = []
+    for name in only:
+        name = str(name).strip()
+        if not name:
+            continue
+        name = OUTPUT_ALIASES.get(name, name)
+        if name not in ANALYSIS_OUTPUTS:
+            raise ValueError(f"saída desconhecida: {name} (válidas: {', '.join(ANALYSIS_OUTPUTS)})")
+        if name not in outputs:
+            outputs.append(name)
+    return outputs or None
+
+
+def stage_deps(name, hints=None, fast=()):
+    """Dependências do nó `name` (HINTED_STAGE_DEPS quando há hint para ele,
+    FAST_STAGE_DEPS quando ele roda na versão barata)."""
+    if name in fast:
+        return FAST_STAGE_DEPS[name]
+    if hints and hints.get(name) and name in HINTED_STAGE_DEPS:
+        return HINTED_STAGE_DEPS[name]
+    return ANALYSIS_STAGES[name][0]
+
+
+def plan_stages(outputs=None, hints=None, fast=()):
+    """Nós a executar, em ordem topológica, para produzir `outputs` (None = todas).
+
+    `hints`: de read_track_hints — nós com hint podem dispensar dependências.
+    `fast`: nós na versão barata (de fast_stages).
+    """
+    needed = set()
+    pending = list(outputs or ANALYSIS_OUTPUTS)
+    while pending:
+        name = pending.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        pending.extend(stage_deps(name, hints, fast))
+    return [name for name in ANALYSIS_STAGES if name in needed]
+
 
-        t_total = _time.time()
+def fast_stages(outputs=None, hints=None):
+    """Nós de FAST_STAGE_DEPS que podem rodar na versão barata para `outputs`.
+
+    Só quando, sem eles, o HPSS sai do plano: se outro estágio já paga o HPSS,
+    o cromagrama harmônico custa pouco a mais e o resultado fica o da análise
+    completa.
+    """
+    fast = tuple(FAST_STAGE_DEPS)
+    return fast if "hpss" not in plan_stages(outputs, hints, fast) else ()
+
+
+def run_stages(st, stages, progress=None, t_start=None, workers=1):
+    """Executa os nós em ordem, gravando cada saída em `st`.
+
+    Abre um estágio de progresso a cada troca de grupo e escreve as linhas
+    [Perf] por rótulo (mesmas da análise completa). Com `workers` > 1, os nós
+    independentes rodam num pool de threads (ver _run_stages_parallel).
+    """
+    progress = progress or ProgressReporter()
+    if workers and workers > 1:
+        return _run_stages_parallel(st, stages, progress, workers, t_start)
+    ctx = st["ctx"]
+    label, t_label = None, t_start or time.time()
+    group = None
+    for name in stages:
+        _deps, stage_group, fn = ANALYSIS_STAGES[name]
+        if stage_group != group:
+            group = stage_group
+            progress.start(group)
+        stage_label = _PERF_LABELS[stage_group]
+        if stage_label != label:
+            if label is not None:
+                now = time.time()
+                hpss_info = f" (HPSS: {ctx.hpss_runs}x)" if label not in ("HPSS", "Dados básicos") else ""
+                sys.stderr.write(f"[Perf] {label}: {now - t_label:.1f}s{hpss_info}\n")
+                t_label = now
+            label = stage_label
+        with _profile(name):
+            st[name] = fn(st)
+    progress.end()
+    if label is not None:
+        hpss_info = f" (HPSS: {ctx.hpss_runs}x)" if label not in ("HPSS", "Dados básicos") else ""
+        sys.stderr.write(f"[Perf] {label}: {time.time() - t_label:.1f}s{hpss_info}\n")
+    return st
+
+
+@contextmanager
+def _blas_limits(n_threads):
+    """Limita as threads de BLAS/OpenMP durante o bloco (threadpoolctl, se houver)."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        yield
+        return
+    with threadpool_limits(limits=n_threads):
+        yield
+
+
+def _run_stages_parallel(st, stages, progress, workers, t_start=None):
+    """Executa o grafo num pool de `workers` threads: cada nó é submetido assim
+    que as dependências terminam.
+
+    O trabalho pesado (FFT/STFT do numpy/scipy, filtros) libera o GIL, então
+    eixos independentes (bateria, baixo, synths, harmonia, estrutura, dinâmica,
+    mix, MIDI...) sobrepõem-se de fato. O BLAS fica limitado a núcleos/workers
+    threads para não multiplicar threads. Os nós só leem `st` e o contexto
+    (memo com trava por chave), então o resultado é o mesmo da execução serial.
+    Os grupos de progresso abrem no primeiro nó e fecham no último de cada um.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    t_begin = t_start or time.time()
+    ctx = st["ctx"]
+    progress.end()  # fecha o estágio sequencial anterior (decode)
+    stage_set = set(stages)
+    left_in_group = {}
+    for name in stages:
+        group = ANALYSIS_STAGES[name][1]
+        left_in_group[group] = left_in_group.get(group, 0) + 1
+
+    def _run(name):
+        _deps, group, fn = ANALYSIS_STAGES[name]
+        with _profile(name, parent=group):
+            return fn(st)
+
+    blas_threads = max(1, (os.cpu_count() or 1) // workers)
+    pending = list(stages)
+    done, running = set(), {}
+    with _blas_limits(blas_threads), ThreadPoolExecutor(max_workers=workers,
+                                                        thread_name_prefix="stage") as pool:
+        while pending or running:
+            for name in list(pending):
+                deps = stage_deps(name, st.get("hints"), st.get("fast", ()))
+                if all(dep in done or dep not in stage_set for dep in deps):
+                    pending.remove(name)
+                    group = ANALYSIS_STAGES[name][1]
+                    if not progress.is_open(group):
+                        progress.begin(group)
+                    running[pool.submit(_run, name)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                st[name] = future.result()
+                done.add(name)
+                group = ANALYSIS_STAGES[name][1]
+                left_in_group[group] -= 1
+                if left_in_group[group] == 0:
+                    progress.finish(group)
+
+    sys.stderr.write(f"[Perf] Estágios em paralelo ({workers} threads, BLAS {blas_threads}): "
+                     f"{time.time() - t_begin:.1f}s (HPSS: {ctx.hpss_runs if ctx is not None else 0}x)\n")
+    return st
+
+
+def _select_outputs(result, outputs):
+    """Recorta um resultado completo para as saídas pedidas (+ campos de identificação)."""
+    keep = ("success", "filename", "duration", "sample_rate", "analysis_method", "analysis_mode",
+            "analysis_hints")
+    selected = {k: result[k] for k in keep if k in result}
+    for name in outputs:
+        if name in result:
+            selected[name] = result[name]
+    if "key" in outputs and "key_method" in result:
+        selected["key_method"] = result["key_method"]
+    if "unavailable" in result:
+        selected["unavailable"] = [name for name in result["unavailable"] if name in outputs]
+    return selected
+
+
+# ──────────────────────────────────────────────────────────────────
+# FUNÇÃO PRINCIPAL
+# ──────────────────────────────────────────────────────────────────
+
+def _probe_duration(file_path):
+    """Duração (s) lida do cabeçalho do container, sem decodificar o áudio."""
+    try:
+        import soundfile as sf
+        info = sf.info(file_path)
+        if info.frames > 0 and info.samplerate > 0:
+            return info.frames / float(info.samplerate)
+    except Exception:
+        pass
+    # Formatos fora do libsndfile (ex.: m4a): o librosa cai no audioread
+    return librosa.get_duration(path=file_path)
+
+
+def _target_sr(real_duration, file_size_mb):
+    """sr de análise adaptativo: arquivos muito longos (>10min) ou grandes (>50MB)
+    usam sr menor para economia de memória.
+
+    Custo de memória do topo da pirâmide: quando a extração MIDI está no plano,
+    essas faixas são decodificadas em PYRAMID_TOP_SR (22050) e só depois
+    reamostradas para o sr de análise — o pico da decodificação é o de 22050
+    (estéreo float32: ~10 MB/min, ~110 MB numa faixa de 11 min), e o mono do
+    topo (~5 MB/min) vive só até os onsets das bandas altas da bateria, antes do
+    HPSS. Ao longo da análise (STFTs, HPSS, cromas) o ganho do sr menor continua.
+    """
+    if real_duration > 600 or file_size_mb > 50:
+        return 11025
+    if real_duration > 300 or file_size_mb > 25:
+        return 16000
+    return 22050
+
+
+# Topo da pirâmide de resolução: os níveis (22050/11025/5512/2756 Hz) são fixos.
+# Faixas analisadas abaixo disso (longas) decodificam neste sr quando a bateria
+# vai ser extraída e derivam o de análise por decimação polifásica; o mono do
+# topo serve só às bandas acima do Nyquist de análise (hi-hats/pratos)
+PYRAMID_TOP_SR = 22050
+
+
+def _load_audio(file_path, target_sr, top_sr=None):
+    """Decodifica e reamostra o arquivo UMA vez, preservando os canais.
+
+    Retorna (y_mono, y_stereo, sr, y_top). O mono é a média dos canais do mesmo
+    buffer (o mesmo downmix do librosa.load mono=True); y_stereo é None em
+    arquivos mono. Antes o arquivo era decodificado duas vezes (mono para as
+    análises, estéreo só para analyze_mix). Com `top_sr` > target_sr, decodifica
+    em top_sr, reamostra (polifásico) para target_sr e devolve o mono do topo em
+    y_top; senão y_top é None.
+    """
+    if not top_sr or top_sr <= target_sr:
+        y_multi, sr = librosa.load(file_path, sr=target_sr, mono=False)
+        if y_multi.ndim == 1:
+            return y_multi, None, sr, None
+        return librosa.to_mono(y_multi), y_multi, sr, None
+
+    y_top_multi, _sr = librosa.load(file_path, sr=top_sr, mono=False)
+    g = np.gcd(int(target_sr), int(top_sr))
+    y_multi = scipy.signal.resample_poly(y_top_multi, target_sr // g, top_sr // g, axis=-1)
+    if y_multi.ndim == 1:
+        return y_multi, None, target_sr, y_top_multi
+    return librosa.to_mono(y_multi), y_multi, target_sr, librosa.to_mono(y_top_multi)
+
+
+def _cached_result(cache, file_path, options, outputs):
+    """Resultado em cache para `options` (sem "only"); None num miss.
+
+    Com `outputs`, procura a chave do subconjunto e depois a do resultado
+    completo, que atende qualquer subconjunto.
+    """
+    if outputs is not None:
+        cached = cache.get(ResultCache.key_for(file_path, dict(options, only=sorted(outputs))))
+        if cached is not None:
+            return cached
+    cached = cache.get(ResultCache.key_for(file_path, options))
+    if cached is not None and outputs is not None:
+        cached = _select_outputs(cached, outputs)
+    return cached
+
+
+def analyze_audio(file_path, use_cache=True, streaming=None, progress=None, profiler=None, only=None,
+                  workers=None, pitch_engine=None, use_hints=None):
+    """Função principal de análise completa.
+
+    Com `use_cache`, consulta antes o ResultCache (hit em milissegundos) e grava
+    nele os resultados bem-sucedidos. `streaming`: True pede a análise em blocos
+    de memória constante (opt-in; só as STREAMING_OUTPUTS são calculadas, as
+    demais saem marcadas como indisponíveis e `workers`/`pitch_engine` não se
+    aplicam); None/False = carga completa; "auto" (STREAMING_AUTO) = streaming a
+    partir de STREAMING_MIN_DURATION, decidido depois da consulta ao cache.
+    `progress`: ProgressReporter que recebe os eventos de início/fim de cada
+    estágio. `profiler`: StageProfiler que mede estágios e sub-estágios (ver
+    StageProfiler.report()). `only`: lista de saídas (nomes do resultado ou
+    apelidos, ver resolve_outputs); roda só os estágios de que elas dependem e
+    devolve só elas. None = análise completa. `workers`: threads para estágios
+    independentes (None = LEGOLAS_ANALYSIS_WORKERS ou 1, serial); o resultado é
+    idêntico ao serial. `pitch_engine`: motor de pitch da bassline/lead no MIDI
+    (ver PITCH_ENGINES; None = LEGOLAS_PITCH_ENGINE ou pyin). `use_hints`:
+    confia no BPM/tonalidade das tags e do nome Beatport (ver read_track_hints)
+    — pula a busca de tempo e reduz a tonalidade a uma verificação (se os hints
+    cobrem todas as saídas pedidas, o áudio nem é decodificado); None =
+    LEGOLAS_USE_HINTS. O resultado ganha "analysis_hints".
+    """
+    global _ACTIVE_PROFILER
+    previous_profiler = _ACTIVE_PROFILER
+    try:
+        if not os.path.exists(file_path):
+            return {"success": False, "error": f"Arquivo não encontrado: {file_path}"}
+        outputs = resolve_outputs(only)
+        pitch_engine = resolve_pitch_engine(pitch_engine)
+        use_hints = resolve_use_hints(use_hints)
+        if workers is None:
+            workers = int(os.environ.get("LEGOLAS_ANALYSIS_WORKERS", "1") or 1)
+
+        t0 = time.time()
+        progress = progress or ProgressReporter()
+        if profiler is not None:
+            progress.profiler = profiler
+            _ACTIVE_PROFILER = profiler
+
+        cache = cache_key = None
+        base_options = {}
+        if pitch_engine != DEFAULT_PITCH_ENGINE:
+            base_options["pitch_engine"] = pitch_engine
+        if use_hints:
+            base_options["hints"] = True
+        if use_cache:
+            try:
+                cache = ResultCache()
+                # Só o opt-in muda a chave (None/False = carga completa); em "auto"
+                # vale qualquer dos dois, e a duração só é lida num miss
+                modes = (None, True) if streaming == STREAMING_AUTO else (True if streaming else None,)
+                for mode in modes:
+                    cached = _cached_result(cache, file_path, dict(base_options, streaming=mode), outputs)
+                    if cached is not None:
+                        sys.stderr.write(f"[Perf] Cache hit: {time.time() - t0:.3f}s\n")
+                        return cached
+            except Exception as e:
+                sys.stderr.write(f"[Warning] cache indisponível: {e}\n")
+                cache = None
+
+        # Obter duração real do arquivo ANTES de carregar (cabeçalho, sem decodificar)
+        real_duration = _probe_duration(file_path)
+        sys.stderr.write(f"[Info] Duração real do arquivo: {real_duration:.1f}s ({real_duration/60:.1f} min)\n")
+        if streaming == STREAMING_AUTO:
+            streaming = real_duration >= STREAMING_MIN_DURATION
+        options = dict(base_options, streaming=True if streaming else None)
+        if outputs is not None:
+            options["only"] = sorted(outputs)
+        if cache is not None:
+            cache_key = ResultCache.key_for(file_path, options)
+
+        # Hints das tags/nome (só o cabeçalho, sem decodificar)
+        hints = read_track_hints(file_path) if use_hints else None
+        if hints:
+            sys.stderr.write(f"[Info] Hints: BPM={hints['bpm']} ({hints['bpm_source']}), "
+                             f"tonalidade={hints['key']} ({hints['key_source']})\n")
+
+        if not streaming and real_duration >= STREAMING_MIN_DURATION:
+            sys.stderr.write("[Info] Faixa longa: --stream reduz a memória (sem bateria/synths/MIDI)\n")
+        if streaming:
+            try:
+                result = analyze_audio_streaming(file_path, real_duration, progress=progress, hints=hints)
+                if hints:
+                    result["analysis_hints"] = hints
+                if outputs is not None:
+                    result = _select_outputs(result, outputs)
+                if cache is not None:
+                    cache.put(cache_key, result)
+                return result
+            except Exception as e:
+                # Formato fora do libsndfile (ex.: m4a): segue pela carga completa
+                sys.stderr.write(f"[Warning] streaming indisponível ({e}), usando carga completa\n")
+                progress.use_plan(PROGRESS_STAGES)
+                if cache is not None:
+                    # O resultado será o da carga completa: grava na chave dela
+                    cache_key = ResultCache.key_for(file_path, dict(options, streaming=None))
+
+        fast = fast_stages(outputs, hints=hints)
+        stages = plan_stages(outputs, hints=hints, fast=fast)
+        if outputs is not None:
+            groups = {ANALYSIS_STAGES[name][1] for name in stages}
+            progress.use_plan(tuple(item for item in PROGRESS_STAGES if item[0] in groups))
+
+        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
+        target_sr = _target_sr(real_duration, file_size_mb)
+        if "decode" in stages:
+            # Carregar áudio (mono) - ajustar sr baseado no tamanho/duração
+            progress.start("decode")
+            # Decodificação única: mono (análises) e estéreo (analyze_mix) do mesmo buffer
+            # O topo (22050) só é decodificado quando a bateria do MIDI vai usá-lo
+            top_sr = PYRAMID_TOP_SR if "midi_extraction" in stages else None
+            y, y_stereo, sr, y_top = _load_audio(file_path, target_sr, top_sr=top_sr)
+            duration = librosa.get_duration(y=y, sr=sr)
+
+            t_load = time.time()
+            sys.stderr.write(f"[Perf] Carregamento: {t_load - t0:.1f}s (sr={sr}"
+                             f"{f', topo={PYRAMID_TOP_SR}' if y_top is not None else ''}, "
+                             f"size={file_size_mb:.0f}MB, {'estéreo' if y_stereo is not None else 'mono'})\n")
+
+            # Contexto compartilhado: HPSS e cada STFT/feature espectral são calculados
+            # uma única vez e reaproveitados por todas as análises abaixo
+            ctx = AnalysisContext(y, sr, y_top=y_top, sr_top=PYRAMID_TOP_SR, stage_workers=workers)
+            if y_top is not None:
+                # Onsets das bandas acima do Nyquist de análise já aqui (memoizados para
+                # a bateria) e o mono do topo liberado: não fica vivo durante o HPSS
+                top_bands = {name: band for name, band in _drum_band_ranges(sr, ctx.sr_top).items()
+                             if band[1] > sr * 0.48}
+                with _profile("drums.top_onsets"):
+                    ctx.band_onset_envelopes(top_bands)
+                ctx.release_top()
+                del y_top
+        else:
+            # Os hints cobrem todas as saídas pedidas (ex.: --only bpm --hints):
+            # nada lê o áudio, então o arquivo não é decodificado
+            y = y_stereo = ctx = None
+            sr, duration = target_sr, real_duration
+            t_load = time.time()
+            sys.stderr.write("[Perf] Carregamento: pulado (hints cobrem as saídas pedidas)\n")
+        st = {"file_path": file_path, "y": y, "y_stereo": y_stereo, "sr": sr,
+              "duration": duration, "ctx": ctx, "pitch_engine": pitch_engine, "hints": hints, "fast": fast}
+        run_stages(st, [name for name in stages if name != "decode"], progress=progress,
+                   t_start=t_load, workers=workers)
+        if "temporal_arrangement" in st and "structure" in st:
+            # Post-processar: preencher elements_entering/exiting nas seções
+            _fill_section_elements(st["structure"], st["temporal_arrangement"])
+
+        t_total = time.time()
         sys.stderr.write(f"[Perf] TOTAL: {t_total - t0:.1f}s\n")
 
-        # Montar resultado completo
+        # Montar resultado (completo, ou só as saídas pedidas)
         result = {
             "success": True,
             "filename": os.path.basename(file_path),
             "duration": round(float(duration), 2),
             "sample_rate": int(sr),
-            "analysis_method": "python_librosa_v3",
-
-            # Dados básicos
-            "bpm": float(bpm) if bpm is not None else None,
-            "key": key,
-            "loudness": convert_numpy(loudness),
-            "frequency_analysis": convert_numpy(frequency_analysis),
-
-            # 11 eixos de análise
-            "musical_identity": convert_numpy(identity),
-            "groove_and_rhythm": convert_numpy(groove),
-            "drum_elements": convert_numpy(drums),
-            "bass_elements": convert_numpy(bass),
-            "synth_layers": convert_numpy(synth_layers),
-            "harmony": convert_numpy(harmony),
-            "structure": convert_numpy(structure),
-            "dynamics": convert_numpy(dynamics),
-            "mix_analysis": convert_numpy(mix_analysis),
-            "dj_analysis": convert_numpy(dj_analysis),
-            "executive_summary": convert_numpy(executive_summary),
-            "temporal_arrangement": convert_numpy(temporal_arrangement),
-            "midi_extraction": convert_numpy(midi_extraction),
+            "analysis_method": ANALYSIS_METHOD,
+        }
+        if hints:
+            result["analysis_hints"] = hints
+        for name in (outputs or ANALYSIS_OUTPUTS):
+            value = st[name]
+            if name == "bpm":
+                result[name] = float(value) if value is not None else None
+            elif name == "key":
+                result[name] = value
+                result["key_method"] = st.get("key_method")
+            else:
+                result[name] = convert_numpy(value)
 
+        if outputs is None:
+            drums, bass, synth_layers = st["drum_elements"], st["bass_elements"], st["synth_layers"]
             # Retrocompatibilidade com formato anterior
-            "drum_detection": convert_numpy({
-                "kick_present": drums.get("kick", {}).get("present", False),
-                "snare_present": drums.get("snare_clap", {}).get("present", False),
-                "hihat_present": drums.get("hihats", {}).get("present", False),
-                "cymbals_present": drums.get("cymbals_rides", {}).get("present", False),
-                "percussion_present": drums.get("percussion", {}).get("present", False)
-            }),
-            "bass_detection": convert_numpy({
-                "sub_bass": bass.get("sub_bass", {}).get("present", False),
-                "mid_bass": bass.get("mid_bass", {}).get("present", False),
-                "bassline": bass.get("bassline", {}).get("present", False)
-            }),
-            "detected_synths": [l["name"] for l in synth_layers],
-            "detected_instruments": []
-        }
+            result.update({
+                "drum_detection": convert_numpy({
+                    "kick_present": drums.get("kick", {}).get("present", False),
+                    "snare_present": drums.get("snare_clap", {}).get("present", False),
+                    "hihat_present": drums.get("hihats", {}).get("present", False),
+                    "cymbals_present": drums.get("cymbals_rides", {}).get("present", False),
+                    "percussion_present": drums.get("percussion", {}).get("present", False)
+                }),
+                "bass_detection": convert_numpy({
+                    "sub_bass": bass.get("sub_bass", {}).get("present", False),
+                    "mid_bass": bass.get("mid_bass", {}).get("present", False),
+                    "bassline": bass.get("bassline", {}).get("present", False)
+                }),
+                "detected_synths": [l["name"] for l in synth_layers],
+                "detected_instruments": []
+            })
+
+        if cache is not None:
+            cache.put(cache_key, result)
 
         return result
 
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        # Alguns erros de decodificação (ex.: NoBackendError do audioread) vêm sem mensagem
+        return {"success": False, "error": str(e) or type(e).__name__}
+    finally:
+        _ACTIVE_PROFILER = previous_profiler
+
+
+# ──────────────────────────────────────────────────────────────────
+# MODO WORKER (--serve): jobs em NDJSON via stdin/stdout
+# ──────────────────────────────────────────────────────────────────
+
+def _emit_line(payload, stream=None):
+    """Escreve um objeto JSON numa única linha e dá flush (protocolo NDJSON)."""
+    stream = stream or sys.stdout
+    stream.write(json.dumps(convert_numpy(payload), ensure_ascii=False) + "\n")
+    stream.flush()
+
+
+def _warm_up(seconds=8.0, sr=22050):
+    """Roda o pipeline completo numa faixa sintética curta.
+
+    Compila os kernels numba (HPSS, beat tracking, pyin) e preenche os caches
+    de filtros do librosa (mel, CQT, chroma) antes do primeiro job real, que
+    de outra forma pagaria esses segundos de cold start.
+    """
+    import tempfile
+    import soundfile as sf
+    t = np.arange(int(seconds * sr)) / float(sr)
+    beat = 60.0 / 125.0
+    y = 0.2 * np.sin(2 * np.pi * 110.0 * t) + 0.1 * np.sin(2 * np.pi * 440.0 * t)
+    y += 0.6 * np.sin(2 * np.pi * 55.0 * t) * np.exp(-(t % beat) * 20.0)
+    fd, path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    try:
+        sf.write(path, y.astype(np.float32), sr)
+        analyze_audio(path, use_cache=False)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def serve(stream_in=None, stream_out=None, warm_up=True):
+    """Worker persistente: lê um job JSON por linha e responde um JSON por linha.
+
+    Requisição: {"id": "...", "path": "/faixa.mp3", "cache": true, "progress": false, "profile": false,
+                 "only": ["bpm", "key"], "pitch_engine": "salience", "hints": true, "stream": false}
+                ("only", "workers", "pitch_engine", "hints" e "stream" opcionais, ver analyze_audio)
+    Resposta:   {"id": "...", "result": {...}}  (mesmo objeto do modo de arquivo único)
+    Comandos:   {"cmd": "ping"} → {"id": ..., "event": "pong"}; {"cmd": "shutdown"} encerra.
+
+    Com "progress": true, os eventos de estágio (ProgressReporter) saem antes da
+    resposta, com o mesmo "id"; com "profile": true, result["profile"] traz o
+    perfil por estágio (StageProfiler) e o cache é ignorado. Ao subir (após o
+    aquecimento) emite {"event": "ready"}. Logs continuam no stderr; o stdout
+    carrega apenas o protocolo.
+    """
+    stream_in = stream_in or sys.stdin
+    stream_out = stream_out or sys.stdout
+    if warm_up:
+        t0 = time.time()
+        try:
+            _warm_up()
+        except Exception as e:
+            sys.stderr.write(f"[Warning] aquecimento do worker falhou: {e}\n")
+        sys.stderr.write(f"[Perf] Aquecimento do worker: {time.time() - t0:.1f}s\n")
+    _emit_line({"event": "ready", "pid": os.getpid()}, stream_out)
+
+    for line in stream_in:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("job deve ser um objeto JSON")
+        except ValueError as e:
+            _emit_line({"id": None, "result": {"success": False, "error": f"Job inválido: {e}"}}, stream_out)
+            continue
+
+        job_id = job.get("id")
+        cmd = job.get("cmd")
+        if cmd == "shutdown":
+            break
+        if cmd == "ping":
+            _emit_line({"id": job_id, "event": "pong"}, stream_out)
+            continue
+
+        path = job.get("path")
+        if not path:
+            result = {"success": False, "error": "Job sem 'path'"}
+        else:
+            reporter = ProgressReporter(stream_out, job_id=job_id) if job.get("progress") else None
+            profiler = StageProfiler() if job.get("profile") else None
+            # Perfil mede a análise de fato: um hit de cache voltaria sem estágios
+            # (mesma regra do --profile na linha de comando)
+            use_cache = job.get("cache", True) and profiler is None
+            result = analyze_audio(path, use_cache=use_cache, streaming=job.get("stream"), progress=reporter,
+                                   profiler=profiler, only=job.get("only"), workers=job.get("workers"),
+                                   pitch_engine=job.get("pitch_engine"), use_hints=job.get("hints"))
+            if profiler is not None:
+                result["profile"] = profiler.report()
+        _emit_line({"id": job_id, "result": result}, stream_out)
+
+
+# ──────────────────────────────────────────────────────────────────
+# MODO BATCH (--batch): biblioteca inteira em paralelo, com manifest retomável
+# ──────────────────────────────────────────────────────────────────
+
+_AUDIO_EXTENSIONS = ('.mp3', '.flac', '.wav', '.m4a', '.aac', '.ogg', '.opus', '.aif', '.aiff')
+_MANIFEST_NAME = "manifest.json"
+
+
+def _collect_batch_files(source):
+    """Lista de faixas a partir de uma pasta (recursiva) ou de um arquivo-lista (um caminho por linha)."""
+    if os.path.isdir(source):
+        files = []
+        for root, _dirs, names in os.walk(source):
+            for name in names:
+                if name.lower().endswith(_AUDIO_EXTENSIONS):
+                    files.append(os.path.abspath(os.path.join(root, name)))
+        return sorted(files)
+    base = os.path.dirname(os.path.abspath(source))
+    files = []
+    with open(source, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                files.append(os.path.abspath(os.path.join(base, line)))
+    return files
+
+
+def _batch_output_name(file_path):
+    """Nome do JSON de resultado: nome da faixa + hash curto do caminho (evita colisão entre pastas)."""
+    import hashlib
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    digest = hashlib.sha1(file_path.encode("utf-8")).hexdigest()[:8]
+    return f"{stem}.{digest}.json"
+
+
+def _write_json_atomic(path, payload, indent=None):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(payload, fh, ensure_ascii=False, indent=indent)
+    os.replace(tmp, path)
+
+
+def _load_manifest(out_dir, use_hints=False):
+    path = os.path.join(out_dir, _MANIFEST_NAME)
+    try:
+        with open(path, encoding="utf-8") as fh:
+            manifest = json.load(fh)
+        if (manifest.get("analysis_method") == ANALYSIS_METHOD
+                and manifest.get("pipeline_version") == PIPELINE_VERSION):
+            if bool(manifest.get("use_hints")) == use_hints:
+                manifest.setdefault("files", {})
+                return manifest
+            sys.stderr.write("[Batch] Manifest de outro modo de hints: recomeçando\n")
+        else:
+            sys.stderr.write("[Batch] Manifest de outra versão do analisador: recomeçando\n")
+    except (OSError, ValueError):
+        pass
+    return {"analysis_method": ANALYSIS_METHOD, "pipeline_version": PIPELINE_VERSION,
+            "use_hints": use_hints, "files": {}}
+
+
+def _batch_worker_init():
+    """Cada processo do pool usa 1 thread de BLAS/OpenMP e de HPSS (o paralelismo vem do pool)."""
+    os.environ["LEGOLAS_HPSS_WORKERS"] = "1"
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except Exception:
+        pass
+
+
+def _batch_analyze_one(file_path, out_dir, use_cache=True, use_hints=None):
+    """Analisa uma faixa no processo do pool e grava o resultado em disco.
+
+    Devolve só o resumo (o resultado completo não volta pelo pipe do pool).
+    """
+    t0 = time.time()
+    result = analyze_audio(file_path, use_cache=use_cache, use_hints=use_hints)
+    elapsed = round(time.time() - t0, 2)
+    if not result.get("success"):
+        error = result.get("error") or "análise falhou sem mensagem de erro"
+        return {"path": file_path, "status": "failed", "error": error, "elapsed_sec": elapsed}
+    output = _batch_output_name(file_path)
+    _write_json_atomic(os.path.join(out_dir, output), result)
+    return {"path": file_path, "status": "done", "output": output, "elapsed_sec": elapsed}
+
+
+def run_batch(source, out_dir, jobs=None, use_cache=True, use_hints=None):
+    """Analisa várias faixas em paralelo (um processo por núcleo).
+
+    Grava um JSON por faixa em `out_dir` e um manifest.json com o status de cada
+    arquivo (done/failed). Rodar de novo com o mesmo `out_dir` pula as faixas já
+    concluídas — uma execução interrompida continua de onde parou; as que
+    falharam são tentadas novamente. `use_hints`: ver analyze_audio; um
+    manifest gravado no outro modo recomeça do zero, como o de outra versão.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    use_hints = resolve_use_hints(use_hints)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, _MANIFEST_NAME)
+    manifest = _load_manifest(out_dir, use_hints)
+    entries = manifest["files"]
+
+    files = _collect_batch_files(source)
+    pending = [f for f in files
+               if entries.get(f, {}).get("status") != "done"
+               or not os.path.exists(os.path.join(out_dir, entries[f].get("output", "")))]
+    skipped = len(files) - len(pending)
+    jobs = max(1, int(jobs or os.cpu_count() or 1))
+    sys.stderr.write(f"[Batch] {len(files)} faixas ({skipped} já concluídas, {len(pending)} pendentes), "
+                     f"{jobs} processos\n")
+
+    t0 = time.time()
+    done_count = 0
+    failed_count = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_batch_worker_init) as pool:
+        futures = {pool.submit(_batch_analyze_one, f, out_dir, use_cache, use_hints): f for f in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            file_path = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                # Processo do pool morreu (ex.: OOM) — registra e segue
+                summary = {"path": file_path, "status": "failed", "error": str(e) or type(e).__name__}
+            entries[file_path] = {k: v for k, v in summary.items() if k != "path"}
+            _write_json_atomic(manifest_path, manifest, indent=2)
+            if summary["status"] == "done":
+                done_count += 1
+            else:
+                failed_count += 1
+            sys.stderr.write(f"[Batch] {i}/{len(pending)} {summary['status']}: "
+                             f"{os.path.basename(file_path)} ({summary.get('elapsed_sec', 0)}s)\n")
+
+    return {
+        "success": failed_count == 0,
+        "total": len(files),
+        "completed": done_count,
+        "failed": failed_count,
+        "skipped": skipped,
+        "elapsed_sec": round(time.time() - t0, 2),
+        "manifest": manifest_path,
+    }
 
 
 def main():
-    if len(sys.argv) < 2:
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Legolas Audio Analyzer — análise musical completa via librosa"
+    )
+    parser.add_argument("file", nargs="?", help="caminho do arquivo de áudio (modo de arquivo único)")
+    parser.add_argument("--serve", action="store_true",
+                        help="worker persistente: jobs NDJSON via stdin/stdout")
+    parser.add_argument("--batch", metavar="ORIGEM",
+                        help="pasta (recursiva) ou arquivo-lista com uma faixa por linha")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="processos em paralelo no modo batch (padrão: nº de núcleos)")
+    parser.add_argument("--out", metavar="PASTA",
+                        help="pasta de saída do modo batch (resultados + manifest.json)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignora o cache de resultados em disco (sempre reanalisa)")
+    parser.add_argument("--stream", "--streaming", dest="stream", action="store_const", const=True,
+                        help="análise em blocos de memória constante (mixes longos): só bpm, key, "
+                             "loudness, bandas, estrutura e dinâmica; o resto sai como indisponível")
+    parser.add_argument("--stream-auto", dest="stream", action="store_const", const=STREAMING_AUTO,
+                        help="como --stream, mas só para faixas a partir de "
+                             f"{STREAMING_MIN_DURATION / 60:.0f} min (decidido depois do cache)")
+    parser.add_argument("--progress", choices=["ndjson"], default=None,
+                        help="emite eventos de estágio (NDJSON) no stdout; o resultado sai "
+                             "compacto na última linha")
+    parser.add_argument("--profile", action="store_true",
+                        help="inclui no resultado um bloco \"profile\" com wall/CPU/memória "
+                             "por estágio e sub-estágio (ignora o cache)")
+    parser.add_argument("--only", metavar="SAÍDAS",
+                        help="só estas saídas, separadas por vírgula (ex.: bpm,key,loudness); "
+                             "roda apenas os estágios de que dependem (sem HPSS no plano, o key "
+                             "sai do cromagrama STFT do mix)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="threads para estágios independentes (padrão: $LEGOLAS_ANALYSIS_WORKERS "
+                             "ou 1 = serial); resultado idêntico ao serial")
+    parser.add_argument("--pitch-engine", choices=PITCH_ENGINES, default=None,
+                        help="motor de pitch da bassline/lead no MIDI: pyin (fiel, lento) ou "
+                             "salience (harmônicas do CQT, rápido); padrão: $LEGOLAS_PITCH_ENGINE ou pyin")
+    parser.add_argument("--hints", action="store_true", default=None,
+                        help="confiar no BPM/tonalidade das tags e do nome Beatport: pula a busca de "
+                             "tempo e só verifica a tonalidade (padrão: $LEGOLAS_USE_HINTS)")
+    args = parser.parse_args()
+    try:
+        only = resolve_outputs(args.only)
+    except ValueError as e:
+        print(json.dumps({"success": False, "error": str(e)}, ensure_ascii=False))
+        sys.exit(1)
+    # Perfil só faz sentido numa análise de verdade, não num hit de cache
+    use_cache = not args.no_cache and not args.profile
+    streaming = args.stream
+
+    if args.serve:
+        serve()
+        return
+
+    if args.batch:
+        if not args.out:
+            print(json.dumps({"success": False, "error": "--batch exige --out <pasta>"}))
+            sys.exit(1)
+        summary = run_batch(args.batch, args.out, jobs=args.jobs, use_cache=use_cache, use_hints=args.hints)
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        return
+
+    if not args.file:
         print(json.dumps({
             "success": False,
-            "error": "Uso: python audio_analyzer.py <caminho_do_arquivo>"
+            "error": "Uso: python audio_analyzer.py <caminho_do_arquivo> | --serve | --batch <origem> --out <pasta>"
         }))
         sys.exit(1)
 
-    file_path = sys.argv[1]
-    result = analyze_audio(file_path)
+    profiler = StageProfiler() if args.profile else None
+    if args.progress == "ndjson":
+        result = analyze_audio(args.file, use_cache=use_cache, streaming=streaming,
+                               progress=ProgressReporter(sys.stdout), profiler=profiler, only=only,
+                               workers=args.workers, pitch_engine=args.pitch_engine, use_hints=args.hints)
+        if profiler is not None:
+            result["profile"] = profiler.report()
+        _emit_line(result)
+        return
+
+    result = analyze_audio(args.file, use_cache=use_cache, streaming=streaming, profiler=profiler,
+                           only=only, workers=args.workers, pitch_engine=args.pitch_engine,
+                           use_hints=args.hints)
+    if profiler is not None:
+        result["profile"] = profiler.report()
     print(json.dumps(result, ensure_ascii=False, indent=2))
 
 
@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+"""
+Benchmark do Legolas Audio Analyzer — velocidade e precisão por estágio.
+
+Gera localmente sinais sintéticos determinísticos com gabarito conhecido
+(kick/clique em BPM conhecido, bassline senoidal com notas conhecidas, pads
+de acordes numa tonalidade conhecida, hats com swing) e roda sobre eles:
+
+  detect_bpm, detect_key, analyze_groove_and_rhythm,
+  detect_structure_adaptive, extract_midi_from_audio
+
+Para cada caso reporta o tempo de cada estágio e o erro contra o gabarito.
+Serve para aceitar mudanças de performance com segurança: um speedup que
+quebre o tratamento de oitava do BPM ou o pitch do baixo aparece aqui.
+
+Uso:
+  python scripts/benchmark_analyzer.py
+  python scripts/benchmark_analyzer.py --seconds 30 --cases house_125_Am,dnb_174_C
+  python scripts/benchmark_analyzer.py --repeat 3 --json bench.json
+  python scripts/benchmark_analyzer.py --scaling --durations 3,6,12,30,60
+  python scripts/benchmark_analyzer.py --library ~/Music/Beatport --sr-tiers
+
+No modo --scaling, cada estágio roda em faixas de duração crescente; o
+expoente de crescimento é ajustado e o script sai com código 1 quando algum
+estágio cresce mais rápido que O(n log n).
+
+No modo --library, o gabarito é o BPM Beatport no nome (' (125) ') e, com o
+mutagen instalado, a tonalidade das tags; --sr-tiers repete cada faixa em
+22050/16000/11025 Hz para medir o custo da política adaptativa de sr.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np  # noqa: E402
+import audio_analyzer as aa  # noqa: E402
+
+
+SR = 22050
+
+# Progressões por modo (graus em semitons a partir da tônica, acorde maior/menor)
+_PROGRESSION_MINOR = [(0, "m"), (8, ""), (3, ""), (10, "")]   # i – VI – III – VII
+_PROGRESSION_MAJOR = [(0, ""), (7, ""), (9, "m"), (5, "")]    # I – V – vi – IV
+
+# Casos padrão: cobrem oitavas de BPM (174 ↔ 87, 90 ↔ 180), modos maior/menor e swing
+CASES = [
+    {"name": "house_125_Am", "bpm": 125.0, "key": "Am", "swing": 0.0},
+    {"name": "techno_132_Fm", "bpm": 132.0, "key": "Fm", "swing": 0.0},
+    {"name": "deep_118_G_swing", "bpm": 118.0, "key": "G", "swing": 0.62},
+    {"name": "dnb_174_C", "bpm": 174.0, "key": "C", "swing": 0.0},
+    {"name": "downtempo_90_Dm", "bpm": 90.0, "key": "Dm", "swing": 0.0},
+]
+
+
+# ──────────────────────────────────────────────────────────────────
+# GERAÇÃO DE SINAIS (determinística)
+# ──────────────────────────────────────────────────────────────────
+
+def _midi_to_hz(midi):
+    return 440.0 * 2.0 ** ((midi - 69) / 12.0)
+
+
+def _add(y, start, burst):
+    i = int(start * SR)
+    if i >= len(y):
+        return
+    m = min(len(burst), len(y) - i)
+    y[i:i + m] += burst[:m]
+
+
+def _kick(length=0.25):
+    t = np.arange(int(length * SR)) / SR
+    return 0.9 * np.sin(2 * np.pi * (50 + 80 * np.exp(-t * 30)) * t) * np.exp(-t * 12)
+
+
+def _hat(rng, length=0.04):
+    n = int(length * SR)
+    noise = rng.standard_normal(n)
+    # Diferença de primeira ordem ≈ passa-altas simples
+    noise = np.diff(noise, prepend=0.0)
+    return 0.12 * noise * np.exp(-np.arange(n) / SR * 90)
+
+
+def _tone(freq, length, amp, attack=0.01):
+    t = np.arange(int(length * SR)) / SR
+    env = np.minimum(1.0, t / attack) * np.exp(-t * 1.5)
+    return amp * env * np.sin(2 * np.pi * freq * t)
+
+
+def _pad(chord_midis, length, amp=0.06):
+    t = np.arange(int(length * SR)) / SR
+    env = np.minimum(1.0, t / 0.3) * np.minimum(1.0, (length - t) / 0.3)
+    out = np.zeros_like(t)
+    for m in chord_midis:
+        f = _midi_to_hz(m)
+        out += np.sin(2 * np.pi * f * t) + 0.3 * np.sin(2 * np.pi * 2 * f * t)
+    return amp * env * out
+
+
+def synth_track(bpm, key, seconds, swing=0.0, seed=0):
+    """Faixa sintética + gabarito.
+
+    Layout em quartos da duração (quantizados em compassos):
+      intro (kick + hats) → main (tudo) → breakdown (só pad) → drop (tudo).
+    Kick em todo tempo, hats nas colcheias (a do contratempo atrasada pelo
+    `swing`: 0.5 = reto, 0.62 ≈ shuffle), baixo em semínimas na fundamental
+    do acorde, um acorde por compasso.
+    """
+    rng = np.random.default_rng(seed)
+    root_pc, is_minor = aa._parse_key_root(key)
+    progression = _PROGRESSION_MINOR if is_minor else _PROGRESSION_MAJOR
+    beat = 60.0 / bpm
+    bar = 4 * beat
+    n_bars = int(seconds // bar)
+    duration = n_bars * bar
+    # float32: uma hora a 22 kHz cabe em ~300 MB
+    y = np.zeros(int(duration * SR) + 1, dtype=np.float32)
+
+    # Fronteiras de seção em compassos inteiros
+    cuts = [0] + [int(round(n_bars * q)) for q in (0.25, 0.5, 0.75)] + [n_bars]
+    sections = ["intro", "main", "breakdown", "drop"]
+
+    def _section_of(bar_idx):
+        for k in range(4):
+            if cuts[k] <= bar_idx < cuts[k + 1]:
+                return sections[k]
+        return sections[-1]
+
+    kick = _kick()
+    off = (swing if swing > 0 else 0.5) * beat
+    kick_beats, bass_notes = [], {}
+    for b in range(n_bars):
+        section = _section_of(b)
+        degree, quality = progression[b % len(progression)]
+        chord_root = 57 + (root_pc + degree - 9) % 12      # A3..G#4
+        third = 3 if quality == "m" else 4
+        _add(y, b * bar, _pad([chord_root, chord_root + third, chord_root + 7], bar))
+        bass_midi = 36 + (root_pc + degree) % 12            # C2..B2
+        for q in range(4):
+            t_beat = b * bar + q * beat
+            beat_idx = b * 4 + q
+            if section != "breakdown":
+                _add(y, t_beat, kick)
+                kick_beats.append(beat_idx)
+                _add(y, t_beat, _hat(rng))
+                _add(y, t_beat + off, _hat(rng))
+            if section in ("main", "drop"):
+                _add(y, t_beat, _tone(_midi_to_hz(bass_midi), beat * 0.9, 0.35))
+                bass_notes[beat_idx] = bass_midi
+
+    y /= np.max(np.abs(y)) * 1.1
+    truth = {
+        "bpm": bpm,
+        "key": key,
+        "swing": swing,
+        "boundaries": [round(c * bar, 3) for c in cuts[1:-1]],
+        "kick_beats": kick_beats,
+        "bass_notes": bass_notes,
+    }
+    return y, truth
+
+
+# ──────────────────────────────────────────────────────────────────
+# MÉTRICAS CONTRA O GABARITO
+# ──────────────────────────────────────────────────────────────────
+
+def score_bpm(detected, expected):
+    """Erro absoluto e classificação de oitava/relação (ok / x2 / x0.5 / x1.5 / ... / errado)."""
+    if not detected:
+        return {"detected": None, "abs_error": None, "octave": "falhou"}
+    ratio = float(detected) / expected
+    octave = "errado"
+    if abs(ratio - 1.0) <= 0.04:
+        octave = "ok"
+    else:
+        # Mesmas relações que o _reconcile_bpm corrige
+        for name, r in (("x2", 2.0), ("x0.5", 0.5), ("x1.5", 1.5), ("x0.67", 2.0 / 3.0),
+                        ("x1.33", 4.0 / 3.0), ("x0.75", 0.75)):
+            if abs(ratio - r) / r <= 0.04:
+                octave = name
+                break
+    return {
+        "detected": float(detected),
+        "abs_error": round(abs(float(detected) - expected), 2),
+        "octave": octave,
+    }
+
+
+def score_key(detected, expected):
+    """Pontuação MIREX: 1 exata, 0.5 quinta, 0.3 relativa, 0.2 paralela, 0 errada."""
+    if not detected:
+        return {"detected": None, "score": 0.0, "relation": "falhou"}
+    d_pc, d_min = aa._parse_key_root(detected)
+    e_pc, e_min = aa._parse_key_root(expected)
+    if d_pc == e_pc and d_min == e_min:
+        score, relation = 1.0, "exata"
+    elif d_min == e_min and (d_pc - e_pc) % 12 in (5, 7):
+        score, relation = 0.5, "quinta"
+    elif d_min != e_min and (d_pc - e_pc) % 12 == (3 if e_min else 9):
+        score, relation = 0.3, "relativa"
+    elif d_pc == e_pc:
+        score, relation = 0.2, "paralela"
+    else:
+        score, relation = 0.0, "errada"
+    return {"detected": detected, "score": score, "relation": relation}
+
+
+def score_groove(groove, expected_swing):
+    """Compara o groove_type com o esperado: reto sem swing, não-reto com swing."""
+    expected = "reto" if expected_swing <= 0.5 else "swing"
+    got = groove.get("groove_type")
+    ok = (got == "reto") if expected == "reto" else (got in ("groovado", "shuffle"))
+    return {"groove_type": got, "swing": groove.get("swing"), "expected": expected, "ok": ok}
+
+
+def score_boundaries(sections, expected, tolerance=3.0):
+    """F-measure das fronteiras de seção (±tolerance s), ignorando início/fim da faixa."""
+    detected = [float(s.get("start", 0)) for s in sections[1:]]
+    if not expected:
+        return {"f1": None, "precision": None, "recall": None, "detected": len(detected)}
+    hits_ref = sum(1 for e in expected if any(abs(d - e) <= tolerance for d in detected))
+    hits_est = sum(1 for d in detected if any(abs(d - e) <= tolerance for e in expected))
+    precision = hits_est / len(detected) if detected else 0.0
+    recall = hits_ref / len(expected)
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return {"f1": round(f1, 3), "precision": round(precision, 3), "recall": round(recall, 3),
+            "detected": len(detected)}
+
+
+def score_midi(midi, truth, tolerance=0.125):
+    """Kick: precisão/recall dos eventos contra os tempos (±tolerance beat) e
+    deslocamento de fase mediano da grade (beats; 0 = grade alinhada ao kick).
+    Baixo: acerto de classe de altura e de nota exata, ponderado pela duração."""
+    stems = midi.get("stems", {})
+    kick_truth = np.asarray(truth["kick_beats"], dtype=float)
+    kick_events = [float(ev["beat"]) for ev in stems.get("kick", [])]
+    kick = {"events": len(kick_events), "precision": 0.0, "recall": 0.0, "phase_offset": None}
+    if kick_events and len(kick_truth):
+        ke = np.asarray(kick_events)
+        dist_est = np.min(np.abs(ke[:, None] - kick_truth[None, :]), axis=1)
+        dist_ref = np.min(np.abs(kick_truth[:, None] - ke[None, :]), axis=1)
+        kick["precision"] = round(float(np.mean(dist_est <= tolerance)), 3)
+        kick["recall"] = round(float(np.mean(dist_ref <= tolerance)), 3)
+        frac = (ke + 0.5) % 1.0 - 0.5
+        kick["phase_offset"] = round(float(np.median(frac)), 3)
+
+    bass_truth = truth["bass_notes"]
+    total = pc_hits = exact_hits = 0.0
+    for ev in stems.get("bassline", []):
+        start, dur = float(ev["beat"]), float(ev.get("duration_beats", 1.0))
+        # Amostra o evento em passos de 1/4 de beat contra a nota do gabarito
+        for pos in np.arange(start, start + dur, 0.25):
+            expected = bass_truth.get(int(np.floor(pos)))
+            if expected is None:
+                continue
+            total += 0.25
+            if (ev["midi"] - expected) % 12 == 0:
+                pc_hits += 0.25
+                if ev["midi"] == expected:
+                    exact_hits += 0.25
+    bass = {
+        "events": len(stems.get("bassline", [])),
+        "pitch_class_acc": round(pc_hits / total, 3) if total else None,
+        "exact_acc": round(exact_hits / total, 3) if total else None,
+    }
+    return {"kick": kick, "bass": bass}
+
+
+# ──────────────────────────────────────────────────────────────────
+# EXECUÇÃO
+# ──────────────────────────────────────────────────────────────────
+
+def _timed(timings, name, fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    timings[name] = round(time.perf_counter() - t0, 4)
+    return out
+
+
+def run_case(case, seconds, seed=0, pitch_engine=None):
+    """Roda os estágios num caso; retorna {timings, scores} (tempos em s).
+
+    `pitch_engine`: motor de pitch da bassline/lead (ver aa.PITCH_ENGINES).
+    """
+    y, truth = synth_track(case["bpm"], case["key"], seconds, swing=case["swing"], seed=seed)
+    duration = len(y) / float(SR)
+    timings = {}
+
+    ctx = aa.AnalysisContext(y, SR)
+    _timed(timings, "hpss", lambda: ctx.y_perc)
+    bpm = _timed(timings, "detect_bpm", aa.detect_bpm, y, SR)
+    key = _timed(timings, "detect_key", aa.detect_key, y, SR, ctx=ctx)
+    groove = _timed(timings, "groove", aa.analyze_groove_and_rhythm, y, SR, bpm, ctx=ctx)
+    structure = _timed(timings, "structure", aa.detect_structure_adaptive, y, SR, duration,
+                       bpm=bpm, ctx=ctx)
+    # MIDI usa o BPM do gabarito: mede a extração isolada do erro de BPM
+    midi = _timed(timings, "midi", aa.extract_midi_from_audio, y, SR, duration, truth["bpm"],
+                  truth["key"], {}, {}, None, ctx=ctx, pitch_engine=pitch_engine)
+    timings["total"] = round(sum(timings.values()), 4)
+
+    return {
+        "case": case["name"],
+        "duration": round(duration, 2),
+        "timings": timings,
+        "bpm": score_bpm(bpm, truth["bpm"]),
+        "key": score_key(key, truth["key"]),
+        "groove": score_groove(groove, truth["swing"]),
+        "structure": score_boundaries(structure.get("sections", []), truth["boundaries"]),
+        "midi": score_midi(midi, truth),
+    }
+
+
+def _print_table(results, stream):
+    header = (f"{'caso':<20} {'dur':>5} {'total':>7} {'midi':>6}  {'bpm':>12} {'key':>14} "
+              f"{'groove':>10} {'estr F1':>7} {'kick P/R':>11} {'baixo pc':>8}")
+    stream.write(header + "\n" + "─" * len(header) + "\n")
+    for r in results:
+        b, k, g, s, m = r["bpm"], r["key"], r["groove"], r["structure"], r["midi"]
+        bpm_txt = f"{b['detected']}({b['octave']})" if b["detected"] else "falhou"
+        key_txt = f"{k['detected']}({k['relation']})"
+        groove_txt = f"{g['groove_type']}{'' if g['ok'] else '✗'}"
+        kick_txt = f"{m['kick']['precision']:.2f}/{m['kick']['recall']:.2f}"
+        bass_pc = m["bass"]["pitch_class_acc"]
+        stream.write(
+            f"{r['case']:<20} {r['duration']:>5.0f} {r['timings']['total']:>7.2f} "
+            f"{r['timings']['midi']:>6.2f}  {bpm_txt:>12} {key_txt:>14} {groove_txt:>10} "
+            f"{s['f1'] if s['f1'] is not None else '-':>7} {kick_txt:>11} "
+            f"{bass_pc if bass_pc is not None else '-':>8}\n"
+        )
+
+
+def summarize(results):
+    """Agregados da rodada: acertos de BPM/tonalidade e médias de precisão/tempo."""
+    def _mean(values):
+        values = [v for v in values if v is not None]
+        return round(float(np.mean(values)), 3) if values else None
+
+    return {
+        "cases": len(results),
+        "bpm_octave_ok": sum(1 for r in results if r["bpm"]["octave"] == "ok"),
+        "key_mirex_mean": _mean([r["key"]["score"] for r in results]),
+        "groove_ok": sum(1 for r in results if r["groove"]["ok"]),
+        "structure_f1_mean": _mean([r["structure"]["f1"] for r in results]),
+        "kick_recall_mean": _mean([r["midi"]["kick"]["recall"] for r in results]),
+        "bass_pitch_class_mean": _mean([r["midi"]["bass"]["pitch_class_acc"] for r in results]),
+        "total_time_s": round(sum(r["timings"]["total"] for r in results), 2),
+    }
+
+
+# ──────────────────────────────────────────────────────────────────
+# ESCALONAMENTO COM A DURAÇÃO (--scaling)
+# ──────────────────────────────────────────────────────────────────
+
+SCALING_DURATIONS_MIN = (3, 6, 12, 30, 60)
+
+
+def _growth_exponent(n, t):
+    """Inclinação do ajuste log-log t ∝ n^k (mínimos quadrados)."""
+    return float(np.polyfit(np.log(n), np.log(t), 1)[0])
+
+
+def run_scaling(durations_min, tolerance=0.15, min_time=0.05, case=None):
+    """Roda o pipeline completo (analyze_audio + StageProfiler) em cada duração.
+
+    O expoente de cada estágio é ajustado contra a duração, e comparado ao
+    expoente de n·log n nos mesmos pontos. Não contra duração × sr efetivo: o
+    analisador reduz o sr de faixas longas, mas decode, pirâmide e onsets da
+    banda de cima rodam em taxa fixa e crescem com a duração. Estágio acima desse
+    teto + `tolerance` é marcado como superlinear. Estágios que não passam de
+    `min_time` segundos em nenhuma duração ficam de fora (só ruído).
+    """
+    import tempfile
+    import soundfile as sf
+
+    case = case or CASES[0]
+    durations_min = sorted(set(durations_min))
+    per_stage = {}
+    sample_rates = []
+    for minutes in durations_min:
+        y, _truth = synth_track(case["bpm"], case["key"], minutes * 60.0, swing=case["swing"])
+        fd, path = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        try:
+            sf.write(path, y, SR)
+            del y
+            profiler = aa.StageProfiler()
+            result = aa.analyze_audio(path, use_cache=False, streaming=False, profiler=profiler)
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if not result.get("success"):
+            raise RuntimeError(f"análise falhou em {minutes} min: {result.get('error')}")
+        report = profiler.report()
+        sample_rates.append(int(result["sample_rate"]))
+        for stage in report["stages"] + [{"name": "total", **report["total"]}]:
+            # Estágios repetidos no mesmo caminho somam (ex.: sub-estágios em laço)
+            per_stage.setdefault(stage["name"], {})
+            per_stage[stage["name"]][minutes] = per_stage[stage["name"]].get(minutes, 0.0) + stage["wall_s"]
+        sys.stderr.write(f"[Info] {minutes} min: {report['total']['wall_s']:.1f}s "
+                         f"(sr={result['sample_rate']}, pico {report['total']['peak_rss_mb']} MB)\n")
+
+    n_arr = np.asarray(durations_min, dtype=float) * 60.0 * SR
+    ceiling = _growth_exponent(n_arr, n_arr * np.log(n_arr)) + tolerance
+    stages = []
+    for name, points in per_stage.items():
+        ms = sorted(points)
+        ts = np.asarray([max(points[m], 1e-4) for m in ms])
+        if len(ms) < 3 or ts.max() < min_time:
+            continue
+        k = _growth_exponent(np.asarray(ms, dtype=float), ts)
+        stages.append({
+            "stage": name,
+            "exponent": round(k, 3),
+            "superlinear": bool(k > ceiling),
+            "wall_s": {f"{m:g}": round(float(points[m]), 3) for m in ms},
+        })
+    stages.sort(key=lambda st: -st["exponent"])
+    return {
+        "durations_min": list(durations_min),
+        "sample_rates": sample_rates,
+        "ceiling_exponent": round(ceiling, 3),
+        "stages": stages,
+        "failed": [st["stage"] for st in stages if st["superlinear"]],
+    }
+
+
+def _print_scaling(report, stream):
+    stream.write(f"teto (n·log n + tolerância): expoente {report['ceiling_exponent']}\n")
+    header = f"{'estágio':<52} {'expoente':>8}  tempos (s)"
+    stream.write(header + "\n" + "─" * 90 + "\n")
+    for st in report["stages"]:
+        flag = "  ✗ SUPERLINEAR" if st["superlinear"] else ""
+        times = " ".join(f"{v:.2f}" for v in st["wall_s"].values())
+        stream.write(f"{st['stage']:<52} {st['exponent']:>8.2f}  {times}{flag}\n")
+
+
+# ──────────────────────────────────────────────────────────────────
+# BIBLIOTECA REAL (--library): BPM do nome Beatport como gabarito
+# ──────────────────────────────────────────────────────────────────
+
+SR_TIERS = (22050, 16000, 11025)
+
+
+def _key_label(file_path):
+    """Tonalidade gravada nas tags (TKEY / initialkey), se o mutagen estiver instalado."""
+    return aa.read_track_hints(file_path).get("key")
+
+
+def run_library(source, tiers=None, limit=None, with_key=True):
+    """Compara detect_bpm cru e conciliado (e a tonalidade, se houver tag) contra
+    os rótulos das faixas com BPM Beatport no nome.
+
+    `tiers`: lista de sr a testar; None = só o sr que a política adaptativa
+    (_target_sr) escolheria para cada faixa.
+    """
+    import librosa
+
+    files = [f for f in aa._collect_batch_files(source) if aa._bpm_from_filename(f)]
+    if limit:
+        files = files[:limit]
+    tracks = []
+    for i, path in enumerate(files, 1):
+        label_bpm = aa._bpm_from_filename(path)
+        label_key = _key_label(path) if with_key else None
+        duration = aa._probe_duration(path)
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        track_tiers = tiers or [aa._target_sr(duration, size_mb)]
+        entry = {"file": os.path.basename(path), "duration": round(duration, 1),
+                 "label_bpm": label_bpm, "label_key": label_key, "tiers": {}}
+        for sr in track_tiers:
+            timings = {}
+            y, _ = _timed(timings, "load", librosa.load, path, sr=sr, mono=True)
+            # Mesmo contexto da análise: BPM pelo rastreador compartilhado e key pelo
+            # cromagrama do CQT harmônico (HPSS medido à parte, como em run_case)
+            ctx = aa.AnalysisContext(y, sr)
+            raw = _timed(timings, "detect_bpm", aa.detect_bpm, y, sr, ctx=ctx)
+            tier = {
+                "bpm_raw": score_bpm(raw, label_bpm),
+                "bpm_reconciled": score_bpm(aa._reconcile_bpm(raw, label_bpm), label_bpm),
+            }
+            if label_key:
+                _timed(timings, "hpss", getattr, ctx, "y_harm")
+                key = _timed(timings, "detect_key", aa.detect_key, y, sr, ctx=ctx)
+                tier["key"] = score_key(key, label_key)
+            tier["timings"] = timings
+            entry["tiers"][str(sr)] = tier
+            del y, ctx
+        tracks.append(entry)
+        summary = " ".join(f"{sr}:{t['bpm_raw']['detected']}({t['bpm_raw']['octave']})"
+                           for sr, t in entry["tiers"].items())
+        sys.stderr.write(f"[Info] {i}/{len(files)} {entry['file']} [{label_bpm}] → {summary}\n")
+    return {"source": source, "tracks": tracks, "summary": summarize_library(tracks)}
+
+
+def summarize_library(tracks):
+    """Por tier de sr: taxa de acerto/oitava do BPM cru, acerto após conciliação,
+    MIREX médio da tonalidade e tempo médio por faixa."""
+    by_tier = {}
+    for entry in tracks:
+        for sr, tier in entry["tiers"].items():
+            by_tier.setdefault(sr, []).append((entry, tier))
+    out = {}
+    for sr, items in sorted(by_tier.items(), key=lambda kv: -int(kv[0])):
+        n = len(items)
+        octaves = [t["bpm_raw"]["octave"] for _, t in items]
+        keys = [t["key"]["score"] for _, t in items if "key" in t]
+        per_track = [sum(t["timings"].values()) for _, t in items]
+        per_minute = [sum(t["timings"].values()) / max(e["duration"] / 60.0, 1e-6) for e, t in items]
+        out[sr] = {
+            "tracks": n,
+            "bpm_raw_ok": round(octaves.count("ok") / n, 3),
+            "bpm_octave_error": round(sum(o in ("x2", "x0.5") for o in octaves) / n, 3),
+            "bpm_ratio_error": round(sum(o.startswith("x") and o not in ("x2", "x0.5")
+                                         for o in octaves) / n, 3),
+            "bpm_wrong": round(sum(o in ("errado", "falhou") for o in octaves) / n, 3),
+            "bpm_reconciled_ok": round(sum(t["bpm_reconciled"]["octave"] == "ok"
+                                           for _, t in items) / n, 3),
+            "key_tracks": len(keys),
+            "key_mirex_mean": round(float(np.mean(keys)), 3) if keys else None,
+            "time_per_track_s": round(float(np.mean(per_track)), 3),
+            "time_per_minute_s": round(float(np.mean(per_minute)), 3),
+        }
+    return out
+
+
+def _print_library(report, stream):
+    header = (f"{'sr':>6} {'faixas':>6} {'bpm ok':>7} {'oitava':>7} {'relação':>8} {'errado':>7} "
+              f"{'concil.':>8} {'key':>6} {'s/faixa':>8} {'s/min':>6}")
+    stream.write(header + "\n" + "─" * len(header) + "\n")
+    for sr, t in report["summary"].items():
+        key_txt = f"{t['key_mirex_mean']:.2f}" if t["key_mirex_mean"] is not None else "-"
+        stream.write(
+            f"{sr:>6} {t['tracks']:>6} {t['bpm_raw_ok']:>7.1%} {t['bpm_octave_error']:>7.1%} "
+            f"{t['bpm_ratio_error']:>8.1%} {t['bpm_wrong']:>7.1%} {t['bpm_reconciled_ok']:>8.1%} "
+            f"{key_txt:>6} {t['time_per_track_s']:>8.2f} {t['time_per_minute_s']:>6.2f}\n"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sintético (velocidade + precisão) do audio_analyzer"
+    )
+    parser.add_argument("--seconds", type=float, default=60.0,
+                        help="duração de cada sinal sintético (padrão: 60)")
+    parser.add_argument("--cases", default=None,
+                        help="nomes separados por vírgula (padrão: todos) — " +
+                             ", ".join(c["name"] for c in CASES))
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="repetições por caso; reporta a mediana dos tempos")
+    parser.add_argument("--json", metavar="ARQUIVO", help="grava o relatório completo em JSON")
+    parser.add_argument("--scaling", action="store_true",
+                        help="benchmark de escalonamento: expoente de crescimento por estágio")
+    parser.add_argument("--durations", default=",".join(str(d) for d in SCALING_DURATIONS_MIN),
+                        help="durações em minutos para --scaling (padrão: 3,6,12,30,60)")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="folga sobre o expoente de n·log n antes de reprovar (padrão: 0.15)")
+    parser.add_argument("--library", metavar="ORIGEM",
+                        help="pasta (recursiva) ou arquivo-lista de faixas com BPM Beatport no nome")
+    parser.add_argument("--sr-tiers", action="store_true",
+                        help="com --library: testa cada faixa em 22050/16000/11025 Hz "
+                             "(padrão: só o sr da política adaptativa)")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="com --library: no máximo N faixas")
+    parser.add_argument("--pitch-engine", choices=aa.PITCH_ENGINES, default=None,
+                        help="motor de pitch da bassline/lead (padrão: o do analisador)")
+    args = parser.parse_args()
+
+    if args.library:
+        sys.stderr.write("[Info] aquecendo (JIT/caches)...\n")
+        run_case(CASES[0], 10.0)
+        report = run_library(args.library, tiers=list(SR_TIERS) if args.sr_tiers else None,
+                             limit=args.limit)
+        if not report["tracks"]:
+            sys.stdout.write("Nenhuma faixa com BPM Beatport no nome (ex.: '... (125) ...').\n")
+            return
+        _print_library(report, sys.stdout)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return
+
+    if args.scaling:
+        durations = [float(d) for d in args.durations.split(",") if d.strip()]
+        if len(durations) < 3:
+            parser.error("--durations precisa de pelo menos 3 pontos")
+        sys.stderr.write("[Info] aquecendo (JIT/caches)...\n")
+        run_case(CASES[0], 10.0)
+        report = run_scaling(durations, tolerance=args.tolerance)
+        _print_scaling(report, sys.stdout)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if report["failed"]:
+            sys.stdout.write(f"\nSUPERLINEAR: {', '.join(report['failed'])}\n")
+            sys.exit(1)
+        return
+
+    cases = CASES
+    if args.cases:
+        wanted = {name.strip() for name in args.cases.split(",") if name.strip()}
+        cases = [c for c in CASES if c["name"] in wanted]
+        unknown = wanted - {c["name"] for c in cases}
+        if unknown:
+            parser.error(f"casos desconhecidos: {', '.join(sorted(unknown))}")
+
+    # Aquecimento: a primeira chamada paga JIT do numba e caches de filtros do librosa
+    sys.stderr.write("[Info] aquecendo (JIT/caches)...\n")
+    run_case(cases[0], min(args.seconds, 10.0), pitch_engine=args.pitch_engine)
+
+    results = []
+    for case in cases:
+        runs = [run_case(case, args.seconds, pitch_engine=args.pitch_engine)
+                for _ in range(max(1, args.repeat))]
+        result = runs[0]
+        if len(runs) > 1:
+            result["timings"] = {
+                name: round(float(np.median([r["timings"][name] for r in runs])), 4)
+                for name in result["timings"]
+            }
+        results.append(result)
+        sys.stderr.write(f"[Info] {case['name']}: {result['timings']['total']:.2f}s\n")
+
+    _print_table(results, sys.stdout)
+    summary = summarize(results)
+    sys.stdout.write("\n" + json.dumps(summary, ensure_ascii=False) + "\n")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"seconds": args.seconds, "repeat": args.repeat,
+                       "pitch_engine": aa.resolve_pitch_engine(args.pitch_engine), "summary": summary,
+                       "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
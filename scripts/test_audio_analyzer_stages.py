@@ -0,0 +1,129 @@
+"""Testes do agendador de estágios do audio_analyzer (plano, versões baratas, paralelo).
+
+Rodar da raiz do repositório: python -m pytest -q scripts
+"""
+import numpy as np
+import pytest
+
+import audio_analyzer as aa
+
+HINTS_BPM = {"bpm": 125.0, "bpm_source": "filename", "key": None, "key_source": None}
+HINTS_FULL = {"bpm": 125.0, "bpm_source": "tag", "key": "Am", "key_source": "tag"}
+
+
+def _plan(outputs, hints=None):
+    outputs = aa.resolve_outputs(outputs)
+    fast = aa.fast_stages(outputs, hints=hints)
+    return aa.plan_stages(outputs, hints=hints, fast=fast), fast
+
+
+def test_plan_bpm_key_sem_hints_dispensa_hpss():
+    stages, fast = _plan(["bpm", "key"])
+    assert fast == ("key",)
+    assert stages == ["decode", "bpm", "key"]
+
+
+def test_plan_bpm_key_com_hints():
+    assert _plan(["bpm", "key"], HINTS_BPM)[0] == ["decode", "bpm", "key"]
+    assert _plan(["bpm", "key"], HINTS_FULL)[0] == ["decode", "bpm", "key"]
+
+
+def test_plan_bpm_com_hint_nao_decodifica():
+    assert _plan(["bpm"], HINTS_BPM)[0] == ["bpm"]
+    assert _plan(["bpm"])[0] == ["decode", "bpm"]
+
+
+def test_plan_completo_em_ordem_topologica():
+    stages, fast = _plan(None)
+    assert fast == ()
+    assert stages == list(aa.ANALYSIS_STAGES)
+    for i, name in enumerate(stages):
+        assert all(stages.index(dep) < i for dep in aa.stage_deps(name))
+
+
+@pytest.mark.parametrize("outputs", [["key", "harmony"], ["key", "drums"], ["bpm", "key", "groove"], None])
+def test_fast_stages_mantem_hpss_quando_outro_estagio_usa(outputs):
+    stages, fast = _plan(outputs)
+    assert fast == ()
+    assert "hpss" in stages
+
+
+@pytest.mark.parametrize("outputs", [["key"], ["bpm", "key"], ["key", "loudness", "mix"]])
+def test_fast_stages_tira_hpss_quando_so_o_key_usa(outputs):
+    stages, fast = _plan(outputs)
+    assert fast == ("key",)
+    assert "hpss" not in stages
+
+
+@pytest.fixture(scope="module")
+def synthetic_clip(tmp_path_factory):
+    sf = pytest.importorskip("soundfile")
+    sr = 22050
+    t = np.arange(int(8.0 * sr)) / float(sr)
+    beat = 60.0 / 125.0
+    y = 0.2 * np.sin(2 * np.pi * 110.0 * t) + 0.1 * np.sin(2 * np.pi * 440.0 * t)
+    y += 0.6 * np.sin(2 * np.pi * 55.0 * t) * np.exp(-(t % beat) * 20.0)
+    path = tmp_path_factory.mktemp("clip") / "clip.wav"
+    sf.write(str(path), y.astype(np.float32), sr)
+    return str(path)
+
+
+def test_paralelo_igual_ao_serial(synthetic_clip):
+    serial = aa.analyze_audio(synthetic_clip, use_cache=False, workers=1)
+    parallel = aa.analyze_audio(synthetic_clip, use_cache=False, workers=3)
+    assert serial["success"], serial.get("error")
+    assert parallel == serial
+
+
+def test_perfil_serial_e_paralelo_listam_os_mesmos_estagios(synthetic_clip):
+    def stage_names(workers):
+        profiler = aa.StageProfiler()
+        result = aa.analyze_audio(synthetic_clip, use_cache=False, workers=workers, profiler=profiler)
+        assert result["success"], result.get("error")
+        return sorted(entry["name"] for entry in profiler.report()["stages"])
+
+    serial = stage_names(1)
+    assert "basic/bpm" in serial and "structure/dynamics" in serial
+    assert stage_names(3) == serial
+
+
+def _groove_clip(path, bpm, seconds=40.0):
+    """Kick em todo beat + hi-hat só no contratempo (house/techno reto)."""
+    sf = pytest.importorskip("soundfile")
+    sr = 22050
+    t = np.arange(int(seconds * sr)) / float(sr)
+    beat = 60.0 / bpm
+    rng = np.random.default_rng(0)
+    y = 0.6 * np.sin(2 * np.pi * 55.0 * t) * np.exp(-(t % beat) * 20.0)
+    y += 0.3 * rng.standard_normal(len(t)) * np.exp(-((t + beat / 2.0) % beat) * 80.0)
+    sf.write(str(path), y.astype(np.float32), sr)
+    return str(path)
+
+
+@pytest.mark.parametrize("bpm", [124.0, 126.0])
+def test_verify_bpm_hint_mantem_hint_correto_com_hat_no_contratempo(tmp_path, bpm):
+    path = _groove_clip(tmp_path / "groove.wav", bpm)
+    assert aa.verify_bpm_hint(path, bpm) == (bpm, True)
+
+
+def test_verify_bpm_hint_corrige_so_meia_velocidade_real(tmp_path):
+    path = _groove_clip(tmp_path / "dnb.wav", 174.0)
+    assert aa.verify_bpm_hint(path, 87.0) == (174.0, False)
+    assert aa.verify_bpm_hint(path, 174.0) == (174.0, True)
+    slow = _groove_clip(tmp_path / "slow.wav", 87.0)
+    assert aa.verify_bpm_hint(slow, 87.0) == (87.0, True)
+
+
+@pytest.mark.parametrize("seconds", [7.3, 1.0])
+def test_hpss_blocked_igual_ao_monolitico(seconds):
+    """7.3 s atravessa vários blocos de 64 frames; 1 s cabe num bloco só."""
+    librosa = pytest.importorskip("librosa")
+    sr = 22050
+    t = np.arange(int(seconds * sr)) / float(sr)
+    rng = np.random.default_rng(0)
+    y = 0.3 * np.sin(2 * np.pi * 220.0 * t) + 0.2 * rng.standard_normal(len(t)) * np.exp(-(t % 0.5) * 30.0)
+    y = y.astype(np.float32)
+    y_harm, y_perc = aa.hpss_blocked(y, block_frames=64, workers=2)
+    ref_harm, ref_perc = librosa.effects.hpss(y)
+    assert np.allclose(y_harm, ref_harm, atol=1e-6)
+    assert np.allclose(y_perc, ref_perc, atol=1e-6)
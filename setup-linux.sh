@@ -138,6 +138,20 @@ else
     exit 1
 fi
 
+# 4.1. Dependências Python do analisador de áudio
+echo -e "\n${BLUE}🎵 Verificando dependências Python do analisador...${NC}"
+if command_exists python3; then
+    # librosa/numpy/scipy/soundfile: obrigatórias; threadpoolctl e mutagen
+    # (tags BPM/tonalidade do modo --hints): opcionais
+    if python3 -m pip install --user librosa numpy scipy soundfile threadpoolctl mutagen; then
+        echo -e "${GREEN}✅ Dependências Python instaladas${NC}"
+    else
+        echo -e "${YELLOW}⚠️  Falha no pip: instale manualmente (ver SETUP-LINUX.md)${NC}"
+    fi
+else
+    echo -e "${YELLOW}⚠️  python3 não encontrado: a análise de áudio ficará indisponível${NC}"
+fi
+
 # 5. Configurar downloads.config.json
 echo -e "\n${BLUE}⚙️  Configurando downloads.config.json...${NC}"
 DOWNLOADS_DIR="$HOME/Downloads/legolas"